@@ -0,0 +1,300 @@
+import os
+import sys
+import json
+import time
+import argparse
+from llama_cpp import LlamaGrammar
+from utils.chat import Chat
+from utils.config import Config, ConfigError
+from utils.files import file_to_markdown
+from utils.grammar import GrammarCache
+from utils.loader import create_chat, create_response_cache, disable_llama_logs, load_model
+from utils.parallel import ParallelDecoder, generate_replies, sample_replies
+from utils.response_cache import RANDOM_SEEDS
+
+
+ENV_FILE = '.env'
+AGENTS = (Chat.SYSTEM_KEY, Chat.USER_KEY, Chat.ASSISTANT_KEY)
+
+
+def print_error(msg: str) -> None:
+    print(f'[ERROR] {msg}', file=sys.stderr)
+
+
+def parse_item(item: dict, working_dir: str) -> list[tuple[str, str]]:
+    """
+    Get the messages of a batch item. An item is either a conversation
+    `{"messages": [{"role": "system" | "user" | "assistant", "content": "..."}]}`
+    or a single prompt `{"system": "...", "files": ["..."], "prompt": "..."}`
+    where `system` and `files` are optional.
+
+    @param item: the batch item
+    @param working_dir: the directory of the relative file paths
+    @return: the messages as (agent, content) tuples
+    @raises ValueError: if the item is not valid
+    """
+    if 'messages' in item:
+        messages = []
+        for message in item['messages']:
+            if not isinstance(message, dict) or message.get('role') not in AGENTS or not isinstance(message.get('content'), str):
+                raise ValueError(f'messages must have a role ({", ".join(AGENTS)}) and a content')
+            messages.append((message['role'], message['content']))
+    elif isinstance(item.get('prompt'), str):
+        messages = [(Chat.SYSTEM_KEY, item['system'])] if item.get('system') else []
+        # The files go before the prompt, so that items about the same files share the prefix
+        parts = []
+        for file_path in item.get('files', []):
+            file_full_path = file_path if os.path.isabs(file_path) else os.path.join(working_dir, file_path)
+            if not os.path.isfile(file_full_path):
+                raise ValueError(f'"{file_path}" does not exist')
+            parts.append(file_to_markdown(file_full_path))
+        parts.append(item['prompt'])
+        messages.append((Chat.USER_KEY, '\n\n'.join(parts)))
+    else:
+        raise ValueError('the item needs "messages" or "prompt"')
+
+    if len(messages) == 0 or messages[-1][0] != Chat.USER_KEY:
+        raise ValueError('the last message must be from the user')
+
+    return messages
+
+
+def read_items(f, working_dir: str) -> list[tuple[int, object, list[tuple[str, str]] | str, int]]:
+    """
+    Read the batch items from a JSON lines stream
+
+    @param f: the stream
+    @param working_dir: the directory of the relative file paths
+    @return: the position, the id, the messages (or the error) and the number of replies of each item
+    """
+    items = []
+    for index, line in enumerate(f):
+        if len(line.strip()) == 0:
+            continue
+        item_id = index
+        try:
+            item = json.loads(line)
+            if not isinstance(item, dict):
+                raise ValueError('the item must be a JSON object')
+            item_id = item.get('id', index)
+            n = item.get('n', 1)
+            if not isinstance(n, int) or n < 1:
+                raise ValueError('"n" must be a positive integer')
+            items.append((index, item_id, parse_item(item, working_dir), n))
+        except ValueError as e:  # json.JSONDecodeError included
+            items.append((index, item_id, f'invalid item: {e}', 1))
+
+    return items
+
+
+def start_item(chat: Chat, messages: list[tuple[str, str]]) -> str | None:
+    """
+    Replace the messages of the chat with the ones of an item
+
+    @param chat: the chat
+    @param messages: the messages as (agent, content) tuples
+    @return: the error if there is no room for the reply
+    """
+    chat.reset_chat()
+    for agent, content in messages:
+        chat.send_message(agent, content)
+
+    if chat.context_available() <= len(chat.header_tokens[Chat.ASSISTANT_KEY]):  # No room for a single token of the reply
+        return f'the prompt is too long ({chat.tokens_used()} tokens)'
+
+    return None
+
+
+def run_batch(
+        chats: list[Chat],
+        items: list[tuple[int, object, list[tuple[str, str]] | str, int]],
+        out,
+        decoder: ParallelDecoder | None = None,
+        grammar: LlamaGrammar | None = None,
+        seed: int = -1
+) -> dict:
+    """
+    Generate the replies of each item and write the results as JSON lines.
+    The items are processed sorted by their messages, so that items sharing a prefix
+    (system prompt, injected files...) are adjacent and the tokens already evaluated
+    for the previous item are reused instead of being evaluated again.
+    With a parallel decoder, up to one item per chat is decoded together (the shared
+    prefix is evaluated once) and the `n` replies of an item are sampled together.
+    The `n` replies of an item use the seeds that follow the seed of the model, so they differ.
+
+    @param chats: the chats used to generate the replies (only the first one without a parallel decoder)
+    @param items: the position, the id, the messages (or the error) and the number of replies of each item
+    @param out: the stream where the results are written
+    @param decoder: the parallel decoder, if any
+    @param grammar: the grammar that constrains every reply, if any
+    @param seed: the seed of the model
+    @return: the aggregate stats
+    """
+    stats = {'items': 0, 'errors': 0, 'prompt_tokens': 0, 'evaluated_tokens': 0, 'generated_tokens': 0, 'seconds': 0.0}
+    start_time = time.perf_counter()
+
+    def write_result(result: dict) -> None:
+        stats['items'] += 1
+        stats['errors'] += 'error' in result
+        out.write(json.dumps(result) + '\n')
+        out.flush()
+
+    group: list[tuple[int, object, list[tuple[str, str]]]] = []
+
+    def run_group() -> None:
+        group_start_time = time.perf_counter()
+        group_chats = chats[:len(group)]
+        replies = generate_replies(decoder, group_chats, seed=seed, grammar=grammar)
+        stats['evaluated_tokens'] += decoder.n_evaluated
+        for (index, item_id, _), chat, reply in zip(group, group_chats, replies):
+            n_generated = chat.content_length(chat.messages[-1])
+            n_prompt = chat.messages[-1].offset + len(chat.header_tokens[Chat.ASSISTANT_KEY])  # The header is part of the prompt of the decoder
+            stats['prompt_tokens'] += n_prompt
+            stats['generated_tokens'] += n_generated
+            write_result({
+                'index': index,
+                'id': item_id,
+                'reply': reply,
+                'prompt_tokens': n_prompt,
+                'generated_tokens': n_generated,
+                'seconds': time.perf_counter() - group_start_time
+            })
+        group.clear()
+
+    chat = chats[0]
+    for index, item_id, messages, n in sorted(items, key=lambda item: (isinstance(item[2], str), item[2])):
+        result = {'index': index, 'id': item_id}
+        if isinstance(messages, str):
+            result['error'] = messages
+            write_result(result)
+            continue
+
+        if decoder is not None and n == 1:  # Decoded together with the next items
+            error = start_item(chats[len(group)], messages)
+            if error is not None:
+                result['error'] = error
+                write_result(result)
+            else:
+                group.append((index, item_id, messages))
+                if len(group) == len(chats):
+                    run_group()
+            continue
+
+        if len(group) > 0:  # The first chat is needed for this item
+            run_group()
+        item_start_time = time.perf_counter()
+        error = start_item(chat, messages)
+        if error is not None:
+            result['error'] = error
+        elif decoder is not None:  # Best-of-n
+            if n > decoder.n_seq:
+                result['error'] = f'at most {decoder.n_seq} replies can be sampled together'
+            else:
+                n_prompt = (chat.tokens_used() + len(chat.header_tokens[Chat.ASSISTANT_KEY])) * n  # The prompt of every sample
+                replies = sample_replies(decoder, chat, n, seed=seed, grammar=grammar)
+                n_generated = sum(len(chat.tokenize_text(reply)) for reply in replies)
+                stats['prompt_tokens'] += n_prompt
+                stats['evaluated_tokens'] += decoder.n_evaluated
+                stats['generated_tokens'] += n_generated
+                result.update({
+                    'replies': replies, 'prompt_tokens': n_prompt, 'reused_tokens': n_prompt - decoder.n_evaluated,
+                    'generated_tokens': n_generated, 'seconds': time.perf_counter() - item_start_time
+                })
+        else:
+            n_prompt = chat.tokens_used() * n  # The prompt of every sample, like the evaluated tokens
+            replies = []
+            n_evaluated = 0
+            n_generated = 0
+            for i in range(n):
+                if i > 0:  # Only the reply of the previous sample has to be removed from the context
+                    start_item(chat, messages)
+                if seed not in RANDOM_SEEDS:  # Like the sequences of the parallel decoder, a random seed already differs
+                    chat.model.set_seed(seed + i)
+                n_evaluated += chat.prefill()
+                replies.append(chat.generate_assistant_reply(grammar=grammar)[0])
+                n_generated += chat.content_length(chat.messages[-1])
+            stats['prompt_tokens'] += n_prompt
+            stats['evaluated_tokens'] += n_evaluated
+            stats['generated_tokens'] += n_generated
+            result.update({'prompt_tokens': n_prompt, 'reused_tokens': n_prompt - n_evaluated, 'generated_tokens': n_generated})
+            result.update({'reply': replies[0]} if n == 1 else {'replies': replies})
+            result['seconds'] = time.perf_counter() - item_start_time
+        write_result(result)
+
+    if len(group) > 0:
+        run_group()
+
+    stats['seconds'] = time.perf_counter() - start_time
+    return stats
+
+
+def print_batch_stats(stats: dict) -> None:
+    seconds = stats['seconds'] if stats['seconds'] > 0 else float('inf')
+    reused = stats['prompt_tokens'] - stats['evaluated_tokens']
+    print(
+        f'{stats["items"]} items ({stats["errors"]} errors) in {stats["seconds"]:.2f}s: '
+        f'{stats["prompt_tokens"]} prompt tokens ({reused} reused), {stats["generated_tokens"]} generated tokens, '
+        f'{(stats["evaluated_tokens"] + stats["generated_tokens"]) / seconds:.1f} tokens/s, {stats["generated_tokens"] / seconds:.1f} generated tokens/s',
+        file=sys.stderr
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate the replies to a JSON lines file of prompts or conversations')
+    parser.add_argument('input', nargs='?', default='-', help='the JSON lines file to read (default: stdin)')
+    parser.add_argument('-o', '--output', default='-', help='the JSON lines file where the results are written (default: stdout)')
+    parser.add_argument('--parallel', type=int, default=1, metavar='N', help='decode up to N items (or the N replies of an item) together')
+    parser.add_argument('--json-schema', metavar='FILE', help='make every reply a JSON value that follows the schema in FILE (or the grammar of a .gbnf FILE)')
+    args = parser.parse_args()
+    if args.parallel < 1:
+        print_error('--parallel must be at least 1')
+        sys.exit(1)
+
+    working_dir = os.getcwd() if args.input == '-' else os.path.dirname(os.path.abspath(args.input))
+    try:
+        in_file = sys.stdin if args.input == '-' else open(args.input, 'r')
+        with in_file:
+            items = read_items(in_file, working_dir)
+    except OSError as e:
+        print_error(f'cannot read the input: {e}')
+        sys.exit(1)
+
+    decoder = None
+    try:
+        config = Config(ENV_FILE)
+    except ConfigError as e:
+        print_error(str(e))
+        sys.exit(1)
+    seed = config.seed
+    disable_llama_logs()
+
+    try:
+        model = load_model(config)
+    except ValueError as e:
+        print_error(f'cannot load the model: {e}')
+        sys.exit(1)
+    # Storing every prompt in the prompt cache would cost more than it saves, and a full context must not stop the batch
+    response_cache = create_response_cache(config) if config.response_cache_file else None  # Shared by the chats
+    chats = [create_chat(config, model, prompt_cache=None, context_policy=Chat.POLICY_SLIDE, response_cache=response_cache) for _ in range(args.parallel)]
+    if args.parallel > 1:
+        decoder = ParallelDecoder(model, args.parallel, n_ctx=config.n_ctx * args.parallel)
+
+    grammar = None
+    if args.json_schema:
+        try:
+            grammar = GrammarCache(chats[0].model).from_file(args.json_schema)
+        except (OSError, ValueError) as e:
+            print_error(f'cannot use "{args.json_schema}": {e}')
+            sys.exit(1)
+
+    try:
+        out_file = sys.stdout if args.output == '-' else open(args.output, 'w')
+        with out_file:
+            stats = run_batch(chats, items, out_file, decoder, grammar, seed)
+    except OSError as e:
+        print_error(f'cannot write the output: {e}')
+        sys.exit(1)
+
+    print_batch_stats(stats)
+    if chats[0].response_cache is not None:
+        print(f'response cache: {chats[0].response_cache.hits} hits, {chats[0].response_cache.misses} misses', file=sys.stderr)
@@ -0,0 +1,689 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import hashlib
+import resource
+import tempfile
+import threading
+import statistics
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from llama_cpp import Llama
+from utils.ansi import AnsiCodes as AC
+from utils.async_chat import AsyncChat
+from utils.chat import Chat
+from utils.config import Config, ConfigError
+from utils.grammar import GrammarCache
+from utils.detokenizer import StreamingDetokenizer, TokenPieces
+from utils.html_cleaner import HTMLCleaner
+from utils.loader import create_chat, create_prompt_cache, disable_llama_logs, load_model
+from utils.parallel import ParallelDecoder, generate_replies
+from utils.speculative import create_draft_model
+from utils.web import WebFetcher
+
+
+ENV_FILE = '.env'
+ERROR_DN = f'{AC.FG_RED}{AC.BOLD}Error{AC.RESET}'
+INFO_DN = f'{AC.FG_GREEN}{AC.BOLD}Info{AC.RESET}'
+
+CODE_EDIT_SYSTEM = 'You are a helpful developer assistant, answer all the questions correctly and concisely.'
+CODE_EDIT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils', 'stop_matcher.py')
+CODE_EDIT_REQUEST = 'Refactor this code: rename `feed` to `push` everywhere and return the whole updated file.'
+
+LONG_SYSTEM_PARAGRAPH = (
+    'You are a senior software engineer working on a large Python code base. '
+    'Always explain your reasoning, point out possible bugs, suggest tests and keep the answers consistent with the existing style. '
+)
+LARGE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils', 'chat.py')
+LARGE_FILE_CHARS = 8000  # About 2000 tokens with common tokenizers
+
+PARALLEL_QUESTIONS = [
+    'What is a Python generator?', 'How do I reverse a list?', 'What does `git rebase` do?', 'Explain big-O notation.',
+    'What is a mutex?', 'How do I read a file in C?', 'What is a closure?', 'What is the difference between TCP and UDP?'
+]
+
+HTML_SECTION = (
+    '<div class="post" id="post-{i}" data-id="{i}"><!-- post {i} -->'
+    '<h2 class="title"><a href="/posts/{i}" title="Post {i}">How to profile a Python program, part {i}</a></h2>'
+    '<p class="meta" style="color: gray">Posted by <a href="/users/{i}">user{i}</a> on <time datetime="2024-01-01">January 1</time></p>'
+    '<p>Use   <code>cProfile</code> to find the slow functions,\n   then measure again after   each change &amp; keep the fastest version.</p>'
+    '<img src="/img/{i}.png" alt="chart {i}"><script>window.track({{"post": {i}}});</script>'
+    '<table><tr><th>Function</th><th>Time</th></tr><tr><td>parse</td><td>{i}ms</td></tr></table>'
+    '<svg width="10" height="10"><circle cx="5" cy="5" r="4"/></svg></div>\n'
+)
+HTML_SECTION_BYTES = len(HTML_SECTION.format(i=0))
+
+GRAMMAR_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'name': {'type': 'string'},
+        'language': {'type': 'string', 'enum': ['python', 'c', 'javascript', 'rust']},
+        'stars': {'type': 'integer'},
+        'topics': {'type': 'array', 'items': {'type': 'string'}, 'maxItems': 5},
+        'archived': {'type': 'boolean'}
+    },
+    'required': ['name', 'language', 'stars', 'topics', 'archived']
+}
+GRAMMAR_PROMPT = 'Describe a popular open source project as a JSON object with its name, language, stars, topics and whether it is archived.'
+
+MULTILINGUAL_TEXT = (
+    'Plain ASCII text with code: `for i in range(10): print(i)`. '
+    'Accents: naïve café, Ærøskøbing, São Paulo. Greek: αβγ. Cyrillic: привет мир. '
+    'CJK: 你好，世界！日本語のテキスト。한국어 문장. '
+    'Emoji: 👋🏽 🎉 👨‍👩‍👧 🇮🇹 and symbols €, ™, ∑, 𝔘𝔫𝔦𝔠𝔬𝔡𝔢.\n'
+)
+
+
+def print_error(msg: str) -> None:
+    print(f'{ERROR_DN}: {msg}')
+
+
+def code_edit_transcript() -> list[tuple[str, str]]:
+    """
+    Build a code-editing conversation: a source file injected in the prompt followed by a refactoring request
+
+    @return: the messages as (agent, content) tuples
+    """
+    with open(CODE_EDIT_FILE, 'r') as f:
+        code = f.read().strip()
+
+    return [
+        (Chat.SYSTEM_KEY, CODE_EDIT_SYSTEM),
+        (Chat.USER_KEY, f'{CODE_EDIT_REQUEST}\n\nContent of stop_matcher.py:\n```py\n{code}\n```')
+    ]
+
+
+def suite_scenarios() -> dict[str, list[tuple[str, str]]]:
+    """
+    Build the fixed conversations replayed by the benchmark suite
+
+    @return: the messages of each scenario as (agent, content) tuples
+    """
+    with open(LARGE_FILE, 'r') as f:
+        large_file = f.read(LARGE_FILE_CHARS).strip()
+
+    return {
+        'short_chat': [
+            (Chat.SYSTEM_KEY, CODE_EDIT_SYSTEM),
+            (Chat.USER_KEY, 'Hi! What is the difference between a list and a tuple in Python?')
+        ],
+        'long_system_prompt': [
+            (Chat.SYSTEM_KEY, LONG_SYSTEM_PARAGRAPH * 40),
+            (Chat.USER_KEY, 'How should I name a function that parses a config file?')
+        ],
+        'large_injected_file': [
+            (Chat.SYSTEM_KEY, CODE_EDIT_SYSTEM),
+            (Chat.USER_KEY, f'Can you explain this code please?\n\nContent of chat.py:\n```py\n{large_file}\n```')
+        ],
+        'max_length_generation': [
+            (Chat.SYSTEM_KEY, CODE_EDIT_SYSTEM),
+            (Chat.USER_KEY, 'Write a very long and detailed tutorial about Python generators, with many examples.')
+        ]
+    }
+
+
+def current_rss_mb() -> float:
+    """
+    Get the current resident memory of the process, from /proc where available
+    (elsewhere the peak of the process, which only grows, is the best approximation)
+
+    @return: the RSS in MB
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def percentile(values: list[float], p: float) -> float:
+    """
+    Get a percentile of a list of values
+
+    @param values: the values
+    @param p: the percentile (0-100)
+    @return: the percentile value (0 if there are no values)
+    """
+    if len(values) == 0:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+
+    return statistics.quantiles(values, n=100, method='inclusive')[min(98, max(0, int(p) - 1))]
+
+
+def measure_turn(chat: Chat, messages: list[tuple[str, str]]) -> dict:
+    """
+    Replay a conversation on an empty model and measure its last turn
+
+    @param chat: the chat used for the benchmark
+    @param messages: the messages as (agent, content) tuples
+    @return: the metrics of the turn
+    """
+    chat.reset_chat()
+    chat.model.reset()
+    for agent, content in messages:
+        chat.send_message(agent, content)
+
+    rss_before = current_rss_mb()
+    start_time = time.perf_counter()
+    n_prefill = chat.prefill()
+    prefill_time = time.perf_counter() - start_time
+
+    token_times = []
+    for _ in chat.stream_reply():
+        token_times.append(time.perf_counter())
+    end_time = time.perf_counter()
+    rss_after = current_rss_mb()
+
+    ttft = (token_times[0] if token_times else end_time) - start_time
+    latencies = [(b - a) * 1000 for a, b in zip(token_times, token_times[1:])]
+    decode_time = end_time - token_times[0] if token_times else 0.0
+
+    return {
+        'prompt_tokens': n_prefill,
+        'generated_tokens': len(token_times),
+        'ttft_s': ttft,
+        'prefill_tokens_per_s': n_prefill / prefill_time if prefill_time > 0 else 0.0,
+        'decode_tokens_per_s': (len(token_times) - 1) / decode_time if decode_time > 0 else 0.0,
+        'token_latency_p50_ms': percentile(latencies, 50),
+        'token_latency_p95_ms': percentile(latencies, 95),
+        'rss_mb': rss_after,
+        'rss_delta_mb': rss_after - rss_before
+    }
+
+
+def bench_suite(chat: Chat, repeat: int = 1) -> dict:
+    """
+    Replay the fixed conversations and report the metrics of each one (best run by TTFT)
+
+    @param chat: the chat used for the benchmark
+    @param repeat: how many times each scenario is replayed
+    @return: the results of the benchmark
+    """
+    results = {}
+    for name, messages in suite_scenarios().items():
+        runs = [measure_turn(chat, messages) for _ in range(repeat)]
+        results[name] = min(runs, key=lambda run: run['ttft_s'])
+        r = results[name]
+        print(
+            f'{INFO_DN}: {name}: ttft {r["ttft_s"] * 1000:.1f}ms, '
+            f'prefill {r["prefill_tokens_per_s"]:.1f} tokens/s ({r["prompt_tokens"]} tokens), '
+            f'decode {r["decode_tokens_per_s"]:.1f} tokens/s ({r["generated_tokens"]} tokens), '
+            f'latency p50 {r["token_latency_p50_ms"]:.2f}ms p95 {r["token_latency_p95_ms"]:.2f}ms, '
+            f'RSS {r["rss_mb"]:.0f}MB ({r["rss_delta_mb"]:+.1f}MB)'
+        )
+
+    return results
+
+
+def bench_parallel(config: Config, sequence_counts: list[int]) -> dict:
+    """
+    Compare the throughput of generating independent replies one after the other
+    and in the same batches with the parallel decoder
+
+    @param config: the settings
+    @param sequence_counts: the numbers of replies generated together
+    @return: the results of the benchmark
+    """
+    model = load_model(config, draft_model=None)
+    results = {}
+    for n_seq in sequence_counts:
+        questions = [PARALLEL_QUESTIONS[i % len(PARALLEL_QUESTIONS)] for i in range(n_seq)]
+        chats = []
+        for question in questions:
+            chat = create_chat(config, model, prompt_cache=None, context_policy=Chat.POLICY_EXIT)
+            chat.send_message(Chat.SYSTEM_KEY, CODE_EDIT_SYSTEM)
+            chat.send_message(Chat.USER_KEY, question)
+            chats.append(chat)
+
+        # Sequential: the shared system prompt stays evaluated, like in the batch mode
+        start_time = time.perf_counter()
+        n_sequential = 0
+        for chat in chats:
+            chat.prefill()
+            chat.generate_assistant_reply()
+            n_sequential += chat.content_length(chat.messages[-1])
+        sequential_time = time.perf_counter() - start_time
+
+        for chat in chats:
+            chat.messages.pop()
+            chat.cache_rebuild()
+        decoder = ParallelDecoder(model, n_seq, n_ctx=config.n_ctx * n_seq)
+        start_time = time.perf_counter()
+        generate_replies(decoder, chats, seed=config.seed)
+        parallel_time = time.perf_counter() - start_time
+        n_parallel = sum(chat.content_length(chat.messages[-1]) for chat in chats)
+        del decoder
+
+        results[n_seq] = {
+            'sequential_tokens_per_s': n_sequential / sequential_time if sequential_time > 0 else 0.0,
+            'parallel_tokens_per_s': n_parallel / parallel_time if parallel_time > 0 else 0.0
+        }
+        r = results[n_seq]
+        print(f'{INFO_DN}: {n_seq} sequences: sequential {r["sequential_tokens_per_s"]:.1f} tokens/s, parallel {r["parallel_tokens_per_s"]:.1f} tokens/s')
+
+    return results
+
+
+def time_reply(chat: Chat, messages: list[tuple[str, str]]) -> dict:
+    """
+    Send the messages, evaluate them and time the generation of the reply
+
+    @param chat: the chat used for the benchmark
+    @param messages: the messages as (agent, content) tuples
+    @return: the reply and its timings
+    """
+    for agent, content in messages:
+        chat.send_message(agent, content)
+    chat.prefill()
+
+    n_tokens = 0
+    start_time = time.perf_counter()
+    for _ in chat.stream_reply():
+        n_tokens += 1
+    elapsed = time.perf_counter() - start_time
+
+    return {
+        'reply': chat.messages[-1].content,
+        'tokens': n_tokens,
+        'seconds': elapsed,
+        'tokens_per_s': n_tokens / elapsed if elapsed > 0 else 0.0
+    }
+
+
+def bench_speculative(config: Config, draft_mode: str) -> dict:
+    """
+    Compare the decoding speed with and without speculative decoding on a code-editing transcript.
+    Sampling is greedy, so the two replies must be identical.
+
+    @param config: the settings
+    @param draft_mode: the drafting mode to compare against plain decoding (lookup or model)
+    @return: the results of the benchmark
+    """
+    messages = code_edit_transcript()
+    results = {}
+    for mode in ('none', draft_mode):
+        draft_model = create_draft_model(mode, config.draft_tokens, config.draft_model_path, config.n_ctx, config.use_gpu)
+        model = load_model(config, draft_model=draft_model)
+        chat = create_chat(config, model, temperature=0.0, prompt_cache=None, context_policy=Chat.POLICY_EXIT)
+        results[mode] = time_reply(chat, messages)
+        print(f'{INFO_DN}: draft={mode}: {results[mode]["tokens"]} tokens in {results[mode]["seconds"]:.2f}s ({results[mode]["tokens_per_s"]:.2f} tokens/s)')
+        del chat, model
+
+    speedup = results[draft_mode]['tokens_per_s'] / results['none']['tokens_per_s'] if results['none']['tokens_per_s'] > 0 else 0.0
+    identical = results[draft_mode]['reply'] == results['none']['reply']
+    print(f'{INFO_DN}: speedup x{speedup:.2f}, identical output: {identical}')
+
+    return {'runs': results, 'speedup': speedup, 'identical': identical}
+
+
+def bench_startup(config: Config, repeat: int = 1) -> dict:
+    """
+    Measure the startup of a chat (loading the model and evaluating the system prompt and the initial message)
+    with an empty prompt cache and again with the cache filled by the first start, like a restart of LlamaTerm
+
+    @param config: the settings
+    @param repeat: start N times in each mode and keep the best run
+    @return: the results of the benchmark
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for run in ('cold', 'warm'):
+            best = None
+            for i in range(repeat):
+                run_dir = os.path.join(cache_dir, f'{run}-{i}' if run == 'cold' else 'cold-0')  # The warm runs reuse the first cache
+                start_time = time.perf_counter()
+                model = load_model(config)
+                load_time = time.perf_counter() - start_time
+                chat = create_chat(config, model, prompt_cache=create_prompt_cache(config, run_dir))
+                if config.supports_system_agent():
+                    chat.send_message(Chat.SYSTEM_KEY, config.system_prompt)
+                if config.assistant_initial_message:
+                    chat.send_message(Chat.ASSISTANT_KEY, config.assistant_initial_message)
+                n_evaluated = chat.prefill()
+                total_time = time.perf_counter() - start_time
+                del chat, model
+
+                if best is None or total_time < best['seconds']:
+                    best = {'seconds': total_time, 'load_seconds': load_time, 'prompt_seconds': total_time - load_time, 'evaluated_tokens': n_evaluated}
+            results[run] = best
+            print(
+                f'{INFO_DN}: {run} start: {best["seconds"]:.2f}s (model {best["load_seconds"]:.2f}s, '
+                f'prompt {best["prompt_seconds"] * 1000:.1f}ms, {best["evaluated_tokens"]} tokens evaluated)'
+            )
+
+    speedup = results['cold']['prompt_seconds'] / results['warm']['prompt_seconds'] if results['warm']['prompt_seconds'] > 0 else 0.0
+    print(f'{INFO_DN}: prompt ready x{speedup:.2f} faster with a warm cache')
+    results['prompt_speedup'] = speedup
+
+    return results
+
+
+def bench_grammar(config: Config, repeat: int = 3) -> dict:
+    """
+    Compare the generation throughput with and without a grammar built from a fixed JSON schema,
+    and the time to get the grammar when it is compiled and when it comes from the grammar cache
+
+    @param config: the settings
+    @param repeat: the number of replies generated in each mode
+    @return: the results of the benchmark
+    """
+    model = load_model(config)
+    cache = GrammarCache(model)
+    start_time = time.perf_counter()
+    grammar = cache.from_json_schema(GRAMMAR_SCHEMA)
+    compile_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    for _ in range(100):
+        cache.from_json_schema(GRAMMAR_SCHEMA)
+    cached_seconds = (time.perf_counter() - start_time) / 100
+    print(f'{INFO_DN}: grammar compiled in {compile_seconds * 1000:.2f}ms, from the cache in {cached_seconds * 1000:.3f}ms')
+
+    results = {'compile_ms': compile_seconds * 1000, 'cached_ms': cached_seconds * 1000}
+    chat = create_chat(config, model, temperature=0.0, prompt_cache=None, context_policy=Chat.POLICY_EXIT)
+    for mode, mode_grammar in (('free', None), ('grammar', grammar)):
+        n_tokens = 0
+        seconds = 0.0
+        n_valid = 0
+        for _ in range(repeat):
+            chat.reset_chat()
+            chat.send_message(Chat.USER_KEY, GRAMMAR_PROMPT)
+            chat.prefill()
+            start_time = time.perf_counter()
+            reply, _ = chat.generate_assistant_reply(grammar=mode_grammar)
+            seconds += time.perf_counter() - start_time
+            n_tokens += chat.content_length(chat.messages[-1])
+            try:
+                n_valid += isinstance(json.loads(reply), dict)
+            except ValueError:
+                pass
+        results[mode] = {'tokens': n_tokens, 'seconds': seconds, 'tokens_per_s': n_tokens / seconds if seconds > 0 else 0.0, 'valid_json': n_valid}
+        print(f'{INFO_DN}: {mode}: {n_tokens} tokens in {seconds:.2f}s ({results[mode]["tokens_per_s"]:.2f} tokens/s), {n_valid}/{repeat} replies are JSON objects')
+
+    return results
+
+
+async def measure_loop_lag(work) -> tuple[object, float]:
+    """
+    Run a coroutine while a ticker measures how late the event loop wakes it up
+
+    @param work: the coroutine
+    @return: what the coroutine returned and the worst lag of the event loop in seconds
+    """
+    max_lag = 0.0
+    done = False
+
+    async def ticker() -> None:
+        nonlocal max_lag
+        while not done:
+            start_time = time.perf_counter()
+            await asyncio.sleep(0.001)
+            max_lag = max(max_lag, time.perf_counter() - start_time - 0.001)
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    try:
+        result = await work
+    finally:
+        done = True
+        await ticker_task
+
+    return result, max_lag
+
+
+async def run_async_bench(create: Callable[[], Chat], n_turns: int) -> dict:
+    """
+    Measure the async chat: event loop lag compared to the blocking chat and the time of the turns of concurrent coroutines
+
+    @param create: the function that creates a new chat
+    @param n_turns: the number of concurrent turns
+    @return: the results of the benchmark
+    """
+    results = {}
+
+    async def blocking_reply() -> str:  # What an asyncio service would do without the async chat
+        chat = create()
+        chat.send_message(Chat.USER_KEY, 'Hello!')
+        return chat.generate_assistant_reply()[0]
+
+    async_chat = AsyncChat(create())
+    _, blocking_lag = await measure_loop_lag(blocking_reply())
+    _, async_lag = await measure_loop_lag(async_chat.reply('Hello!'))
+    results['loop_lag_ms'] = {'blocking': blocking_lag * 1000, 'async': async_lag * 1000}
+    print(f'{INFO_DN}: worst event loop lag during a reply: {blocking_lag * 1000:.1f}ms blocking, {async_lag * 1000:.1f}ms async')
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[async_chat.reply(f'Question {i}?') for i in range(n_turns)])
+    seconds = time.perf_counter() - start_time
+    results['concurrent'] = {'turns': n_turns, 'seconds': seconds}
+    print(f'{INFO_DN}: {n_turns} concurrent turns in {seconds:.2f}s')
+
+    await async_chat.close()
+    return results
+
+
+def bench_async(create: Callable[[], Chat], n_turns: int) -> dict:
+    """
+    Measure the event loop lag and the concurrent turns of the async chat
+
+    @param create: the function that creates a new chat
+    @param n_turns: the number of concurrent turns
+    @return: the results of the benchmark
+    """
+    return asyncio.run(run_async_bench(create, n_turns))
+
+
+def bench_detokenize(model: Llama, repeat: int = 1) -> dict:
+    """
+    Measure the per-token overhead of detokenizing generated text one token at a time: a separate
+    decode of each token against the streaming detokenizer with its cache of token pieces
+
+    @param model: the model whose tokenizer is used
+    @param repeat: replay the tokens N times and keep the best run
+    @return: the results of the benchmark
+    """
+    text = MULTILINGUAL_TEXT * 64
+    tokens = model.tokenize(text.encode('UTF-8'), add_bos=False, special=False)
+
+    def separate() -> str:
+        return ''.join([model.detokenize([token], special=True).decode(Chat.CHARSET, errors='ignore') for token in tokens])
+
+    pieces = TokenPieces(model)
+
+    def streaming() -> str:
+        detokenizer = StreamingDetokenizer(pieces, Chat.CHARSET)
+        return ''.join([detokenizer.feed(token) for token in tokens]) + detokenizer.flush()
+
+    results = {'tokens': len(tokens)}
+    for name, function in (('separate', separate), ('streaming', streaming)):
+        seconds = float('inf')
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            function()
+            seconds = min(seconds, time.perf_counter() - start_time)
+        results[name] = {'ns_per_token': seconds / len(tokens) * 1e9}
+        print(f'{INFO_DN}: {name}: {results[name]["ns_per_token"]:.0f}ns per token')
+
+    return results
+
+
+def html_fixture(size: int, seed: int = 0) -> str:
+    """
+    Build a web page of about the given size, full of what the cleaner removes (scripts, styles, media, comments, attributes, links)
+
+    @param size: the approximate size of the page in bytes
+    @param seed: the number of the page, so that every page is different
+    @return: the HTML of the page
+    """
+    sections = ''.join(HTML_SECTION.format(i=seed * 100000 + i) for i in range(max(size // HTML_SECTION_BYTES, 1)))
+    return (
+        f'<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><title>Page {seed}</title>'
+        '<style>body { font-family: sans-serif } .post { margin: 1em }</style><script src="/app.js"></script></head>'
+        f'<body><nav><ul><li><a href="/">Home</a></li><li><a href="/about">About</a></li></ul></nav><main>{sections}</main>'
+        '<footer><p>Footer</p><noscript>Enable JavaScript</noscript></footer></body></html>'
+    )
+
+
+def serve_pages(pages: list[str], latency: float = 0.0) -> ThreadingHTTPServer:
+    """
+    Serve pages from a local HTTP server on a background thread, at `/<index>`, with an ETag and a Last-Modified
+    header (a request with a matching If-None-Match gets 304)
+
+    @param pages: the HTML of the pages
+    @param latency: the seconds waited before each response, like a remote server
+    @return: the running server
+    """
+    bodies = [page.encode('UTF-8') for page in pages]
+    etags = [f'"{hashlib.sha256(body).hexdigest()[:16]}"' for body in bodies]
+
+    class PageHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Keep-alive, so that the fetcher can reuse its connections
+
+        def do_GET(self) -> None:
+            time.sleep(latency)
+            try:
+                index = int(self.path.strip('/'))
+                body, etag = bodies[index], etags[index]
+            except (ValueError, IndexError):
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', 'Mon, 01 Jan 2024 00:00:00 GMT')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PageHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_html(n_pages: int, page_kb: int, latency: float, repeat: int = 1) -> dict:
+    """
+    Measure the HTML cleaning throughput and the fetching of several pages from a local HTTP server:
+    one at a time, all at the same time, and again from the cache (the server answers 304)
+
+    @param n_pages: the number of pages
+    @param page_kb: the approximate size of each page in KB
+    @param latency: the seconds the local server waits before each response
+    @param repeat: clean the pages N times and keep the best run
+    @return: the results of the benchmark
+    """
+    pages = [html_fixture(page_kb * 1024, seed) for seed in range(n_pages)]
+    total_mb = sum(len(page) for page in pages) / (1024 * 1024)
+
+    clean_seconds = float('inf')
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        cleaned = [HTMLCleaner.clean_html(page) for page in pages]
+        clean_seconds = min(clean_seconds, time.perf_counter() - start_time)
+    cleaned_mb = sum(len(page) for page in cleaned) / (1024 * 1024)
+    leftovers = sum(page.count(marker) for page in cleaned for marker in ('<script', '<!--', 'href=', 'style=', '<svg'))
+    print(f'{INFO_DN}: cleaned {total_mb:.1f} MB in {clean_seconds:.2f}s ({total_mb / clean_seconds:.2f} MB/s), {cleaned_mb:.1f} MB left, {leftovers} leftover tags/attributes')
+
+    server = serve_pages(pages, latency)
+    urls = [f'http://127.0.0.1:{server.server_address[1]}/{i}' for i in range(n_pages)]
+    results = {
+        'pages': n_pages, 'mb': total_mb, 'clean_seconds': clean_seconds, 'clean_mb_per_s': total_mb / clean_seconds,
+        'cleaned_mb': cleaned_mb, 'leftovers': leftovers
+    }
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for name, n_workers in (('sequential', 1), ('concurrent', min(n_pages, 8))):
+                fetcher = WebFetcher(cache_dir=os.path.join(cache_dir, name), n_workers=n_workers)
+                for run in ('cold', 'cached'):
+                    start_time = time.perf_counter()
+                    fetched = fetcher.fetch_many(urls)
+                    seconds = time.perf_counter() - start_time
+                    errors = [page for page in fetched if isinstance(page, Exception)]
+                    if errors:
+                        raise RuntimeError(f'fetch failed: {errors[0]}')
+                    results[f'{name}_{run}_seconds'] = seconds
+                    print(f'{INFO_DN}: {name} fetch ({run}): {n_pages} pages in {seconds:.2f}s ({fetcher.hits} not modified)')
+                fetcher.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return results
+
+
+if __name__ == '__main__':
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument('--json', metavar='FILE', help='write the results to a JSON file')
+    parser = argparse.ArgumentParser(description='LlamaTerm inference benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    suite_parser = subparsers.add_parser('suite', parents=[common_parser], help='measure TTFT, prefill/decode throughput, latency and memory on fixed chats')
+    suite_parser.add_argument('--repeat', type=int, default=1, help='replay each scenario N times and keep the best run')
+    speculative_parser = subparsers.add_parser('speculative', parents=[common_parser], help='compare decoding with and without speculative decoding')
+    speculative_parser.add_argument('--draft', choices=('lookup', 'model'), default='lookup', help='the drafting mode to compare')
+    parallel_parser = subparsers.add_parser('parallel', parents=[common_parser], help='compare sequential and parallel decoding of independent replies')
+    parallel_parser.add_argument('--sequences', type=int, nargs='+', default=[1, 4, 8], help='the numbers of replies generated together')
+    async_parser = subparsers.add_parser('async', parents=[common_parser], help='measure the event loop lag and the concurrent turns of the async chat')
+    async_parser.add_argument('--turns', type=int, default=4, help='the number of concurrent turns')
+    grammar_parser = subparsers.add_parser('grammar', parents=[common_parser], help='compare the generation throughput with and without a JSON schema grammar')
+    grammar_parser.add_argument('--repeat', type=int, default=3, help='the number of replies generated in each mode')
+    detokenize_parser = subparsers.add_parser('detokenize', parents=[common_parser], help='measure the per-token overhead of detokenizing the generated text')
+    detokenize_parser.add_argument('--repeat', type=int, default=5, help='replay the tokens N times and keep the best run')
+    startup_parser = subparsers.add_parser('startup', parents=[common_parser], help='compare the startup with an empty and a warm prompt cache')
+    startup_parser.add_argument('--repeat', type=int, default=1, help='start N times in each mode and keep the best run')
+    html_parser = subparsers.add_parser('html', parents=[common_parser], help='measure HTML cleaning and fetching web pages from a local server (no model needed)')
+    html_parser.add_argument('--pages', type=int, default=8, help='the number of pages')
+    html_parser.add_argument('--page-kb', type=int, default=1024, help='the approximate size of each page in KB')
+    html_parser.add_argument('--latency', type=float, default=0.2, help='the seconds the local server waits before each response')
+    html_parser.add_argument('--repeat', type=int, default=1, help='clean the pages N times and keep the best run')
+    args = parser.parse_args()
+
+    if args.benchmark == 'html':
+        results = bench_html(args.pages, args.page_kb, args.latency, args.repeat)
+    else:
+        try:
+            config = Config(ENV_FILE)
+        except ConfigError as e:
+            print_error(str(e))
+            sys.exit(1)
+        disable_llama_logs()
+
+        try:
+            if args.benchmark == 'suite':
+                model = load_model(config)
+                results = bench_suite(create_chat(config, model, prompt_cache=None, context_policy=Chat.POLICY_EXIT), args.repeat)
+            elif args.benchmark == 'async':
+                model = load_model(config)
+                results = bench_async(lambda: create_chat(config, model, prompt_cache=None, context_policy=Chat.POLICY_SLIDE), args.turns)
+            elif args.benchmark == 'grammar':
+                results = bench_grammar(config, args.repeat)
+            elif args.benchmark == 'detokenize':
+                results = bench_detokenize(load_model(config), args.repeat)
+            elif args.benchmark == 'parallel':
+                results = bench_parallel(config, args.sequences)
+            elif args.benchmark == 'startup':
+                results = bench_startup(config, args.repeat)
+            else:
+                results = bench_speculative(config, args.draft)
+        except ValueError as e:
+            print_error(f'cannot load the model: {e}')
+            sys.exit(1)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -1,224 +1,442 @@
+import time
+STARTUP_TIME = time.perf_counter()
+
 import os
 import sys
-import re
 import pathlib
-import pygments
-import ctypes
-from pygments.lexers.markup import MarkdownLexer
-from pygments.formatters import Terminal256Formatter
-from dotenv import load_dotenv
-from llama_cpp import Llama, llama_log_set
+import argparse
+from typing import TYPE_CHECKING
 from utils.ansi import AnsiCodes as AC
-from utils.chat import Chat
+from utils.config import Config, ConfigError
+from utils.files import FileCache, expand_path_pattern, find_path_patterns, remove_path_patterns
+from utils.instrumentation import Instrumentation
+from utils.output import create_writer
+from utils.retrieval import Retriever
+from utils.startup import BackgroundTask, StartupProfile
+
+# llama_cpp and pygments take most of the startup time: they are imported by the model loader in the background and when needed
+if TYPE_CHECKING:
+    from utils.chat import Chat
+    from utils.sessions import SessionManager
+    from utils.web import WebFetcher
+    from utils.grammar import GrammarCache
+    from llama_cpp import LlamaGrammar
+
+profile = StartupProfile(STARTUP_TIME)
+profile.mark('imports')
 
 
 COMMAND_EXIT = 'exit'
 COMMAND_RESTART = 'restart'
+COMMAND_SAVE = '/save'
+COMMAND_LOAD = '/load'
+COMMAND_STATS = 'stats'
+COMMAND_SESSION = 'session'
+COMMAND_TUNE = 'tune'
+COMMAND_JSON = '/json'
 
 DEBUG = False
 ENV_FILE = '.env'
+SESSION_FILE = 'session.llamaterm'
+DEFAULT_SESSION = 'main'
+TUNE_FILE = 'tune.env'
 ERROR_DN = f'{AC.FG_RED}{AC.BOLD}Error{AC.RESET}'
 
-# Disable llama.cpp verbose output
-if not DEBUG:
-    def my_log_callback(level, message, user_data): pass
-    log_callback = ctypes.CFUNCTYPE(None, ctypes.c_int, ctypes.c_char_p, ctypes.c_void_p)(my_log_callback)
-    llama_log_set(log_callback, ctypes.c_void_p())
-
 def print_error(msg: str) -> None:
     print(f'{ERROR_DN}: {msg}')
 
-def get_env_and_check(key: str, required: bool = True) -> str:
-    value = os.getenv(key)
-    if value is None:
-        if required:
-            print_error(f'missing .env field \'{key}\'')
-            exit(1)
-        return ''
-    
-    return str(value)
-
-# Check if .env exists and load it
-if os.path.isfile(ENV_FILE):
-    load_dotenv(ENV_FILE)
-else:
-    print_error('cannot read .env file.')
-    exit(1)
-
-# Load .env variables
-MODEL_PATH =                get_env_and_check('MODEL_PATH')
-BOT =                       get_env_and_check('BOT')
-PREFIX_TEMPLATE =           get_env_and_check('PREFIX_TEMPLATE')
-EOS =                       get_env_and_check('EOS')
-AGENT_SYSTEM =              get_env_and_check('AGENT_SYSTEM', required=False)
-AGENT_USER =                get_env_and_check('AGENT_USER')
-AGENT_ASSISTANT =           get_env_and_check('AGENT_ASSISTANT')
-SYSTEM_PROMPT =             get_env_and_check('SYSTEM_PROMPT', required=False)
-ASSISTANT_INITIAL_MESSAGE = get_env_and_check('ASSISTANT_INITIAL_MESSAGE', required=False)
-REAL_TIME =                 bool(int(get_env_and_check('REAL_TIME')))
-N_CTX =                     int(get_env_and_check('N_CTX'))
-N_GENERATE =                int(get_env_and_check('N_GENERATE'))
-TEMPERATURE =               float(get_env_and_check('TEMPERATURE'))
-TOP_P =                     float(get_env_and_check('TOP_P'))
-TOP_K =                     int(get_env_and_check('TOP_K'))
-SEED =                      int(get_env_and_check('SEED'))
-USE_MMAP =                  bool(int(get_env_and_check('USE_MMAP')))
-USE_MLOCK =                 bool(int(get_env_and_check('USE_MLOCK')))
-USE_GPU =                   bool(int(get_env_and_check('USE_GPU')))
-
 SYSTEM_DN =                 f'{AC.FG_CYAN}{AC.BOLD}System{AC.RESET}'
 USER_DN =                   f'{AC.FG_RED}{AC.BOLD}User{AC.RESET}'
 ASSISTANT_DN =              f'{AC.FG_YELLOW}{AC.BOLD}Assistant{AC.RESET}'
 INFO_DN =                   f'{AC.FG_GREEN}{AC.BOLD}Info{AC.RESET}'
 
-BEGIN_USER =                PREFIX_TEMPLATE.replace('{agent}', AGENT_USER)
-BEGIN_ASSISTANT =           PREFIX_TEMPLATE.replace('{agent}', AGENT_ASSISTANT)
-BEGIN_SYSTEM =              PREFIX_TEMPLATE.replace('{agent}', AGENT_SYSTEM)
-WORKING_DIR =               sys.argv[1] if len(sys.argv) == 2 else os.getcwd()
-CONTEXT_WARNING =           min(500, N_GENERATE)
-
-
-def supports_system_agent() -> bool:
-    return (
-        (SYSTEM_PROMPT != None) and
-        (AGENT_SYSTEM != None) and
-        (SYSTEM_PROMPT != "None") and
-        (AGENT_SYSTEM != "None") and
-        (SYSTEM_PROMPT != "") and
-        (AGENT_SYSTEM != "")
-    )
+WORKING_DIR =               os.getcwd()
 
+file_cache = FileCache()
+web_fetcher: 'WebFetcher | None' = None  # Created when the first web page is injected
+grammar_cache: 'GrammarCache | None' = None  # Created by the first `/json` command
+reply_grammar: 'LlamaGrammar | None' = None  # The grammar that constrains the replies, set with `/json`
 
-def format_text(text: str) -> str:
-    lexer = MarkdownLexer()
-    formatter = Terminal256Formatter(bg='dark')
 
-    return pygments.highlight(text, lexer, formatter)
+def prefill_prompt(chat: 'Chat') -> None:
+    start_time = time.perf_counter()
+    n_evaluated = chat.prefill()
+    if DEBUG: print(f'{INFO_DN}: prompt ready in {time.perf_counter() - start_time:.2f}s ({n_evaluated}/{chat.tokens_used()} tokens evaluated)')
 
 
-def inject_file(text: str) -> str:  # TODO Check if path is absolute. If so, don't append the working dir
-    match_filename = r'\[(([^\[\]])+\.(\w|\d){1,10})\]'
-    pattern = re.compile(match_filename)
-    filepaths: list[str] = [p[0] for p in pattern.findall(text)]
-    if DEBUG: print(f'{INFO_DN}: filepaths detected in prompt: {str(filepaths)}')
+def print_prompt() -> None:
+    # Perform checks for optional env variables
+    if config.supports_system_agent():
+        print(f'{SYSTEM_DN}: {config.system_prompt}')
+    if assistant_message_present():
+        print(f'{ASSISTANT_DN}: {config.assistant_initial_message}')
 
-    new_text = text
-    for file_path in filepaths:
-        file_full_path = file_path
-        if not os.path.isabs(file_path):
-            file_full_path = os.path.join(WORKING_DIR, file_path)
-        if DEBUG: print(f'{INFO_DN}: full path is "{file_full_path}"')
 
-        if not os.path.isfile(file_full_path):
-            print(f'{ERROR_DN}: faled injecting: "{file_path}" does not exist.')
-            new_text += f'\n\nFile "{file_path}" does not exist.'
-            continue
+def assistant_message_present() -> bool:
+    return config.assistant_initial_message == None or config.assistant_initial_message == ''
+
 
-        print(f'{INFO_DN}: injecting "{file_path}" into the context.')
-        to_inject = file_to_markdown(file_full_path)
-        new_text += '\n\n' + to_inject
+def start_chat(chat: 'Chat') -> None:
+    if config.supports_system_agent():
+        chat.send_message(agent=chat.SYSTEM_KEY, content=config.system_prompt)
+    if assistant_message_present():
+        chat.send_message(agent=chat.ASSISTANT_KEY, content=config.assistant_initial_message)
 
-    return new_text
+    prefill_prompt(chat)
 
 
-def file_to_markdown(file_path: str) -> str:
-    path_split = os.path.splitext(file_path)
-    file_ext = os.path.splitext(file_path)[1][1:]
-    file_name = path_split[0].split(os.sep)[-1] + '.' + file_ext
+def load_chat() -> tuple['SessionManager', Retriever | None]:
+    """
+    Load the model and evaluate the prompt of the first chat, while the user types the first message
+
+    @return: the session manager with the first chat and the retriever of the injected files
+    @raises ValueError: if the model cannot be loaded
+    """
+    from utils.loader import create_chat, disable_llama_logs, load_model
+    from utils.sessions import SessionManager
+    profile.mark('llama_cpp imported')
+
+    # Disable llama.cpp verbose output
+    if not DEBUG:
+        disable_llama_logs()
+    llama = load_model(config, verbose=DEBUG)
+    profile.mark('model loaded')
+
+    chat = create_chat(config, llama, debug=DEBUG)
+    # The sessions share the prompt cache and the stats
+    shared = dict(prompt_cache=chat.prompt_cache, response_cache=chat.response_cache, instrumentation=chat.instrumentation)
+    sessions = SessionManager(
+        lambda: create_chat(config, llama, debug=DEBUG, **shared),
+        ram_budget=config.session_ram_budget * 1024 * 1024,
+        spill_dir=config.session_dir or None
+    )
+    sessions.new(DEFAULT_SESSION, chat)
+
+    retriever = None
+    if config.inject_mode == 'retrieve':
+        retriever = Retriever(
+            count_tokens=lambda text: len(llama.tokenize(text.encode('UTF-8'), add_bos=False, special=False)),
+            tokenizer_id=os.path.basename(config.model_path),
+            cache_dir=config.retrieval_cache_dir or None
+        )
+    start_chat(chat)
+    profile.mark('prompt evaluated')
+
+    return sessions, retriever
+
+
+def run_sessions_command(sessions: 'SessionManager', text: str) -> bool:
+    """
+    Run a `session new|switch <name>` or `session list` command
+
+    @param sessions: the session manager
+    @param text: the text typed by the user
+    @return: whether the text was a sessions command
+    """
+    words = text.split()
+    if words[0] != COMMAND_SESSION or words[1:] != ['list'] and (len(words) != 3 or words[1] not in ('new', 'switch')):
+        return False
+
+    if words[1] == 'list':
+        for name, session_chat, location in sessions.list():
+            print(f'{INFO_DN}: {"*" if location == "active" else " "} {name}: {len(session_chat.messages)} messages, {session_chat.tokens_used()} tokens ({location})')
+    elif words[1] == 'new':
+        try:
+            chat = sessions.new(words[2])
+            print_prompt()
+            start_chat(chat)
+            print(f'{INFO_DN}: session "{words[2]}" created')
+        except ValueError as e:
+            print_error(str(e))
+    else:
+        try:
+            sessions.switch(words[2])
+            print(f'{INFO_DN}: switched to session "{words[2]}" ({len(sessions.chat.messages)} messages)')
+        except (OSError, ValueError, RuntimeError) as e:
+            print_error(f'session switch failed: {e}')
+
+    return True
+
+
+def run_json_command(chat: 'Chat', text: str) -> bool:
+    """
+    Run a `/json <schema-file>` command: the next replies are JSON values that follow the schema
+    (or follow the grammar of a `.gbnf` file), until `/json off`
+
+    @param chat: the chat whose model checks the grammar
+    @param text: the text typed by the user
+    @return: whether the text was a json command
+    """
+    global grammar_cache, reply_grammar
+    words = text.split(maxsplit=1)
+    if words[0] != COMMAND_JSON:
+        return False
+
+    if len(words) == 1:
+        print(f'{INFO_DN}: usage: {COMMAND_JSON} <schema-file> or {COMMAND_JSON} off')
+    elif words[1] == 'off':
+        reply_grammar = None
+        print(f'{INFO_DN}: the replies are free text again')
+    else:
+        from utils.grammar import GrammarCache
+        if grammar_cache is None:
+            grammar_cache = GrammarCache(chat.model)
+        try:
+            reply_grammar = grammar_cache.from_file(os.path.join(WORKING_DIR, words[1]))
+            print(f'{INFO_DN}: the replies follow "{words[1]}", type `{COMMAND_JSON} off` to stop')
+        except (OSError, ValueError) as e:
+            print_error(f'cannot use "{words[1]}": {e}')
+
+    return True
+
+
+def run_tune(chat: 'Chat') -> None:
+    """
+    Benchmark prefill and decode with different performance settings on the loaded model
+    and write the fastest ones to `TUNE_FILE`, next to the .env, as a .env snippet
+    """
+    from utils.tuner import Tuner, TuneSettings
+
+    model = chat.model
+    settings = TuneSettings(
+        n_threads=model.n_threads,
+        n_threads_batch=model.n_threads_batch,
+        n_batch=config.n_batch,
+        n_ubatch=config.n_ubatch,
+        flash_attn=config.flash_attn,
+        type_k=config.type_k,
+        type_v=config.type_v
+    )
+    tuner = Tuner(model, n_prompt=min(512, config.n_ctx // 2))
+    print(f'{INFO_DN}: tuning, it may take a few minutes')
+
+    def print_candidate(candidate: TuneSettings, prefill_speed: float, decode_speed: float) -> None:
+        print(f'{INFO_DN}: {candidate}: prefill {prefill_speed:.1f} tokens/s, decode {decode_speed:.1f} tokens/s')
+
+    try:
+        best, prefill_speed, decode_speed = tuner.tune(settings, callback=print_candidate)
+    except ValueError as e:
+        print_error(f'tuning failed: {e}')
+        return
 
-    text = 'FORMAT-ERROR: The content is not valid text'
+    snippet = f'# Recommended by the tune command: prefill {prefill_speed:.1f} tokens/s, decode {decode_speed:.1f} tokens/s\n{best.to_env()}\n'
+    tune_path = os.path.join(os.path.dirname(os.path.abspath(ENV_FILE)), TUNE_FILE)  # Not in the directory of the user files
     try:
-        f = open(file_path, 'r')
-        text = f.read().strip()
-    except UnicodeError:
-        print_error('not a valid text file')
+        with open(tune_path, 'w') as f:
+            f.write(snippet)
+    except OSError as e:
+        print_error(f'cannot write "{tune_path}": {e}')
+    print(snippet, end='')
+    print(f'{INFO_DN}: copy these settings from "{tune_path}" to the .env and restart to use them')
+
+
+def parse_session_command(text: str) -> tuple[str, str] | None:
+    words = text.split()
+    if len(words) > 2 or words[0] not in (COMMAND_SAVE, COMMAND_LOAD):
+        return None
+
+    file_path = words[1] if len(words) == 2 else SESSION_FILE
+    if not os.path.isabs(file_path):
+        file_path = os.path.join(WORKING_DIR, file_path)
+
+    return words[0], file_path
 
-    md = f'Content of {file_name}:\n```{file_ext}\n{text}\n```'
-    if DEBUG: print(f'{INFO_DN}: file markdown: {md}')
 
-    return md
+def format_text(text: str) -> str:
+    from utils.highlighter import highlight_markdown
+    return highlight_markdown(text)
+
+
+def fetch_pages(urls: list[str]) -> tuple[list[str], list[str]]:
+    """
+    Fetch and clean the web pages of a message, all at the same time
+
+    @param urls: the URLs of the pages
+    @return: the markdown blocks of the fetched pages and the notes about the ones that failed
+    """
+    global web_fetcher
+    from utils.web import WebFetcher, page_to_markdown  # requests is imported only when a page is injected
+    if web_fetcher is None:
+        web_fetcher = WebFetcher(cache_dir=config.web_cache_dir or None)
+
+    blocks: list[str] = []
+    notes: list[str] = []
+    for url, page in zip(urls, web_fetcher.fetch_many(urls)):
+        if isinstance(page, Exception):
+            print_error(f'failed injecting "{url}": {page}')
+            notes.append(f'Web page "{url}" could not be fetched.')
+            continue
+        print(f'{INFO_DN}: injecting "{url}" into the context ({page.reduction:.0f}% smaller after cleaning).')
+        blocks.append(page_to_markdown(url, page.cleaned_html))
+
+    return blocks, notes
+
+
+def inject_file(text: str, retriever: Retriever | None = None) -> str:
+    """
+    Append the files, directories (`[src/]`), globs (`[src/**/*.py]`) and web pages (`[https://example.com]`)
+    in square brackets to the message
+
+    @param text: the text of the message
+    @param retriever: the retriever that selects the relevant chunks of the files, if any
+    @return: the new text
+    """
+    targets = find_path_patterns(text)
+    urls: list[str] = []
+    if '://' in text:
+        from utils.web import find_urls
+        urls = find_urls(text)
+    if DEBUG: print(f'{INFO_DN}: filepaths detected in prompt: {str(targets)}, urls: {str(urls)}')
+    if len(targets) == 0 and len(urls) == 0:
+        return text
+
+    files: list[tuple[str, str]] = []  # Path and name shown to the model
+    missing: list[str] = []
+    for target in targets:
+        file_paths = expand_path_pattern(target, WORKING_DIR)
+        if len(file_paths) == 0:
+            print(f'{ERROR_DN}: faled injecting: "{target}" does not exist.')
+            missing.append(target)
+            continue
+        print(f'{INFO_DN}: injecting {len(file_paths)} files from "{target}" into the context.' if len(file_paths) > 1 else f'{INFO_DN}: injecting "{target}" into the context.')
+        for file_path in file_paths:
+            name = os.path.relpath(file_path, WORKING_DIR) if len(file_paths) > 1 else os.path.basename(file_path)
+            if (file_path, name) not in files:
+                files.append((file_path, name))
+
+    if retriever is not None:
+        query = remove_path_patterns(text)  # The relevant chunks are the ones about the rest of the message
+        if len(urls) > 0:
+            from utils.web import remove_urls
+            query = remove_urls(query)
+        budget = config.inject_budget // max(len(files), 1)
+        blocks = [retriever.file_to_markdown(file_path, query, budget, name) for file_path, name in files]
+    else:
+        blocks = file_cache.markdown(files)
+    page_blocks, page_notes = fetch_pages(urls) if len(urls) > 0 else ([], [])
+    if DEBUG: print(f'{INFO_DN}: file markdown: {blocks}')
+    notes = [f'File "{target}" does not exist.' for target in missing] + page_notes
+    # Tokenized as a whole: the tokens of separately tokenized blocks can differ where they meet
+    return '\n\n'.join([text, *blocks, *page_blocks, *notes])
 
 
 if __name__ == '__main__':
-    print(f'{INFO_DN}: loading model: {MODEL_PATH.split("/")[-1]}')
+    parser = argparse.ArgumentParser(description='Chat with a local model in the terminal')
+    parser.add_argument('working_dir', nargs='?', default=WORKING_DIR, help='the directory of the injected files (default: the current directory)')
+    parser.add_argument('--startup-profile', action='store_true', help='print when each step of the startup ended (imports, model load, prompt evaluation)')
+    args = parser.parse_args()
+    WORKING_DIR = args.working_dir
+
+    # Load .env variables
     try:
-        llama = Llama(
-            model_path=MODEL_PATH,
-            seed=SEED,
-            use_mlock=USE_MLOCK,
-            use_mmap=USE_MMAP,
-            n_ctx=N_CTX,
-            n_gpu_layers=-1 if USE_GPU else 0,
-            verbose=DEBUG
-        )
-    except ValueError as e:
-        print_error(f'the model path specified in the .env file is not valid: "{MODEL_PATH}"')
+        config = Config(ENV_FILE)
+    except ConfigError as e:
+        print_error(str(e))
         exit(1)
+    CONTEXT_WARNING = min(500, config.n_generate)
+    profile.mark('config loaded')
 
-    agent_prefixes = {
-        Chat.SYSTEM_KEY: BEGIN_SYSTEM,
-        Chat.ASSISTANT_KEY: BEGIN_ASSISTANT,
-        Chat.USER_KEY: BEGIN_USER
-    }
-
-    agent_names = {
-        Chat.SYSTEM_KEY: AGENT_SYSTEM,
-        Chat.ASSISTANT_KEY: AGENT_ASSISTANT,
-        Chat.USER_KEY: AGENT_USER
-    }
-
-    chat = Chat(
-        model=llama,
-        agent_prefixes=agent_prefixes,
-        agent_names=agent_names,
-        bot=BOT,
-        eos=EOS,
-        n_generate=N_GENERATE,
-        temperature=TEMPERATURE,
-        top_p=TOP_P,
-        top_k=TOP_K,
-        debug=DEBUG
-    )
-
-    # Perform checks for optional env variables
-    if supports_system_agent():
-        chat.send_message(agent=Chat.SYSTEM_KEY, content=SYSTEM_PROMPT)
-        print(f'{SYSTEM_DN}: {SYSTEM_PROMPT}')
-    
-    assistant_message_present = ASSISTANT_INITIAL_MESSAGE == None or ASSISTANT_INITIAL_MESSAGE == ''
-    if assistant_message_present:
-        chat.send_message(agent=Chat.ASSISTANT_KEY, content=ASSISTANT_INITIAL_MESSAGE)
-        print(f'{ASSISTANT_DN}: {ASSISTANT_INITIAL_MESSAGE}')
+    # The model loads while the user types the first message
+    print(f'{INFO_DN}: loading model: {config.model_path.split("/")[-1]}')
+    loading = BackgroundTask(load_chat)
+    print_prompt()
+    profile.mark('input ready')
 
     # Start chat
     last_message = ''
+    chat = None
     try:
         while 1:
             last_message = input(f'{USER_DN}: ').strip()
             if len(last_message) == 0: continue
             if last_message == COMMAND_EXIT: break
+            if chat is None:
+                profile.mark('first message')
+                if not loading.done():
+                    print(f'{INFO_DN}: waiting for the model to load')
+                try:
+                    sessions, retriever = loading.result()
+                except ValueError as e:
+                    print_error(f'the model path specified in the .env file is not valid: "{config.model_path}"')
+                    exit(1)
+                from utils.chat import Chat  # Already imported by the loader
+                chat = sessions.chat
+                if args.startup_profile:
+                    print(profile.format())
             if last_message == COMMAND_RESTART:
                 chat.reset_chat(keep_system=True)
+                prefill_prompt(chat)
                 print(f'{INFO_DN}: chat context cleared successfully')
                 continue
+            if last_message == COMMAND_STATS:
+                chat.print_stats(last_turn=True)
+                continue
+            if last_message == COMMAND_TUNE:
+                run_tune(chat)
+                continue
+            if run_json_command(chat, last_message):
+                continue
+            if run_sessions_command(sessions, last_message):
+                chat = sessions.chat
+                continue
+            session_command = parse_session_command(last_message)
+            if session_command is not None:
+                command, session_path = session_command
+                try:
+                    if command == COMMAND_SAVE:
+                        chat.save_session(session_path)
+                        print(f'{INFO_DN}: session saved to "{session_path}"')
+                    else:
+                        chat.load_session(session_path)
+                        print(f'{INFO_DN}: session loaded from "{session_path}" ({len(chat.messages)} messages)')
+                except (OSError, ValueError, RuntimeError) as e:
+                    print_error(f'{command} failed: {e}')
+                continue
 
-            last_message = inject_file(last_message)
+            with chat.instrumentation.measure(Instrumentation.INJECT):
+                last_message = inject_file(last_message, retriever)
             free_ctx = chat.send_message(Chat.USER_KEY, last_message)
-            if free_ctx <= CONTEXT_WARNING:
+            if free_ctx <= CONTEXT_WARNING and config.context_policy == Chat.POLICY_EXIT:
                 print(f'{INFO_DN}: context is nearly finished ({free_ctx} tokens left)')
 
             print(f'{ASSISTANT_DN}: ', end='', flush=True)
-            if not REAL_TIME:
-                reply, free_ctx = chat.generate_assistant_reply()
-                print(format_text(reply))
+            if not config.real_time:
+                reply, free_ctx = chat.generate_assistant_reply(grammar=reply_grammar)
+                with chat.instrumentation.measure(Instrumentation.RENDER):
+                    print(format_text(reply))
             else:
-                for token in chat.generate_assistant_reply_stepped():
-                    print(token, end='', flush=True)
-                    free_ctx -= 1
-                    # TODO Get free ctx from apposite chat method
+                writer = create_writer(sys.stdout)
+                if config.highlight:
+                    from utils.highlighter import StreamingHighlighter
+                    sink = StreamingHighlighter(writer, column=len('Assistant: '))
+                else:
+                    sink = writer
+                stream = chat.generate_assistant_reply_stepped(grammar=reply_grammar)
+                try:
+                    for token in stream:
+                        with chat.instrumentation.measure(Instrumentation.RENDER):
+                            sink.write(token)
+                        free_ctx -= 1
+                        # TODO Get free ctx from apposite chat method
+                except KeyboardInterrupt:  # Stop the reply but keep the chat going
+                    chat.cancel()
+                    for token in stream:
+                        sink.write(token)
+                    writer.flush()
+                    print(f'{INFO_DN}: generation interrupted')
+                with chat.instrumentation.measure(Instrumentation.RENDER):
+                    if config.highlight:
+                        sink.finish()
+                    writer.close()
+            chat.instrumentation.end_turn()
     except KeyboardInterrupt:
         print()
 
     # Exit
+    if chat is None:
+        if args.startup_profile:
+            print(profile.format())
+        exit(0)  # Without waiting for the model
+    sessions.close()
     chat.print_stats()
     if DEBUG: print(chat.get_raw_chat())
@@ -0,0 +1,324 @@
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import select
+import socket
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from llama_cpp import LlamaGrammar
+from utils.ansi import AnsiCodes as AC
+from utils.chat import Chat
+from utils.config import Config, ConfigError
+from utils.grammar import GrammarCache
+from utils.loader import create_chat, create_response_cache, disable_llama_logs, load_model
+from utils.scheduler import Request, Scheduler
+
+
+ENV_FILE = '.env'
+ERROR_DN = f'{AC.FG_RED}{AC.BOLD}Error{AC.RESET}'
+INFO_DN = f'{AC.FG_GREEN}{AC.BOLD}Info{AC.RESET}'
+
+ROLES = (Chat.SYSTEM_KEY, Chat.USER_KEY, Chat.ASSISTANT_KEY)
+RETRY_AFTER = 1  # Seconds suggested to the clients when too many requests are waiting
+DISCONNECT_POLL = 0.5  # Seconds between the checks of a waiting client
+
+
+def print_error(msg: str) -> None:
+    print(f'{ERROR_DN}: {msg}')
+
+
+class ChatCompletionsHandler(BaseHTTPRequestHandler):
+    """
+    OpenAI-compatible endpoints: `GET /v1/models` and `POST /v1/chat/completions` (with `"stream": true` for SSE)
+    """
+
+    protocol_version = 'HTTP/1.1'
+    scheduler: Scheduler
+    grammar_cache: GrammarCache
+    model_name: str
+    defaults: dict
+    last_disconnect_check = 0.0
+
+    def do_GET(self) -> None:
+        if self.path.rstrip('/') != '/v1/models':
+            self.send_json(404, error_body('not found'))
+            return
+
+        self.send_json(200, {'object': 'list', 'data': [{'id': self.model_name, 'object': 'model', 'owned_by': 'llamaterm'}]})
+
+    def do_POST(self) -> None:
+        if self.path.rstrip('/') != '/v1/chat/completions':
+            self.send_json(404, error_body('not found'))
+            return
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            request = self.parse_request_body(body)
+        except ValueError as e:  # json.JSONDecodeError included
+            self.send_json(400, error_body(f'invalid request: {e}'))
+            return
+
+        if not self.scheduler.submit(request):
+            self.send_json(429, error_body('too many requests are waiting, retry later'), {'Retry-After': str(RETRY_AFTER)})
+            return
+
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        if body.get('stream', False):
+            self.stream_completion(request, completion_id)
+        else:
+            self.send_completion(request, completion_id)
+
+    def parse_request_body(self, body: dict) -> Request:
+        """
+        Get the request from the body of a chat completion
+
+        @param body: the JSON body
+        @return: the request
+        @raises ValueError: if the body is not valid
+        """
+        if not isinstance(body, dict) or not isinstance(body.get('messages'), list) or len(body['messages']) == 0:
+            raise ValueError('"messages" must be a non-empty list')
+
+        messages = []
+        for message in body['messages']:
+            if not isinstance(message, dict) or message.get('role') not in ROLES or not isinstance(message.get('content'), str):
+                raise ValueError(f'messages must have a role ({", ".join(ROLES)}) and a string content')
+            messages.append((message['role'], message['content']))
+        if messages[-1][0] != Chat.USER_KEY:
+            raise ValueError('the last message must be from the user')
+
+        def option(name: str, convert):  # A missing or null option uses the default
+            value = body.get(name)
+            return convert(self.defaults[name] if value is None else value)
+
+        try:
+            max_tokens = option('max_tokens', int)
+            if max_tokens < 1:
+                raise ValueError('"max_tokens" must be at least 1')
+            return Request(
+                messages,
+                max_tokens=max_tokens,
+                temperature=option('temperature', float),
+                top_p=option('top_p', float),
+                top_k=option('top_k', int),
+                grammar=self.parse_response_format(body.get('response_format'))
+            )
+        except TypeError:
+            raise ValueError('invalid sampling parameters')
+
+    def parse_response_format(self, response_format: dict | None) -> LlamaGrammar | None:
+        """
+        Get the grammar of a `response_format`: `{"type": "json_object"}` for any JSON object or
+        `{"type": "json_schema", "json_schema": {"schema": {...}}}` for the JSON values that follow a schema
+
+        @param response_format: the response format of the request, if any
+        @return: the grammar that constrains the reply (None for free text)
+        @raises ValueError: if the response format or its schema is not valid
+        """
+        if response_format is None:
+            return None
+        if not isinstance(response_format, dict):
+            raise ValueError('"response_format" must be an object')
+
+        kind = response_format.get('type')
+        if kind == 'text':
+            return None
+        if kind == 'json_object':
+            return self.grammar_cache.any_json()
+        if kind == 'json_schema':
+            json_schema = response_format.get('json_schema')
+            if not isinstance(json_schema, dict) or not isinstance(json_schema.get('schema'), dict):
+                raise ValueError('"response_format.json_schema.schema" must be an object')
+            return self.grammar_cache.from_json_schema(json_schema['schema'])
+        raise ValueError('"response_format.type" must be text, json_object or json_schema')
+
+    def send_completion(self, request: Request, completion_id: str) -> None:
+        parts = []
+        try:
+            while True:
+                kind, value = self.wait_event(request)
+                if kind == 'text':
+                    parts.append(value)
+                elif kind == 'error':
+                    self.send_json(500, error_body(value))
+                    return
+                else:
+                    break
+        except ConnectionResetError:  # The client went away, stop generating for it
+            request.cancel()
+            self.close_connection = True
+            return
+
+        self.send_json(200, {
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': self.model_name,
+            'choices': [{'index': 0, 'message': {'role': Chat.ASSISTANT_KEY, 'content': ''.join(parts)}, 'finish_reason': value['finish_reason']}],
+            'usage': usage(value)
+        })
+
+    def stream_completion(self, request: Request, completion_id: str) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        def chunk(delta: dict, finish_reason: str | None = None) -> bytes:
+            data = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': self.model_name,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+            }
+            return f'data: {json.dumps(data)}\n\n'.encode('UTF-8')
+
+        try:
+            self.wfile.write(chunk({'role': Chat.ASSISTANT_KEY, 'content': ''}))
+            self.wfile.flush()
+            next_event = None
+            while True:
+                kind, value = next_event if next_event is not None else self.wait_event(request)
+                next_event = None
+                if kind == 'text':
+                    # Send all the text already generated in a single event
+                    while True:
+                        try:
+                            next_event = request.events.get_nowait()
+                        except queue.Empty:
+                            break
+                        if next_event[0] != 'text':
+                            break
+                        value += next_event[1]
+                        next_event = None
+                    self.wfile.write(chunk({'content': value}))
+                elif kind == 'error':
+                    self.wfile.write(f'data: {json.dumps(error_body(value))}\n\n'.encode('UTF-8'))
+                    break
+                else:
+                    self.wfile.write(chunk({}, value['finish_reason']))
+                    break
+                self.wfile.flush()
+            self.wfile.write(b'data: [DONE]\n\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):  # The client went away, stop generating for it
+            request.cancel()
+
+    def wait_event(self, request: Request) -> tuple[str, object]:
+        """
+        Wait for the next event of a request, checking that the client is still connected
+
+        @param request: the request
+        @return: the kind and the value of the event
+        @raises ConnectionResetError: if the client closed the connection
+        """
+        while True:
+            # Checked between the events too, a long reply never leaves the queue empty
+            if time.monotonic() - self.last_disconnect_check >= DISCONNECT_POLL:
+                self.last_disconnect_check = time.monotonic()
+                if self.client_disconnected():
+                    raise ConnectionResetError('the client closed the connection')
+            try:
+                return request.events.get(timeout=DISCONNECT_POLL)
+            except queue.Empty:
+                pass
+
+    def client_disconnected(self) -> bool:
+        """
+        Check if the client closed the connection, without consuming what it sent
+
+        @return: whether the connection is closed
+        """
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return self.connection.recv(1, socket.MSG_PEEK) == b''
+        except OSError:
+            return True
+
+    def send_json(self, status: int, body: dict, headers: dict[str, str] = {}) -> None:
+        data = json.dumps(body).encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def error_body(message: str) -> dict:
+    return {'error': {'message': message, 'type': 'invalid_request_error'}}
+
+
+def usage(done: dict) -> dict:
+    prompt_tokens = done.get('prompt_tokens', 0)
+    completion_tokens = done.get('completion_tokens', 0)
+    return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+
+
+def create_server(chats: list[Chat], host: str, port: int, max_pending: int = 16) -> ThreadingHTTPServer:
+    """
+    Create the HTTP server of the chat completions API and start its scheduler
+
+    @param chats: the chats of the scheduler, they must use the same model
+    @param host: the address to listen on
+    @param port: the port to listen on (0 for any free port)
+    @param max_pending: the maximum number of requests waiting for the model
+    @return: the server, call `serve_forever()` to handle the requests
+    """
+    model = chats[0].model
+    scheduler = Scheduler(chats, max_pending=max_pending)
+    scheduler.start()
+    handler = type('Handler', (ChatCompletionsHandler,), {
+        'scheduler': scheduler,
+        'grammar_cache': GrammarCache(model),
+        'model_name': os.path.splitext(os.path.basename(model.model_path))[0],
+        'defaults': {'max_tokens': chats[0].n_generate, 'temperature': chats[0].temperature, 'top_p': chats[0].top_p, 'top_k': chats[0].top_k}
+    })
+
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the model of the .env with an OpenAI-compatible chat completions API')
+    parser.add_argument('--host', default='127.0.0.1', help='the address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='the port to listen on')
+    parser.add_argument('--sessions', type=int, default=4, help='the number of conversations kept in memory to reuse their tokens')
+    parser.add_argument('--max-pending', type=int, default=16, help='the maximum number of requests waiting for the model')
+    args = parser.parse_args()
+
+    try:
+        config = Config(ENV_FILE)
+    except ConfigError as e:
+        print_error(str(e))
+        sys.exit(1)
+    disable_llama_logs()
+
+    print(f'{INFO_DN}: loading model: {os.path.basename(config.model_path)}')
+    try:
+        model = load_model(config)
+    except ValueError as e:
+        print_error(f'cannot load the model: {e}')
+        sys.exit(1)
+    # A full context must not stop the server
+    response_cache = create_response_cache(config) if config.response_cache_file else None  # Shared by the chats
+    chats = [create_chat(config, model, prompt_cache=None, context_policy=Chat.POLICY_SLIDE, response_cache=response_cache) for _ in range(args.sessions)]
+
+    server = create_server(chats, args.host, args.port, args.max_pending)
+    print(f'{INFO_DN}: serving on http://{args.host}:{args.port}/v1')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+    server.server_close()
@@ -0,0 +1,160 @@
+import time
+import random
+import numpy as np
+from collections.abc import Sequence
+
+
+class StubContext:
+    """
+    Stand-in for the llama.cpp context of `StubLlama`, KV cache operations are no-ops
+    """
+
+    def __init__(self) -> None:
+        self.ctx = None
+        self.memory = None
+
+    def kv_cache_seq_rm(self, seq_id: int, p0: int, p1: int) -> bool:
+        return True
+
+    def kv_cache_seq_shift(self, seq_id: int, p0: int, p1: int, shift: int) -> None:
+        pass
+
+
+class StubLlama:
+    """
+    Deterministic stand-in for `Llama` used to test LlamaTerm offline
+    without a GGUF model. Text is tokenized byte by byte (special tokens are kept whole) and the
+    replies are pseudo-random words that depend only on the seed and the prompt.
+    Evaluation and sampling costs can be simulated with per-token delays.
+    """
+
+    BOS = 1
+    EOS = 2
+    SPECIAL_TOKENS = ['<|im_start|>', '<|im_end|>', '<|endoftext|>', '<s>', '</s>', '[INST]', '[/INST]']
+    BYTES_OFFSET = 256
+    WORDS = [
+        'the', 'model', 'token', 'context', 'cache', 'reply', 'fast', 'local', 'code', 'file',
+        'prompt', 'chat', 'value', 'function', 'return', 'string', 'list', 'index', 'state', 'memory'
+    ]
+
+    def __init__(
+            self,
+            n_ctx: int = 4096,
+            seed: int = 0,
+            reply_length: int = 64,
+            prefill_delay: float = 0.0,
+            decode_delay: float = 0.0
+    ) -> None:
+        """
+        Create a new stub model
+
+        @param n_ctx: the context size
+        @param seed: the seed used to generate the replies
+        @param reply_length: the number of tokens generated before EOS (0 to never stop)
+        @param prefill_delay: the seconds spent to evaluate each prompt token
+        @param decode_delay: the seconds spent to sample each generated token
+        """
+        self._n_ctx = n_ctx
+        self._seed = seed
+        self.reply_length = reply_length
+        self.prefill_delay = prefill_delay
+        self.decode_delay = decode_delay
+
+        self.model_path = 'stub.gguf'
+        self.input_ids = np.zeros(n_ctx, dtype=np.intc)
+        self.n_tokens = 0
+        self.n_evaluated = 0
+        self._ctx = StubContext()
+        self._special_ids = {text: i + 3 for i, text in enumerate(self.SPECIAL_TOKENS)}
+        self._special_texts = {i: text.encode('UTF-8') for text, i in self._special_ids.items()}
+
+    def n_ctx(self) -> int:
+        return self._n_ctx
+
+    def set_seed(self, seed: int) -> None:
+        self._seed = seed
+
+    def token_eos(self) -> int:
+        return self.EOS
+
+    def token_bos(self) -> int:
+        return self.BOS
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> list[int]:
+        tokens = [self.BOS] if add_bos else []
+        i = 0
+        while i < len(text):
+            special_token = self._match_special(text, i) if special else None
+            if special_token is not None:
+                tokens.append(special_token)
+                i += len(self.SPECIAL_TOKENS[special_token - 3])
+            else:
+                tokens.append(self.BYTES_OFFSET + text[i])
+                i += 1
+
+        return tokens
+
+    def detokenize(self, tokens: Sequence[int], prev_tokens: Sequence[int] | None = None, special: bool = False) -> bytes:
+        pieces = []
+        for token in tokens:
+            if token >= self.BYTES_OFFSET:
+                pieces.append(bytes((token - self.BYTES_OFFSET,)))
+            elif special and token in self._special_texts:
+                pieces.append(self._special_texts[token])
+
+        return b''.join(pieces)
+
+    def reset(self) -> None:
+        self.n_tokens = 0
+
+    def eval(self, tokens: Sequence[int]) -> None:
+        if self.n_tokens + len(tokens) > self._n_ctx:
+            raise RuntimeError('llama_decode returned 1')
+        if self.prefill_delay > 0:
+            time.sleep(self.prefill_delay * len(tokens))
+
+        self.input_ids[self.n_tokens:self.n_tokens + len(tokens)] = tokens
+        self.n_tokens += len(tokens)
+        self.n_evaluated += len(tokens)
+
+    def generate(self, tokens: Sequence[int], **kwargs):
+        tokens = list(tokens)
+
+        # Reuse the evaluated prefix like llama-cpp-python does
+        n_past = 0
+        for evaluated, token in zip(self.input_ids[:self.n_tokens], tokens):
+            if evaluated != token:
+                break
+            n_past += 1
+        if n_past == len(tokens):  # Replay the last token to get fresh logits
+            n_past -= 1
+        self.n_tokens = max(n_past, 0)
+
+        rng = random.Random(hash((self._seed, len(tokens), tuple(tokens[-16:]))))
+        reply = self.tokenize(self._reply_text(rng).encode('UTF-8'), add_bos=False)
+        to_evaluate = tokens[self.n_tokens:]
+        n_generated = 0
+        while True:
+            self.eval(to_evaluate)
+            if self.decode_delay > 0:
+                time.sleep(self.decode_delay)
+
+            if self.reply_length > 0 and n_generated >= self.reply_length:
+                token = self.EOS
+            else:
+                token = reply[n_generated % len(reply)]
+            n_generated += 1
+
+            yield token
+            to_evaluate = [token]
+
+    def _match_special(self, text: bytes, i: int) -> int | None:
+        for special_text, token in self._special_ids.items():
+            if text.startswith(special_text.encode('UTF-8'), i):
+                return token
+
+        return None
+
+    def _reply_text(self, rng: random.Random) -> str:
+        words = [rng.choice(self.WORDS) for _ in range(64)]
+        return ' '.join(words) + '.\n'
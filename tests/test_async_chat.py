@@ -0,0 +1,123 @@
+import time
+import asyncio
+from utils.async_chat import AsyncChat
+from utils.chat import Chat
+from tests.stub_model import StubLlama
+
+
+N_CTX = 16384
+N_GENERATE = 64
+DECODE_DELAY = 0.002  # Seconds per generated token, like a small model on CPU
+N_TURNS = 4
+
+
+def create_chat() -> Chat:
+    return Chat(model=StubLlama(n_ctx=N_CTX, reply_length=N_GENERATE, decode_delay=DECODE_DELAY), n_generate=N_GENERATE)
+
+
+async def measure_loop_lag(work) -> tuple[object, float]:
+    """
+    Run a coroutine while a ticker measures how late the event loop wakes it up
+
+    @param work: the coroutine
+    @return: what the coroutine returned and the worst lag of the event loop in seconds
+    """
+    max_lag = 0.0
+    done = False
+
+    async def ticker() -> None:
+        nonlocal max_lag
+        while not done:
+            start_time = time.perf_counter()
+            await asyncio.sleep(0.001)
+            max_lag = max(max_lag, time.perf_counter() - start_time - 0.001)
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    try:
+        result = await work
+    finally:
+        done = True
+        await ticker_task
+
+    return result, max_lag
+
+
+def test_event_loop_is_not_blocked() -> None:
+    async def blocking_reply() -> str:  # What an asyncio service would do without the async chat
+        chat = create_chat()
+        chat.send_message(Chat.USER_KEY, 'Hello!')
+        return chat.generate_assistant_reply()[0]
+
+    async def run() -> tuple[float, float]:
+        async_chat = AsyncChat(create_chat())
+        _, blocking_lag = await measure_loop_lag(blocking_reply())
+        reply, async_lag = await measure_loop_lag(async_chat.reply('Hello!'))
+        await async_chat.close()
+        assert len(reply) > 0
+        return blocking_lag, async_lag
+
+    blocking_lag, async_lag = asyncio.run(run())
+    assert blocking_lag >= N_GENERATE * DECODE_DELAY / 2  # The whole reply
+    assert async_lag < blocking_lag / 2
+
+
+def test_concurrent_turns_are_serialized() -> None:
+    async def run() -> tuple[list[str], list]:
+        async_chat = AsyncChat(create_chat())
+        replies = await asyncio.gather(*[async_chat.reply(f'Question {i}?') for i in range(N_TURNS)])
+        await async_chat.close()
+        return replies, async_chat.chat.messages[-2 * N_TURNS:]
+
+    replies, messages = asyncio.run(run())
+    # Each user message is followed by its own reply
+    assert [msg.agent for msg in messages] == [Chat.USER_KEY, Chat.ASSISTANT_KEY] * N_TURNS
+    pairs = {user.content: reply.content for user, reply in zip(messages[0::2], messages[1::2])}
+    assert [pairs[f'Question {i}?'] for i in range(N_TURNS)] == replies
+
+
+def test_cancelling_the_consumer_stops_the_reply() -> None:
+    async def run() -> None:
+        async_chat = AsyncChat(Chat(model=StubLlama(n_ctx=N_CTX, reply_length=0, decode_delay=DECODE_DELAY), n_generate=10 * N_GENERATE))
+        n_received = 0
+
+        async def consume() -> None:
+            nonlocal n_received
+            async for _ in async_chat.stream('Tell me a long story.'):
+                n_received += 1
+
+        task = asyncio.create_task(consume())
+        while n_received < 10:
+            await asyncio.sleep(0.001)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        assert task.cancelled()
+
+        # The partial reply is kept and the chat is still usable
+        partial = async_chat.chat.messages[-1]
+        assert partial.agent == Chat.ASSISTANT_KEY
+        assert async_chat.chat.content_length(partial) < async_chat.chat.n_generate
+        assert len(await async_chat.reply('Go on.')) > 0
+        await async_chat.close()
+
+    asyncio.run(run())
+
+
+def test_slow_consumer_holds_the_worker_back() -> None:
+    async def run() -> None:
+        slow_chat = AsyncChat(create_chat(), max_buffered=8)
+        n_used = []
+        async for _ in slow_chat.stream('Hello again!'):
+            if len(n_used) == 0:
+                first_token = slow_chat.chat.tokens_used() - 1
+            await asyncio.sleep(0.01)
+            n_used.append(slow_chat.chat.tokens_used() - first_token)
+        n_reply = slow_chat.chat.content_length(slow_chat.chat.messages[-1])  # The EOS appended at the end is not generated
+        max_ahead = max(min(used, n_reply) - n_consumed for n_consumed, used in enumerate(n_used, start=1))
+        await slow_chat.close()
+        assert max_ahead <= slow_chat.max_buffered + 1  # The queue and the text waiting for room
+
+    asyncio.run(run())
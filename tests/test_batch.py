@@ -0,0 +1,93 @@
+import io
+import os
+import json
+import pytest
+import batch
+from utils.chat import Chat
+from tests.stub_model import StubLlama
+
+
+N_CTX = 4096
+N_GENERATE = 256
+SEED = 42
+N_ITEMS = 16
+SYSTEM_PROMPTS = [
+    'You are a helpful developer assistant, answer all the questions correctly and concisely.',
+    'You are a senior software engineer working on a large Python code base. Always explain your reasoning.'
+]
+QUESTIONS = [
+    'What is a Python generator?', 'How do I reverse a list?', 'What does `git rebase` do?', 'Explain big-O notation.',
+    'What is a mutex?', 'How do I read a file in C?', 'What is a closure?', 'What is the difference between TCP and UDP?'
+]
+
+
+def batch_items() -> list[dict]:
+    """
+    Build batch items: groups that share a system prompt, a conversation, an item with several samples and an invalid item
+
+    @return: the items
+    """
+    items = [{'id': f'q{i}', 'system': SYSTEM_PROMPTS[i % 2], 'prompt': QUESTIONS[i % len(QUESTIONS)]} for i in range(N_ITEMS)]
+    items.append({'id': 'conversation', 'messages': [
+        {'role': 'system', 'content': SYSTEM_PROMPTS[0]}, {'role': 'user', 'content': 'Hi!'},
+        {'role': 'assistant', 'content': 'Hello!'}, {'role': 'user', 'content': 'What is a closure?'}
+    ]})
+    items.append({'id': 'samples', 'system': SYSTEM_PROMPTS[0], 'prompt': 'Name a sorting algorithm.', 'n': 3})
+    items.append({'id': 'invalid', 'system': SYSTEM_PROMPTS[0]})
+
+    return items
+
+
+def run_stub_batch(items: list[dict]) -> tuple[list[dict], dict]:
+    """
+    Run a batch with a fresh stub model
+
+    @param items: the batch items
+    @return: the results, in input order, and the aggregate stats
+    """
+    lines = io.StringIO(''.join(json.dumps(item) + '\n' for item in items))
+    chat = Chat(model=StubLlama(n_ctx=N_CTX, seed=SEED), n_generate=N_GENERATE, context_policy=Chat.POLICY_SLIDE)
+    out = io.StringIO()
+    stats = batch.run_batch([chat], batch.read_items(lines, os.getcwd()), out, seed=SEED)
+    results = sorted((json.loads(line) for line in out.getvalue().splitlines()), key=lambda result: result['index'])
+
+    return results, stats
+
+
+@pytest.fixture(scope='module')
+def batch_run() -> tuple[list[dict], list[dict], dict]:
+    items = batch_items()
+    results, stats = run_stub_batch(items)
+    return items, results, stats
+
+
+def test_every_item_gets_a_result(batch_run) -> None:
+    items, results, _ = batch_run
+    assert [result['id'] for result in results] == [item['id'] for item in items]
+    assert [result['id'] for result in results if 'error' in result] == ['invalid']
+
+
+def test_shared_prefixes_are_reused(batch_run) -> None:
+    _, _, stats = batch_run
+    assert stats['evaluated_tokens'] < stats['prompt_tokens']
+
+
+def test_reuse_does_not_change_the_replies(batch_run) -> None:
+    items, results, _ = batch_run
+    for item, result in zip(items, results):
+        alone = run_stub_batch([item])[0][0]
+        assert result.get('reply') == alone.get('reply')
+        assert result.get('replies') == alone.get('replies')
+
+
+def test_token_counts_are_consistent(batch_run) -> None:
+    _, results, _ = batch_run
+    for result in results:
+        assert 0 <= result.get('reused_tokens', 0) <= result.get('prompt_tokens', 0)
+
+
+def test_samples_differ(batch_run) -> None:
+    _, results, _ = batch_run
+    samples = next(result['replies'] for result in results if result['id'] == 'samples')
+    assert len(samples) == 3
+    assert len(set(samples)) == len(samples)
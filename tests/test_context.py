@@ -0,0 +1,62 @@
+import random
+import pytest
+from utils.chat import Chat, Message
+from tests.stub_model import StubLlama
+
+
+N_CTX = 2048
+N_GENERATE = 128
+N_TURNS = 300
+SYSTEM_PROMPTS = [
+    'You are a helpful developer assistant, answer all the questions correctly and concisely.',
+    'You are a senior software engineer working on a large Python code base. '
+    'Always explain your reasoning, point out possible bugs, suggest tests and keep the answers consistent with the existing style.'
+]
+
+
+def assert_context_consistent(chat: Chat, pinned: list[Message]) -> None:
+    """
+    Check that the context of a chat is consistent with its messages
+
+    @param chat: the chat
+    @param pinned: the system messages that must stay at the start of the context
+    """
+    assert chat.tokens_used() <= chat.model.n_ctx(), 'context overflow'
+    assert chat.messages[:len(pinned)] == pinned, 'a pinned system message was evicted or moved'
+
+    offset = 1 if chat.bot_token else 0
+    for msg in chat.messages:
+        assert msg.offset == offset, f'message at offset {msg.offset} instead of {offset}: {msg!r}'
+        tokens = chat.tokens_cache[msg.offset:msg.offset + msg.length].tolist()
+        header = chat.header_tokens[msg.agent]
+        assert tokens[:len(header)] == header, f'header not found in the span of {msg!r}'
+        assert tokens[len(tokens) - len(chat.eos_tokens):] == chat.eos_tokens, f'EOS not found in the span of {msg!r}'
+        assert chat.detokenize_tokens(tokens[len(header):len(tokens) - len(chat.eos_tokens)]) == msg.content
+        offset += msg.length
+    assert offset == chat.tokens_used()
+
+
+@pytest.mark.parametrize('policy', [Chat.POLICY_SLIDE, Chat.POLICY_SUMMARIZE])
+def test_long_conversation(policy: str) -> None:
+    """
+    A long conversation with random message lengths never overflows a small context, keeps the
+    system messages pinned and the spans of the messages match the context tokens after each turn
+    """
+    chat = Chat(model=StubLlama(n_ctx=N_CTX, reply_length=N_GENERATE // 2), n_generate=N_GENERATE, context_policy=policy)
+    for system_prompt in SYSTEM_PROMPTS:
+        chat.send_message(Chat.SYSTEM_KEY, system_prompt)
+    pinned = list(chat.messages)
+
+    rng = random.Random(0)
+    n_evicted = 0
+    for turn in range(N_TURNS):
+        n_messages = len(chat.messages)
+        words = [rng.choice(StubLlama.WORDS) for _ in range(rng.choice((2, 10, 40, 120)))]
+        chat.send_message(Chat.USER_KEY, f'Question {turn}: {" ".join(words)}?')
+        chat.generate_assistant_reply()  # The stub model raises like llama.cpp if the context overflows
+        n_evicted += max(0, n_messages + 2 - len(chat.messages))
+        assert_context_consistent(chat, pinned)
+
+    assert n_evicted > 0
+    if policy == Chat.POLICY_SUMMARIZE:
+        assert chat.summary_message in chat.messages
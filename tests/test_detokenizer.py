@@ -0,0 +1,38 @@
+import pytest
+from utils.chat import Chat
+from utils.detokenizer import StreamingDetokenizer, TokenPieces
+from tests.stub_model import StubLlama
+
+
+SPLIT_CHARACTERS = ('é', 'ß', '€', '世', '한', '👋', '👋🏽', '👨‍👩‍👧', '🇮🇹', '𝔘')  # 2, 3 and 4 byte characters and sequences
+MULTILINGUAL_TEXT = (
+    'Plain ASCII text with code: `for i in range(10): print(i)`. '
+    'Accents: naïve café, Ærøskøbing, São Paulo. Greek: αβγ. Cyrillic: привет мир. '
+    'CJK: 你好，世界！日本語のテキスト。한국어 문장. '
+    'Emoji: 👋🏽 🎉 👨‍👩‍👧 🇮🇹 and symbols €, ™, ∑, 𝔘𝔫𝔦𝔠𝔬𝔡𝔢.\n'
+)
+
+
+def stream(detokenizer: StreamingDetokenizer, tokens: list[int]) -> str:
+    detokenizer.reset()
+    return ''.join([detokenizer.feed(token) for token in tokens]) + detokenizer.flush()
+
+
+@pytest.mark.parametrize('text', [
+    f'{prefix}{character}{suffix}' for character in SPLIT_CHARACTERS for prefix in ('', 'a') for suffix in ('', 'b', character)
+])
+def test_characters_split_across_tokens(text: str) -> None:
+    """
+    The stub model tokenizes byte by byte, so every multi-byte character is split across tokens
+    """
+    model = StubLlama()
+    tokens = model.tokenize(text.encode('UTF-8'), add_bos=False)
+    assert stream(StreamingDetokenizer(TokenPieces(model), Chat.CHARSET), tokens) == text
+
+
+def test_same_text_as_a_whole_decode() -> None:
+    model = StubLlama()
+    tokens = model.tokenize(MULTILINGUAL_TEXT.encode('UTF-8'), add_bos=False)
+    detokenizer = StreamingDetokenizer(TokenPieces(model), Chat.CHARSET)
+    assert stream(detokenizer, tokens) == model.detokenize(tokens, special=True).decode(Chat.CHARSET)
+    assert stream(detokenizer, tokens) == MULTILINGUAL_TEXT  # The state is reset between texts
@@ -0,0 +1,49 @@
+import os
+from array import array
+from utils.model_state import ModelState
+from utils.prompt_cache import PromptCache
+
+
+def test_lookup_finds_the_longest_prefix(tmp_path) -> None:
+    cache = PromptCache(str(tmp_path), 1024 * 1024, model_id='model')
+    cache.store(ModelState(array('i', [1, 2]), b'short'))
+    cache.store(ModelState(array('i', [1, 2, 3]), b'long'))
+
+    assert cache.lookup([1, 2, 3, 4]).data == b'long'
+    assert cache.lookup([1, 2, 5]).data == b'short'
+    assert cache.lookup([5]) is None
+
+
+def test_states_of_other_models_are_not_found(tmp_path) -> None:
+    PromptCache(str(tmp_path), 1024 * 1024, model_id='model').store(ModelState(array('i', [1, 2]), b'state'))
+    assert PromptCache(str(tmp_path), 1024 * 1024, model_id='other model').lookup([1, 2]) is None
+
+
+def test_corrupt_state_is_evicted(tmp_path) -> None:
+    cache = PromptCache(str(tmp_path), 1024 * 1024, model_id='model')
+    cache.store(ModelState(array('i', [1, 2]), b'short'))
+    cache.store(ModelState(array('i', [1, 2, 3]), b'x' * 100))
+    long_path = cache._state_path(cache.prefix_key([1, 2, 3]))
+    with open(long_path, 'r+b') as f:
+        f.truncate(20)
+
+    assert cache.lookup([1, 2, 3]).data == b'short'  # The next longest prefix
+    assert not os.path.exists(long_path)
+    assert len(cache.index) == 1
+
+
+def test_store_leaves_no_temporary_files(tmp_path) -> None:
+    cache = PromptCache(str(tmp_path), 1024 * 1024)
+    cache.store(ModelState(array('i', [1, 2]), b'state'))
+    assert sorted(os.listdir(tmp_path)) == sorted([PromptCache.INDEX_FILE, cache.prefix_key([1, 2]) + PromptCache.STATE_EXT])
+
+
+def test_least_recently_used_states_are_evicted(tmp_path) -> None:
+    state_size = len(ModelState(array('i', [1]), b'x' * 100).data) + 16 + 4
+    cache = PromptCache(str(tmp_path), 2 * state_size)
+    for token in (1, 2, 3):
+        cache.store(ModelState(array('i', [token]), b'x' * 100))
+
+    assert cache.size() <= 2 * state_size
+    assert cache.lookup([1]) is None
+    assert cache.lookup([3]) is not None
@@ -0,0 +1,38 @@
+from utils.retrieval import FileIndex, index_terms
+
+
+CHUNK_CHARS = 100
+
+
+def test_identifiers_are_split_into_terms() -> None:
+    assert index_terms('parse_session_command loadSession') == ['parse_session_command', 'parse', 'session', 'command', 'loadsession', 'load', 'session']
+
+
+def test_chunks_are_groups_of_whole_lines() -> None:
+    lines = [f'line {i} ' + 'x' * 20 for i in range(20)]
+    index = FileIndex.build('\n'.join(lines), len, CHUNK_CHARS)
+
+    assert '\n'.join(chunk.text for chunk in index.chunks) == '\n'.join(lines)
+    assert all(chunk.first_line <= chunk.last_line for chunk in index.chunks)
+    assert index.chunks[-1].last_line == len(lines)
+
+
+def test_long_lines_are_split() -> None:
+    long_line = 'minified ' * 100
+    index = FileIndex.build(f'first\n{long_line}\nlast', len, CHUNK_CHARS)
+
+    assert all(len(chunk.text) <= CHUNK_CHARS for chunk in index.chunks)
+    assert ''.join(chunk.text for chunk in index.chunks if chunk.first_line == 2) == long_line
+    assert [chunk.text for chunk in index.chunks if chunk.first_line != 2] == ['first', 'last']
+    assert len(index.select('minified', CHUNK_CHARS)) > 0  # A piece fits in the budget
+
+
+def test_select_prefers_relevant_chunks_within_the_budget() -> None:
+    text = '\n'.join(['def load_session(path):'] + ['    pass'] * 30 + ['def save_session(path):'] + ['    pass'] * 30)
+    index = FileIndex.build(text, len, CHUNK_CHARS)
+    budget = max(chunk.n_tokens for chunk in index.chunks)  # Room for one chunk
+    selected = index.select('how does save_session work?', budget)
+
+    assert sum(chunk.n_tokens for chunk in selected) <= budget
+    assert any('save_session' in chunk.text for chunk in selected)
+    assert not any('load_session' in chunk.text for chunk in selected)
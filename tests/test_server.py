@@ -0,0 +1,162 @@
+import json
+import time
+import socket
+import threading
+import http.client
+import pytest
+import server as server_module
+from utils.chat import Chat
+from tests.stub_model import StubLlama
+
+
+N_CTX = 16384
+N_GENERATE = 32
+MAX_PENDING = 2
+DECODE_DELAY = 0.002  # Seconds per generated token, like a small model on CPU
+SYSTEM_PROMPT = 'You are a helpful developer assistant, answer all the questions correctly and concisely.'
+QUESTION = [{'role': 'system', 'content': SYSTEM_PROMPT}, {'role': 'user', 'content': 'What is a Python generator?'}]
+
+
+class StubServer:
+    def __init__(self) -> None:
+        self.model = StubLlama(n_ctx=N_CTX, reply_length=0, decode_delay=DECODE_DELAY)
+        self.chats = [Chat(model=self.model, n_generate=N_GENERATE, context_policy=Chat.POLICY_SLIDE) for _ in range(2)]
+        self.server = server_module.create_server(self.chats, '127.0.0.1', 0, max_pending=MAX_PENDING)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def post(self, body: dict) -> tuple[int, dict, str]:
+        """
+        Send a chat completion request
+
+        @param body: the body of the request
+        @return: the status, the headers and the body of the response (the text of the events if streamed)
+        """
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        try:
+            connection.request('POST', '/v1/chat/completions', json.dumps(body), {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            return response.status, dict(response.getheaders()), response.read().decode('UTF-8')
+        finally:
+            connection.close()
+
+    def post_and_disconnect(self, body: dict, wait: float = 0.0) -> None:
+        """
+        Send a chat completion request and close the connection without reading the whole response
+
+        @param body: the body of the request
+        @param wait: the seconds to wait before closing the connection
+        """
+        data = json.dumps(body).encode('UTF-8')
+        client = socket.create_connection(('127.0.0.1', self.port), timeout=60)
+        client.sendall(
+            b'POST /v1/chat/completions HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n' +
+            f'Content-Length: {len(data)}\r\n\r\n'.encode('UTF-8') + data
+        )
+        if body.get('stream'):
+            client.recv(4096)
+        time.sleep(wait)
+        client.close()
+
+    def chat_of(self, content: str) -> Chat:
+        return next(chat for chat in self.chats if len(chat.messages) >= 2 and chat.messages[-2].content == content)
+
+
+def streamed_text(events: str) -> str:
+    """
+    Join the text of the chunks of a streamed chat completion
+
+    @param events: the server-sent events
+    @return: the text of the reply
+    """
+    parts = []
+    for line in events.splitlines():
+        if line.startswith('data: ') and line != 'data: [DONE]':
+            parts.append(json.loads(line[len('data: '):])['choices'][0]['delta'].get('content', ''))
+
+    return ''.join(parts)
+
+
+@pytest.fixture(scope='module')
+def stub_server():
+    server = StubServer()
+    yield server
+    server.server.shutdown()
+    server.server.server_close()
+
+
+def test_models(stub_server: StubServer) -> None:
+    connection = http.client.HTTPConnection('127.0.0.1', stub_server.port, timeout=60)
+    connection.request('GET', '/v1/models')
+    response = connection.getresponse()
+    assert response.status == 200
+    assert json.loads(response.read())['data'][0]['id'] == 'stub'
+    connection.close()
+
+
+def test_completion_and_stream(stub_server: StubServer) -> None:
+    status, _, body = stub_server.post({'messages': QUESTION})
+    assert status == 200
+    completion = json.loads(body)
+    reply = completion['choices'][0]['message']['content']
+    assert len(reply) > 0
+    assert completion['usage']['completion_tokens'] == N_GENERATE
+
+    status, _, body = stub_server.post({'messages': QUESTION, 'stream': True})
+    assert status == 200
+    assert body.rstrip().endswith('data: [DONE]')
+    assert streamed_text(body) == reply
+
+
+def test_null_options_use_the_defaults(stub_server: StubServer) -> None:
+    nulls = {'max_tokens': None, 'temperature': None, 'top_p': None, 'top_k': None, 'response_format': None, 'stream': None}
+    assert stub_server.post({'messages': QUESTION, **nulls})[0] == 200
+
+
+@pytest.mark.parametrize('body', [
+    {}, {'messages': []}, {'messages': [{'role': 'assistant', 'content': 'Hi!'}]},
+    {'messages': QUESTION, 'temperature': 'hot'}, {'messages': QUESTION, 'max_tokens': 0}
+])
+def test_invalid_requests(stub_server: StubServer, body: dict) -> None:
+    assert stub_server.post(body)[0] == 400
+
+
+def test_continued_conversation_evaluates_only_new_messages(stub_server: StubServer) -> None:
+    status, _, body = stub_server.post({'messages': QUESTION})
+    reply = json.loads(body)['choices'][0]['message']['content']
+    n_evaluated = stub_server.model.n_evaluated
+    continued = QUESTION + [{'role': 'assistant', 'content': reply}, {'role': 'user', 'content': 'How do I reverse a list?'}]
+    status, _, body = stub_server.post({'messages': continued})
+    assert status == 200
+    used = json.loads(body)['usage']
+    n_prompt_evaluated = stub_server.model.n_evaluated - n_evaluated - used['completion_tokens']
+    assert n_prompt_evaluated < used['prompt_tokens'] // 2
+
+
+def test_backpressure(stub_server: StubServer) -> None:
+    statuses = []
+    threads = [
+        threading.Thread(target=lambda i=i: statuses.append(stub_server.post({'messages': [{'role': 'user', 'content': f'Question {i}?'}]})))
+        for i in range(MAX_PENDING + 4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    rejected = [headers for status, headers, _ in statuses if status == 429]
+    assert len(rejected) > 0
+    assert all('Retry-After' in headers for headers in rejected)
+    assert any(status == 200 for status, _, _ in statuses)
+
+
+@pytest.mark.parametrize('stream', [True, False])
+def test_disconnect_stops_the_generation(stub_server: StubServer, stream: bool) -> None:
+    n_long = 100 * N_GENERATE
+    content = f'Tell me a long story ({"streamed" if stream else "whole"}).'
+    # A waiting client is checked every DISCONNECT_POLL seconds, a stream when the next text is sent
+    stub_server.post_and_disconnect({'messages': [{'role': 'user', 'content': content}], 'stream': stream, 'max_tokens': n_long}, wait=0 if stream else server_module.DISCONNECT_POLL)
+
+    assert stub_server.post({'messages': QUESTION})[0] == 200
+    story_chat = stub_server.chat_of(content)
+    assert story_chat.content_length(story_chat.messages[-1]) < n_long
@@ -0,0 +1,118 @@
+import asyncio
+import threading
+import functools
+from collections.abc import AsyncIterator, Callable
+from concurrent.futures import ThreadPoolExecutor
+from llama_cpp import LlamaGrammar
+from utils.chat import Chat
+
+
+class AsyncChat:
+    """
+    asyncio facade over a `Chat`. Everything that touches the chat runs on a single worker thread
+    that owns it (and its model), so the event loop never blocks on llama.cpp and the turns of
+    several coroutines are serialized: a turn starts only when the previous one has ended.
+    The streamed text goes through a bounded queue, when the consumer is slower than the model
+    the worker waits for it (backpressure). Cancelling the task that consumes a stream stops the
+    reply at the current token, the partial reply is kept like with `Chat.cancel()`.
+    """
+
+    def __init__(self, chat: Chat, max_buffered: int = 64) -> None:
+        """
+        Create a new async chat, the chat must not be used directly afterwards
+
+        @param chat: the chat
+        @param max_buffered: the maximum number of generated texts waiting for the consumer
+        """
+        self.chat = chat
+        self.max_buffered = max_buffered
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-worker')
+        self.turn_lock = asyncio.Lock()
+
+    async def run(self, function: Callable, *args, **kwargs):
+        """
+        Run a function on the worker thread, after the calls submitted before it
+
+        @param function: the function, e.g. a method of the chat
+        @return: what the function returned
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    async def send_message(self, agent: str, content: str) -> int:
+        """
+        Append a message to the context of the chat, like `Chat.send_message`
+
+        @param agent: the agent that sent the content
+        @param content: the content of the message
+        @return: the available context after appending the message
+        """
+        async with self.turn_lock:
+            return await self.run(self.chat.send_message, agent, content)
+
+    async def reply(self, content: str | None = None, grammar: LlamaGrammar | None = None) -> str:
+        """
+        Send a user message (if any) and get the whole assistant reply
+
+        @param content: the content of the user message (None to reply to the messages already sent)
+        @param grammar: the grammar used to constrain the output of the model
+        @return: the reply
+        """
+        return ''.join([text async for text in self.stream(content, grammar)])
+
+    async def stream(self, content: str | None = None, grammar: LlamaGrammar | None = None) -> AsyncIterator[str]:
+        """
+        Send a user message (if any) and stream the assistant reply: `async for text in chat.stream(...)`
+
+        @param content: the content of the user message (None to reply to the messages already sent)
+        @param grammar: the grammar used to constrain the output of the model
+        @return: the detokenized text of each generated token
+        """
+        async with self.turn_lock:
+            loop = asyncio.get_running_loop()
+            events: asyncio.Queue = asyncio.Queue(self.max_buffered)
+            cancelled = threading.Event()
+
+            def put(event: tuple[str, object]) -> None:  # Waits while the queue is full
+                asyncio.run_coroutine_threadsafe(events.put(event), loop).result()
+
+            def generate() -> None:  # On the worker thread
+                try:
+                    if content is not None:
+                        self.chat.send_message(Chat.USER_KEY, content)
+                    for text in self.chat.stream_reply(grammar=grammar):
+                        if cancelled.is_set():  # Also set before the reply started
+                            self.chat.cancel()
+                        put(('text', text))
+                    put(('done', None))
+                except Exception as e:
+                    put(('error', e))
+
+            worker = loop.run_in_executor(self.executor, generate)
+            finished = False
+            try:
+                while True:
+                    kind, value = await events.get()
+                    if kind == 'text':
+                        yield value
+                    elif kind == 'error':
+                        finished = True
+                        raise value
+                    else:
+                        finished = True
+                        break
+            finally:
+                if not finished:  # Cancelled or closed early: stop the reply and let the worker finish the turn
+                    cancelled.set()
+                    self.chat.cancel()
+                    while True:
+                        kind, _ = await asyncio.shield(events.get())
+                        if kind != 'text':
+                            break
+                await asyncio.shield(worker)
+
+    async def close(self) -> None:
+        """
+        Wait for the running turn to end and stop the worker thread
+        """
+        async with self.turn_lock:
+            await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
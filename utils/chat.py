@@ -1,10 +1,34 @@
+import time
+import threading
+import llama_cpp
+from array import array
+from collections.abc import Sequence
 from llama_cpp import Llama, LlamaGrammar
+from utils.detokenizer import StreamingDetokenizer, TokenPieces
+from utils.instrumentation import Instrumentation
+from utils.model_state import ModelState
+from utils.prompt_cache import PromptCache
+from utils.response_cache import ResponseCache, model_identity
+from utils.session import SessionFile
+from utils.stop_matcher import StopMatch, StopSequenceMatcher, TokenStopMatcher
 
 
 class Message:
-    def __init__(self, agent: str, content: str) -> None:
+    __slots__ = ('agent', 'content', 'offset', 'length')
+
+    def __init__(self, agent: str, content: str, offset: int = -1, length: int = 0) -> None:
+        """
+        Create a new message
+
+        @param agent: the agent that sent the content
+        @param content: the content of the message
+        @param offset: the position of the message round in the context tokens (-1 if not in context)
+        @param length: the number of tokens of the message round, header and EOS included
+        """
         self.agent = agent
         self.content = content
+        self.offset = offset
+        self.length = length
 
     def __repr__(self) -> str:
         return f'<{self.agent}> {self.content}'
@@ -16,7 +40,15 @@ class Chat:
     ASSISTANT_KEY = 'assistant'
     USER_KEY = 'user'
 
-    CLEAR_CURRENT_LINE = '\33[2K\r'
+    POLICY_EXIT = 'exit'
+    POLICY_SLIDE = 'slide'
+    POLICY_SUMMARIZE = 'summarize'
+    CONTEXT_POLICIES = (POLICY_EXIT, POLICY_SLIDE, POLICY_SUMMARIZE)
+
+    SUMMARY_PROMPT = 'Summarize the following conversation in a few sentences, keeping all the facts that may be needed later:'
+    SUMMARY_HEADER = 'Summary of the earlier conversation:'
+    SUMMARY_MAX_TOKENS = 256
+
     CHARSET = 'UTF-8'
 
     def __init__(
@@ -38,6 +70,10 @@ class Chat:
             },
             bot: str = '',
             eos: str = '<|im_end|>\n',
+            prompt_cache: PromptCache | None = None,
+            response_cache: ResponseCache | None = None,
+            context_policy: str = POLICY_EXIT,
+            instrumentation: Instrumentation | None = None,
             debug=False
     ) -> None:
         """
@@ -52,6 +88,10 @@ class Chat:
         @param agent_names: the dict with the names for: system, assistant, user
         @param bot: the token that starts the chat
         @param eos: the token that ends a single chat round
+        @param prompt_cache: the cache used to restore already evaluated prompts
+        @param response_cache: the cache of the replies to identical contexts (used only when the sampling is deterministic)
+        @param context_policy: what to do when the context is full: exit, slide (evict the oldest rounds) or summarize them
+        @param instrumentation: the hooks that record the time spent in each stage of a turn
         @param debug: whether or not to output debug informations
         """
         self.model = model
@@ -63,13 +103,26 @@ class Chat:
         self.top_k = top_k
         self.agent_prefixes = agent_prefixes
         self.agent_names = agent_names
+        self.prompt_cache = prompt_cache
+        self.response_cache = response_cache
+        self.context_policy = context_policy
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
         self.debug = debug
 
-        self.eos_token = self.tokenize_text(self.eos, add_bos=False, special=True)[0]
+        self.eos_tokens = self.tokenize_text(self.eos, add_bos=False, special=True)
+        self.eos_token = self.eos_tokens[0]
         self.bot_token = self.tokenize_text(self.bot, add_bos=False, special=True)[0] if len(self.bot) > 0 else None
 
+        stop_sequences = [self.eos, *self.agent_prefixes.values()]
+        self.stop_matcher = StopSequenceMatcher(stop_sequences)
+        self.stop_tokens_matcher = TokenStopMatcher({seq: self.tokenize_text(seq) for seq in stop_sequences if len(seq) > 0})
+        self.header_tokens = {agent: self.tokenize_text(prefix) for agent, prefix in self.agent_prefixes.items()}
+        self.detokenizer = StreamingDetokenizer(TokenPieces(self.model), self.CHARSET)
+
         self.messages: list[Message] = []
-        self.tokens_cache: list[int] = []
+        self.summary_message: Message | None = None
+        self.cancel_event = threading.Event()
+        self.tokens_cache = array('i')
         self.cache_initialize()
 
 
@@ -80,81 +133,212 @@ class Chat:
         @param grammar: the grammar used to constrain the output of the model
         @return: the response text and the number of remaining tokens in the context
         """
-        self.cache_append_header(agent=self.ASSISTANT_KEY)
-
-        reply = ''
-        n_reply_tokens = 0
-        for token in self.model.generate(tokens=self.tokens_cache, temp=self.temperature, top_p=self.top_p, top_k=self.top_k, grammar=grammar):
-            self.check_context_overflow()  # Check for context exceeded
-            if token == self.model.token_eos() or token == self.eos_token:  # Check for EOS termination
-                self.tokens_cache += self.tokenize_text(self.eos)
-                break
-            if n_reply_tokens >= self.n_generate:  # Check if the model generated more tokens than it should in this chat turn
-                self.tokens_cache += self.tokenize_text(self.eos)
-                break
-
-            self.tokens_cache.append(token)
-            n_reply_tokens += 1
-            reply += self.detokenize_tokens([token])
-
-            interrupt, reply = self.check_eos_failure(reply)                            # Check for EOS detection failure due to multiple EOS tokens
-            if interrupt: break
-            interrupt, reply = self.check_model_impersonation(reply, self.USER_KEY)     # Check for model trying to impersonate the user before EOS
-            if interrupt: break
-            interrupt, reply = self.check_model_impersonation(reply, self.SYSTEM_KEY)   # Check for model trying to impersonate the system before EOS
-            if interrupt: break
-
-        self.add_message(self.ASSISTANT_KEY, reply)
+        stream = self.stream_reply(grammar=grammar)
+        try:
+            for _ in stream:
+                pass
+        except KeyboardInterrupt:  # Stop at the current token and keep the partial reply
+            self.cancel()
+            for _ in stream:
+                pass
 
-        return reply, self.context_available()
+        return self.messages[-1].content, self.context_available()
 
 
     def generate_assistant_reply_stepped(self, grammar: LlamaGrammar | None = None):
         """
         Get a response from the model (after a user message presumably) as a stream of tokens.
+        Text that could be the beginning of a stop sequence is held back until it is clear
+        whether it belongs to the reply, so it never has to be erased from the terminal.
 
         @param grammar: the grammar used to constrain the output of the model
-        @return: the single (already detokenized) token generated
+        @return: the single (already detokenized) token generated, the last one ends with a newline
         """
-        self.cache_append_header(agent=self.ASSISTANT_KEY)
+        emitted: list[str] = []
+        pending = ''
+        stream = self.stream_reply(grammar=grammar)
+        try:
+            while True:
+                try:
+                    pending += next(stream)
+                except StopIteration:
+                    break
+
+                n_held = min(self.stop_matcher.partial_length, len(pending))
+                if len(pending) > n_held:
+                    ready = pending[:len(pending) - n_held]
+                    pending = pending[len(pending) - n_held:]
+                    emitted.append(ready)
+                    yield ready
+        except KeyboardInterrupt:  # Interrupted between two tokens: stop like `cancel()`, so the turn is closed
+            self.cancel()
+            for text in stream:
+                pending += text
+
+        # The reply may end before the held text (stop sequence) or be stripped
+        text = ''.join(emitted)
+        full_text = text + pending
+        reply = self.messages[-1].content
+        reply_end = full_text.find(reply) + len(reply)
+        tail = full_text[len(text):reply_end] if reply_end > len(text) else ''
+        if not (text + tail).endswith('\n'):
+            tail += '\n'
+        if len(tail) > 0:
+            yield tail
+
+
+    def stream_reply(self, grammar: LlamaGrammar | None = None):
+        """
+        Generate the assistant reply, yielding the detokenized text of each token.
+        The reply is added to the messages once the generation ends, even if it
+        was cancelled with `cancel()` or a keyboard interrupt.
+        A reply found in the response cache is yielded at once, without using the model:
+        its tokens are added to the context and evaluated with the next prompt.
 
-        reply = ''
+        @param grammar: the grammar used to constrain the output of the model
+        @return: the stop sequence that interrupted the reply, if any
+        """
+        self.cancel_event.clear()
+        try:
+            self.make_room(self.n_generate)
+        except KeyboardInterrupt:  # Interrupted while making room (e.g. summarizing): close the turn without generating
+            self.cancel()
+        reply_offset = self.tokens_used()
+        self.cache_append_header(agent=self.ASSISTANT_KEY)
+        self.stop_matcher.reset()
+        self.stop_tokens_matcher.reset()
+        self.detokenizer.reset()
+
+        cache_key = None
+        interrupted = self.cancel_event.is_set()  # A partial reply is not cached
+        if not interrupted and self.response_cache is not None and self.response_cache.deterministic(self.temperature):
+            cache_key = self.response_cache.key(self.tokens_cache, self.reply_settings(grammar))
+            cached = self.response_cache.lookup(cache_key)
+            if cached is not None:
+                if self.debug: print('[DEBUG] Reply found in the response cache')
+                reply_tokens, reply, stop_sequence = cached
+                self.tokens_cache.extend(reply_tokens)
+                if len(reply) > 0:
+                    yield reply
+                self.add_reply(reply, reply_offset, stop_sequence)
+                return StopMatch(stop_sequence, len(reply), 0) if stop_sequence is not None else None
+
+        reply_start = self.tokens_used()
+        reply_parts: list[str] = []
+        stop = None
         n_reply_tokens = 0
-        for token in self.model.generate(tokens=self.tokens_cache, temp=self.temperature, top_p=self.top_p, top_k=self.top_k, grammar=grammar):
-            self.check_context_overflow()
-            if token == self.model.token_eos() or token == self.eos_token:  # Check for EOS termination
-                self.tokens_cache += self.tokenize_text(self.eos)
-                yield '\n'
-                break
-            if n_reply_tokens >= self.n_generate:  # Check for max tokens reached
-                self.tokens_cache += self.tokenize_text(self.eos)
-                yield '\n'
-                break
+        n_prompt_tokens = self.tokens_used() - self.model_prefix_length()  # Evaluated before the first token
+        generated = () if interrupted else self.model.generate(tokens=self.tokens_cache, temp=self.temperature, top_p=self.top_p, top_k=self.top_k, grammar=grammar)
+        step_start = time.perf_counter()
+        try:
+            for token in generated:
+                step_end = time.perf_counter()
+                if n_reply_tokens == 0:
+                    self.instrumentation.record(Instrumentation.PREFILL, step_end - step_start, n_prompt_tokens)
+                else:
+                    self.instrumentation.record(Instrumentation.DECODE, step_end - step_start, 1)
+
+                if self.check_context_overflow():  # Check for context exceeded
+                    interrupted = True
+                    break
+                if token == self.model.token_eos() or token == self.eos_token:  # Check for EOS termination
+                    break
+                if n_reply_tokens >= self.n_generate:  # Check if the model generated more tokens than it should in this chat turn
+                    break
+
+                self.tokens_cache.append(token)
+                n_reply_tokens += 1
+                new_text = self.detokenizer.feed(token)  # Empty until the token completes a character
+                reply_parts.append(new_text)
+
+                # Check for a multi-token EOS or for the model trying to impersonate another agent
+                stop_check_start = time.perf_counter()
+                n_stop_tokens = 0
+                token_stop = self.stop_tokens_matcher.feed(token)
+                if token_stop is not None:
+                    sequence, n_stop_tokens = token_stop
+                    kept_parts = reply_parts[:len(reply_parts) - n_stop_tokens]
+                    stop_parts = reply_parts[len(reply_parts) - n_stop_tokens:]
+                    stop = StopMatch(sequence, sum(map(len, kept_parts)), sum(map(len, stop_parts[:-1])))
+                else:
+                    # Fall back to the text for stop sequences spelled with unusual tokens (e.g. `'<|' + 'end' + '|>'`)
+                    stop = self.stop_matcher.feed(new_text)
+                    if stop is not None:
+                        n_stop_chars = self.stop_matcher.position - stop.start
+                        while n_stop_chars > 0 and n_stop_tokens < len(reply_parts):
+                            n_stop_tokens += 1
+                            n_stop_chars -= len(reply_parts[-n_stop_tokens])
+                self.instrumentation.record(Instrumentation.STOP_CHECK, time.perf_counter() - stop_check_start)
+
+                if stop is not None:
+                    if self.debug: print(f'[DEBUG] Stop sequence detected: {stop.sequence!r}')
+                    del self.tokens_cache[len(self.tokens_cache) - n_stop_tokens:]  # Roll back the partial stop sequence
+                    break
+
+                yield new_text
+                if self.cancel_event.is_set():  # Stop before evaluating the next token
+                    interrupted = True
+                    break
+                step_start = time.perf_counter()  # The time spent by the caller is not part of the decoding
+        except KeyboardInterrupt:  # Interrupted while the model was evaluating
+            if self.debug: print('[DEBUG] Generation interrupted')
+            interrupted = True
+
+        reply = ''.join(reply_parts)
+        if stop is not None:
+            reply = reply[:stop.start]
+        if cache_key is not None and not interrupted:
+            self.response_cache.store(cache_key, self.tokens_cache[reply_start:], reply, stop.sequence if stop is not None else None)
+        self.add_reply(reply, reply_offset, stop.sequence if stop is not None else None)
+
+        return stop
+
+
+    def reply_settings(self, grammar: LlamaGrammar | None = None) -> dict:
+        """
+        Get the settings that change the reply to a context, besides the model
 
-            self.tokens_cache.append(token)
-            n_reply_tokens += 1
-            new_text = self.detokenize_tokens([token])
-            reply += new_text
-
-            interrupt, reply = self.check_eos_failure(reply)
-            if interrupt:  # Remove the broken EOS text from the terminal
-                n_char_to_delete = len(self.eos) - 1
-                back_str = '\b' * n_char_to_delete
-                empty_str = ' ' * n_char_to_delete
-                yield back_str + empty_str + '\n'
-                break
-            interrupt, reply = self.check_model_impersonation(reply, self.USER_KEY)
-            if interrupt:  # Remove the text generated by the impersionation from the terminal
-                yield self.CLEAR_CURRENT_LINE
-                break
-            interrupt, reply = self.check_model_impersonation(reply, self.SYSTEM_KEY)
-            if interrupt:  # Remove the text generated by the impersionation from the terminal
-                yield self.CLEAR_CURRENT_LINE
-                break
+        @param grammar: the grammar used to constrain the output of the model
+        @return: the seed, the sampling settings, the length limit, the stop sequences and the grammar
+        """
+        return {
+            'seed': self.model._seed,  # Changed for each sample of a batch item
+            'temperature': self.temperature,
+            'top_p': self.top_p,
+            'top_k': self.top_k,
+            'n_generate': self.n_generate,
+            'stop': [self.eos, *self.agent_prefixes.values()],
+            'grammar': grammar._grammar if grammar is not None else None
+        }
 
-            yield new_text
 
-        self.add_message(self.ASSISTANT_KEY, reply)
+    def add_reply(self, reply: str, reply_offset: int, stop_sequence: str | None = None) -> Message:
+        """
+        Close the assistant turn that starts at `reply_offset` in the context and save its reply.
+        The tokens of the reply must already be in the context.
+
+        @param reply: the text of the reply, up to the stop sequence
+        @param reply_offset: the position of the assistant header in the context tokens
+        @param stop_sequence: the stop sequence that ended the reply, if any
+        @return: the message of the reply
+        """
+        self.tokens_cache.extend(self.eos_tokens)
+        if stop_sequence is not None and stop_sequence != self.eos:  # The model tried to impersonate another agent
+            reply = reply.strip()
+
+        reply_message = self.add_message(self.ASSISTANT_KEY, reply)
+        reply_message.offset = reply_offset
+        reply_message.length = self.tokens_used() - reply_offset
+
+        return reply_message
+
+
+    def cancel(self) -> None:
+        """
+        Stop the reply being generated at the current token.
+        The partial reply is kept and the context stays valid for the next turn.
+        """
+        self.cancel_event.set()
 
 
     def send_message(self, agent: str, content: str) -> int:
@@ -186,47 +370,217 @@ class Chat:
         return new_message
 
 
-    def check_eos_failure(self, reply: str) -> tuple[bool, str]:
+    def save_session(self, path: str) -> None:
+        """
+        Save the messages, the context and the model state to a session file
+
+        @param path: the path of the session file
         """
-        Check if the model outputted an EOS token that was not properly tokenized.
-        For example 3 tokens like `'<|' + 'end' + '|>'` instead of the single EOS
-        token `'<|eos|>'`.
+        self.prefill()  # Make sure that the model state covers the whole context
+        messages = [{'agent': msg.agent, 'content': msg.content, 'offset': msg.offset, 'length': msg.length} for msg in self.messages]
+        SessionFile.write(path, model_identity(self.model.model_path), messages, self.tokens_cache, ModelState.capture(self.model))
+
 
-        @param reply: the reply of the assistant
-        @return: a tuple `(is_escape_detected, cleaned_reply)`
+    def load_session(self, path: str) -> None:
         """
-        interrupt = False
-        if self.eos in reply[-(len(self.eos)+1):]:
-            if self.debug: print(f'[DEBUG] EOS escape occurred: {reply[-len(self.eos):]}')
-            reply = reply[:-len(self.eos)]
-            # TODO: Should re-add single-token EOS here?
-            interrupt = True
+        Restore the messages, the context and the model state from a session file,
+        without evaluating the context again (unless the model state cannot be restored)
 
-        return interrupt, reply
+        @param path: the path of the session file
+        @raises ValueError: if the file is not a valid session file of this model or it does not fit in the context
+        """
+        model_id, messages, tokens, state = SessionFile.read(path)
+        if model_id != model_identity(self.model.model_path):
+            raise ValueError('the session was saved with a different model')
+        if len(tokens) > self.model.n_ctx():
+            raise ValueError(f'the session has {len(tokens)} tokens, more than the context size ({self.model.n_ctx()})')
+        try:
+            messages = [Message(**msg) for msg in messages]
+        except TypeError:
+            raise ValueError('invalid messages in the session file')
+        if any(msg.offset + msg.length > len(tokens) for msg in messages):
+            raise ValueError('the messages of the session file do not match its context')
+
+        self.messages = messages
+        self.tokens_cache = tokens
+        self.summary_message = next((msg for msg in messages if msg.agent == self.SYSTEM_KEY and msg.content.startswith(self.SUMMARY_HEADER)), None)
+        try:
+            state.restore(self.model)
+        except RuntimeError:  # e.g. different KV cache settings: the KV cache may be partially overwritten, evaluate the context again
+            self.model.n_tokens = 0
+            self.prefill()
 
 
-    def check_model_impersonation(self, reply: str, agent: str) -> tuple[bool, str]:
+    def prefill(self) -> int:
         """
-        Check if the model tried to impersonate the user (usually by completely skipping the EOS).
+        Evaluate the context with the model ahead of the next reply, reusing the
+        tokens already evaluated and the longest prefix found in the prompt cache
 
-        @param reply: the reply of the assistant
-        @param agent: the agent that the model may have impersonated (usually the user or itself)
-        @return: a tuple `(is_impersonation_detected, cleaned_reply)`
+        @return: the number of tokens that had to be evaluated
         """
-        interrupt = False
-        if self.agent_prefixes[agent] in reply:
-            if self.debug: print(f'[DEBUG] Impersonation of {agent} detected')
-            reply = reply.split(self.agent_prefixes[agent])[0].strip()
-            interrupt = True
+        n_past = self.model_prefix_length()
+        if self.prompt_cache is not None and n_past < self.tokens_used():
+            state = self.prompt_cache.lookup(self.tokens_cache)
+            if state is not None and len(state.tokens) > n_past:
+                try:
+                    state.restore(self.model)
+                    n_past = len(state.tokens)
+                    if self.debug: print(f'[DEBUG] Restored {len(state.tokens)} tokens from the prompt cache')
+                except RuntimeError:  # Not a state of this model: forget it and evaluate the context from scratch
+                    self.prompt_cache.remove(state.tokens)
+                    n_past = 0
+
+        self.model.n_tokens = n_past
+        to_evaluate = self.tokens_cache[n_past:]
+        if len(to_evaluate) > 0:
+            with self.instrumentation.measure(Instrumentation.PREFILL, len(to_evaluate)):
+                self.model.eval(to_evaluate)
+            if self.prompt_cache is not None:
+                self.prompt_cache.store(ModelState.capture(self.model))
 
-        return interrupt, reply
+        return len(to_evaluate)
+
+
+    def model_prefix_length(self) -> int:
+        """
+        Get the number of leading context tokens that the model has already evaluated
+
+        @return: the length of the common prefix between the context and the model state
+        """
+        n_past = 0
+        for evaluated, token in zip(self.model.input_ids[:self.model.n_tokens], self.tokens_cache):
+            if evaluated != token:
+                break
+            n_past += 1
+
+        return n_past
+
+
+    def make_room(self, n_tokens: int) -> None:
+        """
+        Free the context according to the context policy so that `n_tokens` fit in it.
+        System messages are kept, the oldest user/assistant rounds are evicted
+        (or summarized) and the last message is never removed.
+
+        @param n_tokens: the number of tokens that need to fit in the context
+        """
+        if self.context_policy == self.POLICY_EXIT or self.context_available() >= n_tokens:
+            return
+
+        n_needed = n_tokens - self.context_available()
+        if self.context_policy == self.POLICY_SUMMARIZE:
+            n_needed += self.SUMMARY_MAX_TOKENS
+
+        # Evict whole rounds, so that the remaining history starts with a user message
+        evicted: list[Message] = []
+        n_freed = 0
+        for msg in self.messages[:-1]:
+            if msg.agent == self.SYSTEM_KEY:
+                continue
+            if n_freed >= n_needed and msg.agent == self.USER_KEY:
+                break
+            evicted.append(msg)
+            n_freed += msg.length if msg.offset >= 0 else len(self.tokenize_text(self.round_text(msg)))
+
+        if len(evicted) == 0:
+            return
+        if self.debug: print(f'[DEBUG] Evicting {len(evicted)} messages ({n_freed} tokens) from the context')
+
+        if self.context_policy == self.POLICY_SUMMARIZE:
+            if self.summary_message is not None:
+                evicted.insert(0, self.summary_message)
+            summary = self.summarize_messages(evicted)
+            evicted_ids = {id(msg) for msg in evicted}
+            self.messages = [msg for msg in self.messages if id(msg) not in evicted_ids]
+
+            # Keep the summary right after the pinned system messages
+            self.summary_message = Message(agent=self.SYSTEM_KEY, content=f'{self.SUMMARY_HEADER} {summary}')
+            n_pinned = 0
+            while n_pinned < len(self.messages) and self.messages[n_pinned].agent == self.SYSTEM_KEY:
+                n_pinned += 1
+            self.messages.insert(n_pinned, self.summary_message)
+            self.cache_rebuild()
+        else:
+            evicted_ids = {id(msg) for msg in evicted}
+            self.messages = [msg for msg in self.messages if id(msg) not in evicted_ids]
+            old_tokens = self.tokens_cache
+            self.cache_rebuild()
+            self.cache_shift_model(old_tokens)
+
+
+    def summarize_messages(self, messages: list[Message]) -> str:
+        """
+        Ask the model for a short summary of some messages.
+        It replaces the model state, so the context will be evaluated again afterwards.
+
+        @param messages: the messages to summarize
+        @return: the summary
+        """
+        transcript = '\n'.join(f'{self.agent_names[msg.agent]}: {msg.content}' for msg in messages)
+        prompt = [self.bot_token] if self.bot_token else []
+        prompt += self.tokenize_text(f'{self.agent_prefixes[self.USER_KEY]}{self.SUMMARY_PROMPT}\n\n')
+        end_tokens = self.tokenize_text(self.eos + self.agent_prefixes[self.ASSISTANT_KEY])
+
+        # Keep only the most recent part of the transcript if it does not fit
+        n_transcript_max = self.model.n_ctx() - len(prompt) - len(end_tokens) - self.SUMMARY_MAX_TOKENS
+        transcript_tokens = self.tokenize_text(transcript)
+        prompt += transcript_tokens[max(0, len(transcript_tokens) - n_transcript_max):] + end_tokens
+
+        summary_tokens = []
+        for token in self.model.generate(tokens=prompt, temp=self.temperature, top_p=self.top_p, top_k=self.top_k):
+            if token == self.model.token_eos() or token == self.eos_token or len(summary_tokens) >= self.SUMMARY_MAX_TOKENS:
+                break
+            summary_tokens.append(token)
+
+        return self.detokenize_tokens(summary_tokens).strip()
+
+
+    def cache_shift_model(self, old_tokens: array) -> None:
+        """
+        Update the KV cache of the model in place after a span of tokens was removed
+        from the context, so that the tokens after the span are not evaluated again.
+        If the model does not support it, the next generation will evaluate them.
+
+        @param old_tokens: the context tokens before the removal
+        """
+        n_removed = len(old_tokens) - len(self.tokens_cache)
+        p0 = 0
+        for old, new in zip(old_tokens, self.tokens_cache):
+            if old != new:
+                break
+            p0 += 1
+        p1 = p0 + n_removed
+        if n_removed <= 0 or old_tokens[p1:] != self.tokens_cache[p0:]:  # Not a single removed span
+            return
+
+        n_evaluated = 0
+        for evaluated, token in zip(self.model.input_ids[:self.model.n_tokens], old_tokens):
+            if evaluated != token:
+                break
+            n_evaluated += 1
+        if n_evaluated <= p1:  # Nothing to keep after the removed span
+            self.model.n_tokens = min(n_evaluated, p0)
+            return
+
+        ctx = self.model._ctx
+        can_shift = getattr(llama_cpp, 'llama_memory_can_shift', None)
+        if can_shift is not None and ctx.memory is not None and not can_shift(ctx.memory):
+            return
+        if not ctx.kv_cache_seq_rm(0, p0, p1):
+            return
+        ctx.kv_cache_seq_shift(0, p1, n_evaluated, -n_removed)
+
+        n_kept = n_evaluated - n_removed
+        self.model.input_ids[p0:n_kept] = self.model.input_ids[p1:n_evaluated]
+        self.model.n_tokens = n_kept
+        if self.debug: print(f'[DEBUG] Shifted {n_kept - p0} tokens of the KV cache by {-n_removed}')
 
 
     def cache_initialize(self) -> None:
         """
         Initialize the context and re-add the BOS if needed
         """
-        self.tokens_cache = []
+        self.tokens_cache = array('i')
         if self.bot_token:  # Add the BOT if specified
             self.tokens_cache.append(self.bot_token)
 
@@ -237,29 +591,58 @@ class Chat:
 
         @param agent: the agent for which the header will be added
         """
-        header = f'{self.agent_prefixes[agent]}'
-        self.tokens_cache += self.tokenize_text(header)
+        self.tokens_cache.extend(self.header_tokens[agent])
 
 
     def cache_append_message(self, message: Message) -> None:
         """
-        Append a message to the context tokens
+        Append a message to the context tokens and record its position in them
 
         @param message: the message that will be added
         """
-        round_text = f'{self.agent_prefixes[message.agent]}{message.content}{self.eos}'
-        self.tokens_cache += self.tokenize_text(round_text)
+        message.offset = self.tokens_used()
+        self.tokens_cache.extend(self.header_tokens[message.agent])
+        self.tokens_cache.extend(self.tokenize_text(message.content))
+        self.tokens_cache.extend(self.eos_tokens)
+        message.length = self.tokens_used() - message.offset
+
+
+    def content_length(self, message: Message) -> int:
+        """
+        Get the number of tokens of the content of a message in context (header and EOS excluded)
+
+        @param message: the message
+        @return: the number of tokens of its content
+        """
+        return message.length - len(self.header_tokens[message.agent]) - len(self.eos_tokens)
+
+
+    def round_text(self, message: Message) -> str:
+        """
+        Get the raw text of a chat round, header and EOS included
+
+        @param message: the message of the round
+        @return: the raw text of the round
+        """
+        return f'{self.agent_prefixes[message.agent]}{message.content}{self.eos}'
 
 
     def cache_rebuild(self) -> None:
         """
         Rebuild the cache by using the messages list contained in the
-        Chat object
+        Chat object. The tokens of messages already in context are reused,
+        only the new messages are tokenized.
         """
+        old_tokens = self.tokens_cache
         self.cache_initialize()
 
         for msg in self.messages:
-            self.cache_append_message(msg)
+            if msg.offset >= 0 and msg.offset + msg.length <= len(old_tokens):
+                new_offset = self.tokens_used()
+                self.tokens_cache.extend(old_tokens[msg.offset:msg.offset + msg.length])
+                msg.offset = new_offset
+            else:
+                self.cache_append_message(msg)
 
 
     def reset_chat(self, keep_system: bool = False) -> None:
@@ -268,20 +651,17 @@ class Chat:
 
         @param keep_system: if the system messages should be kept in context or not
         """
-        self.cache_initialize()
-
         if keep_system:
-            # Remove all the non-system messages
-            self.messages = [msg for msg in self.messages if msg.agent == self.SYSTEM_KEY]
-
-            # Re-add the system messages to the token cache
-            for msg in self.messages:
-                self.cache_append_message(msg)
+            # Remove all the non-system messages and rebuild the context from the remaining ones
+            self.messages = [msg for msg in self.messages if msg.agent == self.SYSTEM_KEY and msg is not self.summary_message]
+            self.cache_rebuild()
         else:
             self.messages = []
+            self.cache_initialize()
+        self.summary_message = None
 
 
-    def detokenize_tokens(self, tokens: list[int], special: bool = True) -> str:
+    def detokenize_tokens(self, tokens: Sequence[int], special: bool = True) -> str:
         """
         Detokenize the tokens list to a string
 
@@ -305,27 +685,49 @@ class Chat:
         @return: the list of tokens
         """
         try:
-            return self.model.tokenize(text=bytes(text, self.CHARSET), add_bos=add_bos, special=special)
+            start_time = time.perf_counter()
+            tokens = self.model.tokenize(text=bytes(text, self.CHARSET), add_bos=add_bos, special=special)
+            self.instrumentation.record(Instrumentation.TOKENIZE, time.perf_counter() - start_time, len(tokens))
+            return tokens
         except:
             print('[ERROR] An error occurred during tokenization of:', text)
             exit(1)
 
 
-    def check_context_overflow(self):
+    def check_context_overflow(self) -> bool:
         """
-        Check if the context available was finished
+        Check if the context available was finished.
+        With the exit policy the program is terminated.
+
+        @return: whether the context was finished
         """
-        if self.context_available() <= 0:
+        if self.context_available() > 0:
+            return False
+
+        if self.context_policy == self.POLICY_EXIT:
             print('[ERROR] Context exceeded.')
             exit(1)
 
+        return True
+
 
-    def print_stats(self):
+    def print_stats(self, last_turn: bool = False):
         """
-        Print some stats about the chat
+        Print some stats about the chat and the time spent in each stage
+
+        @param last_turn: whether to also print the breakdown of the last turn
         """
         print(f'Tokens used: {self.tokens_used()}')
         print(f'Tokens left: {self.context_available()}')
+        if self.response_cache is not None:
+            print(f'Response cache: {self.response_cache.hits} hits, {self.response_cache.misses} misses')
+        if last_turn:
+            print('Last turn:')
+            for line in self.instrumentation.format(self.instrumentation.last_turn):
+                print(f'  {line}')
+        print(f'All turns ({self.instrumentation.n_turns}):')
+        for line in self.instrumentation.format(self.instrumentation.total):
+            print(f'  {line}')
 
 
     def context_available(self) -> int:
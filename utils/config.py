@@ -0,0 +1,186 @@
+import os
+from dotenv import dotenv_values
+
+
+class ConfigError(Exception):
+    pass
+
+
+class Config:
+    """
+    Settings read from the .env file
+    """
+
+    KV_CACHE_TYPES = ('f32', 'f16', 'q8_0', 'q5_1', 'q5_0', 'q4_1', 'q4_0')
+
+    def __init__(self, env_file: str = '.env') -> None:
+        """
+        Load and validate the settings
+
+        @param env_file: the path of the .env file
+        @raises ConfigError: if the file is missing or a field is missing or invalid
+        """
+        if not os.path.isfile(env_file):
+            raise ConfigError('cannot read .env file.')
+        self.values = {**dotenv_values(env_file), **os.environ}
+
+        self.model_path =                self.get('MODEL_PATH')
+        self.bot =                       self.get('BOT')
+        self.prefix_template =           self.get('PREFIX_TEMPLATE')
+        self.eos =                       self.get('EOS')
+        self.agent_system =              self.get('AGENT_SYSTEM', required=False)
+        self.agent_user =                self.get('AGENT_USER')
+        self.agent_assistant =           self.get('AGENT_ASSISTANT')
+        self.system_prompt =             self.get('SYSTEM_PROMPT', required=False)
+        self.assistant_initial_message = self.get('ASSISTANT_INITIAL_MESSAGE', required=False)
+        self.real_time =                 self.get_bool('REAL_TIME')
+        self.highlight =                 self.get_bool('HIGHLIGHT', default=False)
+        self.n_ctx =                     self.get_int('N_CTX')
+        self.n_generate =                self.get_int('N_GENERATE')
+        self.temperature =               self.get_float('TEMPERATURE')
+        self.top_p =                     self.get_float('TOP_P')
+        self.top_k =                     self.get_int('TOP_K')
+        self.seed =                      self.get_int('SEED')
+        self.use_mmap =                  self.get_bool('USE_MMAP')
+        self.use_mlock =                 self.get_bool('USE_MLOCK')
+        self.use_gpu =                   self.get_bool('USE_GPU')
+        self.prompt_cache_dir =          self.get('PROMPT_CACHE_DIR', required=False)
+        self.prompt_cache_size =         self.get_int('PROMPT_CACHE_SIZE', default=1024)
+        self.response_cache_file =       self.get('RESPONSE_CACHE_FILE', required=False)
+        self.response_cache_size =       self.get_int('RESPONSE_CACHE_SIZE', default=64)
+        self.context_policy =            self.get_choice('CONTEXT_POLICY', ('exit', 'slide', 'summarize'), default='exit')
+        self.draft_mode =                self.get_choice('DRAFT_MODE', ('none', 'lookup', 'model'), default='none')
+        self.draft_tokens =              self.get_int('DRAFT_TOKENS', default=10)
+        self.draft_model_path =          self.get('DRAFT_MODEL_PATH', required=self.draft_mode == 'model')
+        self.stats_file =                self.get('STATS_FILE', required=False)
+        self.session_ram_budget =        self.get_int('SESSION_RAM_BUDGET', default=1024)
+        self.session_dir =               self.get('SESSION_DIR', required=False)
+        self.inject_mode =               self.get_choice('INJECT_MODE', ('full', 'retrieve'), default='full')
+        self.inject_budget =             self.get_int('INJECT_BUDGET', default=1024)
+        self.retrieval_cache_dir =       self.get('RETRIEVAL_CACHE_DIR', required=False)
+        self.web_cache_dir =             self.get('WEB_CACHE_DIR', required=False)
+        self.n_threads =                 self.get_int('N_THREADS', default=0)
+        self.n_threads_batch =           self.get_int('N_THREADS_BATCH', default=0)
+        self.n_batch =                   self.get_int('N_BATCH', default=512)
+        self.n_ubatch =                  self.get_int('N_UBATCH', default=512)
+        self.flash_attn =                self.get_bool('FLASH_ATTN', default=False)
+        self.type_k =                    self.get_choice('TYPE_K', self.KV_CACHE_TYPES, default='f16')
+        self.type_v =                    self.get_choice('TYPE_V', self.KV_CACHE_TYPES, default='f16')
+        if self.type_v not in ('f32', 'f16') and not self.flash_attn:
+            raise ConfigError('invalid .env field \'TYPE_V\', a quantized V cache needs FLASH_ATTN=1')
+
+    def get(self, key: str, required: bool = True) -> str:
+        """
+        Get a field as a string
+
+        @param key: the name of the field
+        @param required: whether a missing field is an error
+        @return: the value of the field (empty if missing and not required)
+        @raises ConfigError: if the field is required and missing
+        """
+        value = self.values.get(key)
+        if value is None:
+            if required:
+                raise ConfigError(f'missing .env field \'{key}\'')
+            return ''
+
+        return str(value)
+
+    def get_int(self, key: str, default: int | None = None) -> int:
+        """
+        Get a field as an integer
+
+        @param key: the name of the field
+        @param default: the value used if the field is missing or empty (the field is required if None)
+        @return: the value of the field
+        @raises ConfigError: if the field is required and missing or it's not an integer
+        """
+        value = self.get(key, required=default is None)
+        if value == '':
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise ConfigError(f'invalid .env field \'{key}\', must be an integer')
+
+    def get_float(self, key: str, default: float | None = None) -> float:
+        """
+        Get a field as a float
+
+        @param key: the name of the field
+        @param default: the value used if the field is missing or empty (the field is required if None)
+        @return: the value of the field
+        @raises ConfigError: if the field is required and missing or it's not a number
+        """
+        value = self.get(key, required=default is None)
+        if value == '':
+            return default
+        try:
+            return float(value)
+        except ValueError:
+            raise ConfigError(f'invalid .env field \'{key}\', must be a number')
+
+    def get_bool(self, key: str, default: bool | None = None) -> bool:
+        """
+        Get a field written as 0/1 as a boolean
+
+        @param key: the name of the field
+        @param default: the value used if the field is missing or empty (the field is required if None)
+        @return: the value of the field
+        @raises ConfigError: if the field is required and missing or it's not 0/1
+        """
+        value = self.get_int(key, default=None if default is None else int(default))
+        return bool(value)
+
+    def get_choice(self, key: str, choices: tuple[str, ...], default: str) -> str:
+        """
+        Get a field that must be one of a fixed set of values
+
+        @param key: the name of the field
+        @param choices: the allowed values
+        @param default: the value used if the field is missing or empty
+        @return: the value of the field
+        @raises ConfigError: if the value is not allowed
+        """
+        value = self.get(key, required=False) or default
+        if value not in choices:
+            raise ConfigError(f'invalid .env field \'{key}\', must be one of: {", ".join(choices)}')
+
+        return value
+
+    def supports_system_agent(self) -> bool:
+        """
+        Check if the model has a system agent and a system prompt was provided
+
+        @return: whether the system prompt can be sent
+        """
+        return (
+            (self.system_prompt != "None") and
+            (self.agent_system != "None") and
+            (self.system_prompt != "") and
+            (self.agent_system != "")
+        )
+
+    def agent_prefixes(self) -> dict[str, str]:
+        """
+        Build the header of each agent from the prefix template
+
+        @return: the prefixes for: system, assistant, user
+        """
+        return {
+            'system': self.prefix_template.replace('{agent}', self.agent_system),
+            'assistant': self.prefix_template.replace('{agent}', self.agent_assistant),
+            'user': self.prefix_template.replace('{agent}', self.agent_user)
+        }
+
+    def agent_names(self) -> dict[str, str]:
+        """
+        Get the name of each agent
+
+        @return: the names for: system, assistant, user
+        """
+        return {
+            'system': self.agent_system,
+            'assistant': self.agent_assistant,
+            'user': self.agent_user
+        }
@@ -0,0 +1,67 @@
+import codecs
+from llama_cpp import Llama
+
+
+class TokenPieces:
+    """
+    The bytes of each token of a model, detokenized once and then cached
+    (a vocabulary has a bounded number of tokens, so the cache never needs to evict)
+    """
+
+    def __init__(self, model: Llama, special: bool = True) -> None:
+        """
+        Create a new token pieces cache
+
+        @param model: the llama object whose vocabulary is used
+        @param special: whether special tokens are detokenized to their text
+        """
+        self.model = model
+        self.special = special
+        self.pieces: dict[int, bytes] = {}
+
+    def get(self, token: int) -> bytes:
+        piece = self.pieces.get(token)
+        if piece is None:
+            piece = self.pieces[token] = self.model.detokenize([token], special=self.special)
+
+        return piece
+
+
+class StreamingDetokenizer:
+    """
+    Turn generated tokens into text one token at a time. The bytes of a character split across
+    tokens (emoji, CJK, ...) are kept until its last byte arrives, so only complete characters
+    are returned and none of them is lost.
+    """
+
+    def __init__(self, pieces: TokenPieces, charset: str = 'UTF-8') -> None:
+        """
+        Create a new streaming detokenizer
+
+        @param pieces: the cached bytes of the tokens (can be shared by several detokenizers of the same model)
+        @param charset: the encoding of the bytes of the tokens
+        """
+        self.pieces = pieces
+        self.decoder = codecs.getincrementaldecoder(charset)(errors='ignore')
+
+    def feed(self, token: int) -> str:
+        """
+        Add a token to the text
+
+        @param token: the token
+        @return: the characters completed by the token (empty if they need the next tokens)
+        """
+        return self.decoder.decode(self.pieces.get(token))
+
+    def flush(self) -> str:
+        """
+        End the text, the bytes of an incomplete character are dropped
+
+        @return: the characters still to be returned
+        """
+        text = self.decoder.decode(b'', final=True)
+        self.decoder.reset()
+        return text
+
+    def reset(self) -> None:
+        self.decoder.reset()
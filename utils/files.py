@@ -0,0 +1,259 @@
+import os
+import re
+import sys
+import glob
+import mmap
+import fnmatch
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+INVALID_TEXT = 'FORMAT-ERROR: The content is not valid text'
+BINARY_TEXT = 'FORMAT-ERROR: The content is binary'
+OVERSIZED_TEXT = 'FORMAT-ERROR: The file is too large to be injected'
+
+MAX_FILE_SIZE = 1024 * 1024  # Bigger files are not injected
+MAX_FILES = 100  # Maximum number of files injected from a directory or a glob
+MMAP_THRESHOLD = 64 * 1024  # Bigger files are memory-mapped instead of read into a buffer
+BINARY_CHECK_SIZE = 8192  # A NUL byte in the first bytes means that the file is binary
+IGNORE_FILE = '.gitignore'
+DEFAULT_IGNORE_PATTERNS = (
+    '.*', '__pycache__', 'node_modules', 'venv', 'build', 'dist', '*.egg-info',
+    '*.pyc', '*.o', '*.so', '*.a', '*.dll', '*.exe', '*.gguf', '*.bin', '*.state', '*.llamaterm'
+)
+
+FILE_PATTERN = re.compile(r'\[([^\[\]]+)\]')
+FILE_EXTENSION_PATTERN = re.compile(r'\.(\w|\d){1,10}$')
+
+
+def is_path_pattern(target: str) -> bool:
+    """
+    Check if the text between square brackets is a file (`[main.py]`), a directory (`[src/]`) or a glob (`[src/**/*.py]`)
+
+    @param target: the text between the square brackets
+    @return: whether it should be injected
+    """
+    if '://' in target:  # Web pages are injected by `utils.web`
+        return False
+    has_extension = FILE_EXTENSION_PATTERN.search(target) is not None
+    if '*' in target or '?' in target:  # Not a glob without a path, e.g. `[is this right?]`
+        return '/' in target or os.sep in target or has_extension
+    return target.endswith('/') or has_extension
+
+
+def find_path_patterns(text: str) -> list[str]:
+    """
+    Find the files, directories and globs in square brackets
+
+    @param text: the text of the message
+    @return: the paths and patterns, in order
+    """
+    return [target for target in FILE_PATTERN.findall(text) if is_path_pattern(target)]
+
+
+def remove_path_patterns(text: str) -> str:
+    """
+    Remove the files, directories and globs in square brackets from a text
+
+    @param text: the text of the message
+    @return: the rest of the text
+    """
+    return FILE_PATTERN.sub(lambda match: ' ' if is_path_pattern(match.group(1)) else match.group(0), text)
+
+
+def load_ignore_patterns(directory: str) -> list[str]:
+    """
+    Get the ignore rules of a directory: the default ones and the simple patterns of its .gitignore
+
+    @param directory: the directory
+    @return: the glob patterns of the ignored names and relative paths
+    """
+    patterns = list(DEFAULT_IGNORE_PATTERNS)
+    try:
+        with open(os.path.join(directory, IGNORE_FILE), 'r') as f:
+            for line in f:
+                line = line.strip()
+                if len(line) > 0 and not line.startswith(('#', '!')):
+                    patterns.append(line.strip('/'))
+    except (OSError, UnicodeError):
+        pass
+
+    return patterns
+
+
+def is_ignored(relative_path: str, patterns: list[str]) -> bool:
+    """
+    Check if a path matches an ignore rule, by its name, one of its parent directories or its whole path
+
+    @param relative_path: the path relative to the injected directory
+    @param patterns: the ignore rules
+    @return: whether the path is ignored
+    """
+    parts = relative_path.split(os.sep)
+    return any(fnmatch.fnmatch(part, pattern) for part in parts for pattern in patterns) or \
+        any(fnmatch.fnmatch(relative_path, pattern) for pattern in patterns)
+
+
+def is_binary_file(file_path: str) -> bool:
+    """
+    Check if a file is binary by looking for a NUL byte in its first bytes
+
+    @param file_path: the path of the file
+    @return: whether the file is binary (or cannot be read)
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            return b'\0' in f.read(BINARY_CHECK_SIZE)
+    except OSError:
+        return True
+
+
+def expand_path_pattern(target: str, working_dir: str) -> list[str]:
+    """
+    Get the files of a file path, a directory (recursively) or a glob, skipping the ignored and the binary ones
+
+    @param target: the path or the pattern
+    @param working_dir: the directory of the relative paths
+    @return: the paths of the files, sorted (at most `MAX_FILES`)
+    """
+    full_target = target if os.path.isabs(target) else os.path.join(working_dir, target)
+    if os.path.isfile(full_target):
+        return [full_target]
+
+    if os.path.isdir(full_target):
+        root = full_target
+        paths = []
+        for dir_path, dir_names, file_names in os.walk(root):
+            dir_patterns = load_ignore_patterns(dir_path)
+            dir_names[:] = [name for name in dir_names if not is_ignored(name, dir_patterns)]
+            paths.extend(os.path.join(dir_path, name) for name in file_names)
+    else:
+        # The ignore rules are the ones of the directory before the first wildcard
+        root_parts = []
+        for part in full_target.split(os.sep):
+            if any(char in part for char in '*?['):
+                break
+            root_parts.append(part)
+        root = os.sep.join(root_parts) or os.sep
+        paths = [path for path in glob.glob(full_target, recursive=True) if os.path.isfile(path)]
+
+    patterns = load_ignore_patterns(root)
+    files = []
+    for path in sorted(paths):
+        if len(files) == MAX_FILES:
+            break
+        if not is_ignored(os.path.relpath(path, root), patterns) and not is_binary_file(path):
+            files.append(path)
+
+    return files
+
+
+def read_text_file(file_path: str, max_size: int | None = MAX_FILE_SIZE) -> str:
+    """
+    Read a UTF-8 text file, memory-mapping the big ones
+
+    @param file_path: the path of the file
+    @param max_size: the maximum size of the file in bytes (None for no limit, e.g. when only parts of it are injected)
+    @return: the text, without leading and trailing whitespace
+    @raises ValueError: if the file is binary or too large
+    @raises UnicodeError: if the file is not valid UTF-8
+    """
+    size = os.path.getsize(file_path)
+    if max_size is not None and size > max_size:
+        raise ValueError(OVERSIZED_TEXT)
+    if size == 0:
+        return ''
+
+    with open(file_path, 'rb') as f:
+        if size < MMAP_THRESHOLD:
+            data = f.read()
+            if b'\0' in data[:BINARY_CHECK_SIZE]:
+                raise ValueError(BINARY_TEXT)
+            text = data.decode('UTF-8')
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm.find(b'\0', 0, BINARY_CHECK_SIZE) >= 0:
+                    raise ValueError(BINARY_TEXT)
+                with memoryview(mm) as view:
+                    text = str(view, 'UTF-8')
+
+    return text.replace('\r\n', '\n').strip()
+
+
+def file_to_markdown(file_path: str, file_name: str | None = None) -> str:
+    """
+    Wrap the content of a text file in a markdown code block named after the file
+
+    @param file_path: the path of the file
+    @param file_name: the name shown to the model (the base name of the file if None)
+    @return: the markdown block
+    """
+    file_ext = os.path.splitext(file_path)[1][1:]
+    if file_name is None:
+        file_name = os.path.basename(file_path)
+
+    try:
+        text = read_text_file(file_path)
+    except UnicodeError:
+        print(f'[ERROR] "{file_path}" is not a valid text file', file=sys.stderr)
+        text = INVALID_TEXT
+    except ValueError as e:
+        print(f'[ERROR] "{file_path}" cannot be injected: {e}', file=sys.stderr)
+        text = str(e)
+
+    return f'Content of {file_name}:\n```{file_ext}\n{text}\n```'
+
+
+class FileCache:
+    """
+    LRU cache of the markdown of the injected files, keyed by the path and validated
+    with the modification time and the size, so an unchanged file is never read again.
+    The missing files are read concurrently on a thread pool.
+    """
+
+    def __init__(self, max_entries: int = 256, n_workers: int = 8) -> None:
+        """
+        Create a new file cache
+
+        @param max_entries: the maximum number of files kept
+        @param n_workers: the number of threads that read the files
+        """
+        self.max_entries = max_entries
+        self.n_workers = n_workers
+        self.entries: OrderedDict[tuple[str, str], tuple[tuple[int, int], str]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def markdown(self, files: list[tuple[str, str]]) -> list[str]:
+        """
+        Get the markdown blocks of several files, reading the ones not cached concurrently
+
+        @param files: the path and the name shown to the model of each file
+        @return: the markdown block of each file
+        """
+        versions = {}
+        missing = []
+        for key in files:
+            try:
+                stat = os.stat(key[0])
+                versions[key] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                versions[key] = (0, 0)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == versions[key]:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            elif key not in missing:
+                missing.append(key)
+                self.misses += 1
+
+        if len(missing) > 0:
+            with ThreadPoolExecutor(max_workers=min(self.n_workers, len(missing))) as executor:
+                blocks = list(executor.map(lambda key: file_to_markdown(*key), missing))
+            for key, block in zip(missing, blocks):
+                self.entries[key] = (versions[key], block)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        return [self.entries[key][1] if key in self.entries else file_to_markdown(*key) for key in files]
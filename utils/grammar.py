@@ -0,0 +1,122 @@
+import json
+import hashlib
+import threading
+import llama_cpp
+from collections import OrderedDict
+from llama_cpp import Llama, LlamaGrammar
+from llama_cpp.llama_grammar import JSON_GBNF, json_schema_to_gbnf
+
+
+class GrammarCache:
+    """
+    LRU cache of the compiled grammars, keyed by the hash of their JSON schema or GBNF source, so a schema
+    used again (the same `/json` file, the same API `response_format`) is not converted and checked again.
+    A JSON schema is hashed after removing its formatting, the order of the properties is kept because
+    the generated objects follow it. It can be used from several threads.
+    """
+
+    def __init__(self, model: Llama | None = None, max_entries: int = 32) -> None:
+        """
+        Create a new grammar cache
+
+        @param model: the model whose vocabulary is used to check the grammars (not checked if None)
+        @param max_entries: the maximum number of grammars kept
+        """
+        self.model = model
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, LlamaGrammar] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def from_json_schema(self, schema: str | dict) -> LlamaGrammar:
+        """
+        Get the grammar of the JSON values that follow a schema
+
+        @param schema: the JSON schema, as text or already parsed
+        @return: the grammar
+        @raises ValueError: if the schema is not valid or not supported
+        """
+        if isinstance(schema, str):
+            schema = json.loads(schema)  # json.JSONDecodeError is a ValueError
+        if not isinstance(schema, dict):
+            raise ValueError('a JSON schema must be an object')
+        schema_text = json.dumps(schema, separators=(',', ':'), ensure_ascii=False)
+
+        def compile_schema() -> str:
+            try:
+                return json_schema_to_gbnf(schema_text)
+            except (KeyError, TypeError, ValueError, AssertionError, NotImplementedError) as e:
+                raise ValueError(f'unsupported JSON schema: {e}')
+
+        return self._get('json:' + schema_text, compile_schema)
+
+    def from_gbnf(self, gbnf: str) -> LlamaGrammar:
+        """
+        Get the grammar of a GBNF source
+
+        @param gbnf: the GBNF source, its first rule is `root`
+        @return: the grammar
+        @raises ValueError: if the grammar is not valid
+        """
+        return self._get('gbnf:' + gbnf, lambda: gbnf)
+
+    def from_file(self, path: str) -> LlamaGrammar:
+        """
+        Get the grammar of a file: a GBNF grammar if its extension is `.gbnf`, a JSON schema otherwise
+
+        @param path: the path of the file
+        @return: the grammar
+        @raises OSError: if the file cannot be read
+        @raises ValueError: if the grammar or the schema is not valid
+        """
+        with open(path, 'r') as f:
+            source = f.read()
+
+        return self.from_gbnf(source) if path.endswith('.gbnf') else self.from_json_schema(source)
+
+    def any_json(self) -> LlamaGrammar:
+        return self.from_gbnf(JSON_GBNF)
+
+    def _get(self, source: str, compile_source) -> LlamaGrammar:
+        """
+        Get a cached grammar, compiling it if it is not cached
+
+        @param source: the text that identifies the grammar (its kind and its source)
+        @param compile_source: the function that returns the GBNF source of the grammar
+        @return: the grammar
+        @raises ValueError: if the grammar is not valid
+        """
+        key = hashlib.sha256(source.encode('UTF-8')).hexdigest()
+        with self.lock:
+            grammar = self.entries.get(key)
+            if grammar is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return grammar
+            self.misses += 1
+
+        gbnf = compile_source()
+        self._check(gbnf)
+        grammar = LlamaGrammar.from_string(gbnf, verbose=False)
+        with self.lock:
+            self.entries[key] = grammar
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        return grammar
+
+    def _check(self, gbnf: str) -> None:
+        """
+        Parse a grammar with llama.cpp, an invalid grammar would only fail when the reply is generated
+
+        @param gbnf: the GBNF source
+        @raises ValueError: if the grammar is not valid
+        """
+        if self.model is None or not hasattr(self.model, '_model'):  # The stub model does not use grammars
+            return
+        sampler = llama_cpp.llama_sampler_init_grammar(self.model._model.vocab, gbnf.encode('UTF-8'), b'root')
+        if not sampler:
+            raise ValueError('invalid grammar')
+        llama_cpp.llama_sampler_free(sampler)
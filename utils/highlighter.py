@@ -0,0 +1,145 @@
+import re
+import shutil
+import unicodedata
+import pygments
+from functools import lru_cache
+from typing import TextIO
+from pygments.lexer import Lexer
+from pygments.lexers import get_lexer_by_name
+from pygments.lexers.markup import MarkdownLexer
+from pygments.lexers.special import TextLexer
+from pygments.formatters import Terminal256Formatter
+from pygments.util import ClassNotFound
+from utils.output import OutputWriter
+
+
+FORMATTER = Terminal256Formatter(bg='dark')
+FENCE_PATTERN = re.compile(r'^\s*(```|~~~)\s*([\w+#.-]*)')
+
+
+@lru_cache(maxsize=None)
+def get_lexer(language: str) -> Lexer:
+    """
+    Get the lexer of a language, creating it only the first time
+
+    @param language: the name or alias of the language ('markdown' for plain replies)
+    @return: the lexer (plain text if the language is unknown)
+    """
+    if language == 'markdown':
+        return MarkdownLexer()
+    try:
+        return get_lexer_by_name(language)
+    except ClassNotFound:
+        return TextLexer()
+
+
+def highlight_markdown(text: str) -> str:
+    """
+    Highlight a whole markdown text
+
+    @param text: the text
+    @return: the text with the terminal color codes
+    """
+    return pygments.highlight(text, get_lexer('markdown'), FORMATTER)
+
+
+def display_width(text: str) -> int:
+    """
+    Get the number of terminal columns taken by a text without newlines
+
+    @param text: the text
+    @return: the number of columns
+    """
+    return sum(2 if unicodedata.east_asian_width(c) in ('W', 'F') else 1 for c in text if not unicodedata.combining(c))
+
+
+class StreamingHighlighter:
+    """
+    Highlight a markdown reply while it is being generated.
+    The unfinished line is written as plain text and, once it is complete, it is
+    redrawn highlighted with the markdown lexer or with the lexer of the fenced
+    code block it belongs to. Only the current line is ever highlighted again.
+    Flushing the output is up to the caller.
+    """
+
+    def __init__(self, out: TextIO | OutputWriter, column: int = 0) -> None:
+        """
+        Create a new streaming highlighter
+
+        @param out: the stream or the output writer where the reply is written
+        @param column: the terminal column where the reply starts (e.g. after the agent name)
+        """
+        self.out = out
+        self.redraw = out.isatty()
+        self.language = 'markdown'
+        self.line = ''
+        self.line_start_column = column
+        self.n_written = 0  # Characters of the current line already written as plain text
+
+    def write(self, text: str) -> None:
+        """
+        Write a chunk of the reply
+
+        @param text: the chunk
+        """
+        parts: list[str] = []
+        lines = text.split('\n')
+        for i, chunk in enumerate(lines):
+            self.line += chunk
+            if i < len(lines) - 1:
+                self._complete_line(parts)
+        if self.redraw and len(self.line) > self.n_written:
+            parts.append(self.line[self.n_written:])
+            self.n_written = len(self.line)
+
+        if len(parts) > 0:
+            self.out.write(''.join(parts))
+
+    def finish(self) -> None:
+        """
+        Write the unfinished line of the reply, if any, and end it with a newline
+        """
+        if len(self.line) > 0:
+            parts: list[str] = []
+            self._complete_line(parts)
+            self.out.write(''.join(parts))
+        self.language = 'markdown'
+
+    def _complete_line(self, parts: list[str]) -> None:
+        line = self.line
+        fence = FENCE_PATTERN.match(line)
+        if fence is not None and self.language == 'markdown':
+            highlighted = self._highlight(line, 'markdown')
+            self.language = fence.group(2).lower() or 'text'
+        elif fence is not None and fence.group(2) == '':
+            self.language = 'markdown'
+            highlighted = self._highlight(line, 'markdown')
+        else:
+            highlighted = self._highlight(line, self.language)
+
+        if self.redraw and self.n_written > 0:
+            parts.append(self._erase_line())
+        parts.append(highlighted)
+
+        self.line = ''
+        self.line_start_column = 0
+        self.n_written = 0
+
+    def _highlight(self, line: str, language: str) -> str:
+        highlighted = pygments.highlight(line + '\n', get_lexer(language), FORMATTER)
+        return highlighted if highlighted.endswith('\n') else highlighted + '\n'
+
+    def _erase_line(self) -> str:
+        """
+        Get the codes that move the cursor back to the start of the current line, wrapped rows included, and clear it
+        """
+        width = shutil.get_terminal_size().columns
+        end_column = self.line_start_column + display_width(self.line[:self.n_written])
+        rows_up = (end_column - 1) // width if end_column > 0 else 0
+        codes = '\r'
+        if rows_up > 0:
+            codes += f'\33[{rows_up}A'
+        if self.line_start_column > 0:
+            codes += f'\33[{self.line_start_column}C'
+
+        return codes + '\33[J'
@@ -1,7 +1,30 @@
 import requests
-from bs4 import BeautifulSoup, Comment
+from html.parser import HTMLParser
+try:
+    from lxml import etree  # Optional, its C parser is faster than the one of the standard library
+except ImportError:
+    etree = None
+
+
+class HTMLCleaner(HTMLParser):
+    """
+    Cleans HTML in a single pass while it is parsed, without building a tree: scripts, styles, media,
+    comments and attributes are removed, links are replaced with their text and the whitespace of each
+    text is collapsed. The events come from the lxml parser if it is installed, from `html.parser` otherwise.
+    """
+
+    REMOVED_TAGS = frozenset(('script', 'style', 'iframe', 'img', 'noscript', 'svg', 'template'))
+    UNWRAPPED_TAGS = frozenset(('a',))  # Replaced by their text
+    VOID_TAGS = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'))
+
+    session: requests.Session | None = None
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.parts: list[str] = []
+        self.open_tags: list[str] = []
+        self.removed_depth = 0  # The number of open removed tags, their content is skipped
 
-class HTMLCleaner:
     @classmethod
     def fetch_and_clean_html(cls, url: str) -> tuple[str, float]:
         """
@@ -11,81 +34,83 @@ class HTMLCleaner:
         @return: A tuple containing the cleaned HTML and the reduction percentage
         @raises Exception: If there's an error fetching the URL
         """
+        if cls.session is None:  # Reuse the connections between calls
+            cls.session = requests.Session()
         try:
-            response = requests.get(url)
+            response = cls.session.get(url)
             response.raise_for_status()
             original_html = response.text
-            original_length = len(original_html)
-
-            soup = BeautifulSoup(original_html, 'html.parser')
-
-            cls._remove_unwanted_elements(soup)
-            cls._remove_comments(soup)
-            cls._replace_links_with_text(soup)
-            cls._remove_attributes(soup)
-            cls._clean_text_nodes(soup)
-
-            cleaned_html = str(soup)
-            cleaned_length = len(cleaned_html)
-
-            reduction_percentage = cls._calculate_reduction(original_length, cleaned_length)
-
-            return cleaned_html, reduction_percentage
-
         except requests.RequestException as e:
             raise Exception(f"Error fetching the URL: {e}")
 
-    @staticmethod
-    def _remove_unwanted_elements(soup: BeautifulSoup) -> None:
-        """
-        Removes unwanted elements from the BeautifulSoup object.
-
-        @param soup: The BeautifulSoup object to clean
-        """
-        for element in soup(["script", "style", "iframe", "img"]):
-            element.decompose()
+        cleaned_html = cls.clean_html(original_html)
+        return cleaned_html, cls._calculate_reduction(len(original_html), len(cleaned_html))
 
-    @staticmethod
-    def _remove_comments(soup: BeautifulSoup) -> None:
-        """
-        Removes comments from the BeautifulSoup object.
-
-        @param soup: The BeautifulSoup object to clean
-        """
-        for comment in soup.find_all(text=lambda text: isinstance(text, Comment)):
-            comment.extract()
-
-    @staticmethod
-    def _replace_links_with_text(soup: BeautifulSoup) -> None:
-        """
-        Replaces link tags with their text content in the BeautifulSoup object.
-
-        @param soup: The BeautifulSoup object to clean
-        """
-        for a in soup.find_all('a'):
-            a.replace_with(a.get_text())
-
-    @staticmethod
-    def _remove_attributes(soup: BeautifulSoup) -> None:
+    @classmethod
+    def clean_html(cls, html: str) -> str:
         """
-        Removes all attributes from tags in the BeautifulSoup object.
+        Cleans HTML, the tags left open by the page are closed at the end
 
-        @param soup: The BeautifulSoup object to clean
+        @param html: The HTML to clean
+        @return: The cleaned HTML
         """
-        for tag in soup.find_all(True):
-            tag.attrs = {}
+        cleaner = cls()
+        if etree is None or not html.strip() or not cleaner._feed_lxml(html):
+            cleaner = cls()
+            cleaner.feed(html)
+            cleaner.close()
+        cleaner.parts.extend(f'</{tag}>' for tag in reversed(cleaner.open_tags))
+        return ''.join(cleaner.parts)
 
-    @classmethod
-    def _clean_text_nodes(cls, soup: BeautifulSoup) -> None:
+    def _feed_lxml(self, html: str) -> bool:
         """
-        Cleans text nodes in the BeautifulSoup object.
+        Parse the HTML with lxml
 
-        @param soup: The BeautifulSoup object to clean
+        @param html: The HTML to clean
+        @return: False if lxml could not parse it
         """
-        for element in soup.find_all(text=True):
-            if element.parent.name not in ['script', 'style']:
-                cleaned_text = cls._clean_text(str(element)) + '\n'
-                element.replace_with(cleaned_text)
+        parser = etree.HTMLParser(target=_LxmlTarget(self), remove_comments=True, remove_pis=True)
+        try:
+            parser.feed(html)
+            parser.close()
+        except etree.LxmlError:
+            return False
+        return True
+
+    def handle_starttag(self, tag: str, attrs) -> None:
+        if tag in self.REMOVED_TAGS:
+            if tag not in self.VOID_TAGS:
+                self.removed_depth += 1
+        elif self.removed_depth or tag in self.UNWRAPPED_TAGS:
+            return
+        elif tag in self.VOID_TAGS:
+            self.parts.append(f'<{tag}/>')
+        else:
+            self.parts.append(f'<{tag}>')
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag: str, attrs) -> None:
+        if not self.removed_depth and tag not in self.REMOVED_TAGS and tag not in self.UNWRAPPED_TAGS:
+            self.parts.append(f'<{tag}/>')
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in self.REMOVED_TAGS:
+            if tag not in self.VOID_TAGS and self.removed_depth:
+                self.removed_depth -= 1
+        elif self.removed_depth or tag in self.UNWRAPPED_TAGS or tag not in self.open_tags:
+            return
+        else:  # Close the tags left open inside this one
+            while True:
+                open_tag = self.open_tags.pop()
+                self.parts.append(f'</{open_tag}>')
+                if open_tag == tag:
+                    break
+
+    def handle_data(self, data: str) -> None:
+        if not self.removed_depth:
+            text = self._clean_text(data)
+            if text:
+                self.parts.append(text + '\n')
 
     @staticmethod
     def _clean_text(text: str) -> str:
@@ -109,3 +134,32 @@ class HTMLCleaner:
         if original_length == 0:
             return 0.0
         return ((original_length - cleaned_length) / original_length) * 100.0
+
+
+class _LxmlTarget:
+    """
+    Forwards the events of the lxml parser to a cleaner, the text split around entities is joined again
+    """
+
+    def __init__(self, cleaner: HTMLCleaner) -> None:
+        self.cleaner = cleaner
+        self.text: list[str] = []
+
+    def start(self, tag: str, attrib) -> None:
+        self._flush()
+        self.cleaner.handle_starttag(tag, attrib)
+
+    def end(self, tag: str) -> None:
+        self._flush()
+        self.cleaner.handle_endtag(tag)
+
+    def data(self, data: str) -> None:
+        self.text.append(data)
+
+    def close(self) -> None:
+        self._flush()
+
+    def _flush(self) -> None:
+        if self.text:
+            self.cleaner.handle_data(''.join(self.text))
+            self.text = []
@@ -0,0 +1,131 @@
+import json
+import time
+from collections.abc import Callable
+from contextlib import contextmanager
+
+
+class StageStats:
+    __slots__ = ('calls', 'seconds', 'tokens')
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.seconds = 0.0
+        self.tokens = 0
+
+    def add(self, seconds: float, n_tokens: int) -> None:
+        self.calls += 1
+        self.seconds += seconds
+        self.tokens += n_tokens
+
+    def to_dict(self) -> dict:
+        return {'calls': self.calls, 'seconds': self.seconds, 'tokens': self.tokens}
+
+
+class Instrumentation:
+    """
+    Timing hooks for the stages of a chat turn. Every measurement is added to the
+    current turn and to the cumulative stats, and is forwarded to the listeners
+    as `listener(stage, seconds, n_tokens)`.
+    """
+
+    INJECT = 'inject'
+    TOKENIZE = 'tokenize'
+    PREFILL = 'prefill'
+    DECODE = 'decode'
+    STOP_CHECK = 'stop_check'
+    RENDER = 'render'
+    STAGES = (INJECT, TOKENIZE, PREFILL, DECODE, STOP_CHECK, RENDER)
+    THROUGHPUT_STAGES = (PREFILL, DECODE)
+
+    def __init__(self, log_path: str = '') -> None:
+        """
+        Create new instrumentation hooks
+
+        @param log_path: the JSON lines file to which the stats of each turn are appended (disabled if empty)
+        """
+        self.log_path = log_path
+        self.listeners: list[Callable[[str, float, int], None]] = []
+        self.turn = self._empty_stats()
+        self.last_turn = self._empty_stats()
+        self.total = self._empty_stats()
+        self.n_turns = 0
+
+    def add_listener(self, listener: Callable[[str, float, int], None]) -> None:
+        """
+        Register a callback called after each measurement
+
+        @param listener: the callback, it receives the stage, the seconds spent and the tokens processed
+        """
+        self.listeners.append(listener)
+
+    def record(self, stage: str, seconds: float, n_tokens: int = 0) -> None:
+        """
+        Record the time spent in a stage
+
+        @param stage: the stage measured (one of STAGES)
+        @param seconds: the time spent
+        @param n_tokens: the number of tokens processed
+        """
+        self.turn[stage].add(seconds, n_tokens)
+        self.total[stage].add(seconds, n_tokens)
+        for listener in self.listeners:
+            listener(stage, seconds, n_tokens)
+
+    @contextmanager
+    def measure(self, stage: str, n_tokens: int = 0):
+        """
+        Record the time spent in the body of a `with` block
+
+        @param stage: the stage measured (one of STAGES)
+        @param n_tokens: the number of tokens processed
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start_time, n_tokens)
+
+    def end_turn(self) -> None:
+        """
+        Close the current turn and append its stats to the log file, if any
+        """
+        self.n_turns += 1
+        self.last_turn = self.turn
+        self.turn = self._empty_stats()
+
+        if self.log_path:
+            entry = {'turn': self.n_turns, 'time': time.time(), 'stages': self.to_dict(self.last_turn)}
+            try:
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+            except OSError as e:
+                print(f'[ERROR] Cannot write the stats to "{self.log_path}": {e}')
+
+    def format(self, stats: dict[str, StageStats]) -> list[str]:
+        """
+        Format a breakdown of the stats, one line per stage that was measured
+
+        @param stats: the stats of each stage
+        @return: the lines of the breakdown
+        """
+        total_seconds = sum(stage.seconds for stage in stats.values())
+        lines = []
+        for name, stage in stats.items():
+            if stage.calls == 0:
+                continue
+            line = f'{name:<10} {stage.seconds * 1000:10.1f}ms {stage.seconds / total_seconds * 100 if total_seconds > 0 else 0:5.1f}%'
+            if stage.tokens > 0:
+                line += f' {stage.tokens:7} tokens'
+            if name in self.THROUGHPUT_STAGES and stage.seconds > 0:
+                line += f' ({stage.tokens / stage.seconds:.1f} tokens/s)'
+            lines.append(line)
+
+        return lines
+
+    @staticmethod
+    def to_dict(stats: dict[str, StageStats]) -> dict:
+        return {name: stage.to_dict() for name, stage in stats.items() if stage.calls > 0}
+
+    @classmethod
+    def _empty_stats(cls) -> dict[str, StageStats]:
+        return {stage: StageStats() for stage in cls.STAGES}
@@ -0,0 +1,104 @@
+import ctypes
+from llama_cpp import Llama, llama_log_set
+from utils.chat import Chat
+from utils.config import Config
+from utils.instrumentation import Instrumentation
+from utils.prompt_cache import PromptCache
+from utils.response_cache import ResponseCache, model_identity
+from utils.speculative import create_draft_model
+from utils.tuner import KV_CACHE_TYPES
+
+
+def disable_llama_logs() -> None:
+    """
+    Disable llama.cpp verbose output
+    """
+    global _log_callback  # Keep a reference, llama.cpp calls it until the end of the program
+    _log_callback = ctypes.CFUNCTYPE(None, ctypes.c_int, ctypes.c_char_p, ctypes.c_void_p)(lambda level, message, user_data: None)
+    llama_log_set(_log_callback, ctypes.c_void_p())
+
+
+def load_model(config: Config, verbose: bool = False, **overrides) -> Llama:
+    """
+    Load the model described by the settings
+
+    @param config: the settings
+    @param verbose: whether llama.cpp should print its logs
+    @param overrides: arguments passed to `Llama` instead of the ones from the settings
+    @return: the llama object that represents the model
+    @raises ValueError: if the model cannot be loaded
+    """
+    params = dict(
+        model_path=config.model_path,
+        seed=config.seed,
+        use_mlock=config.use_mlock,
+        use_mmap=config.use_mmap,
+        n_ctx=config.n_ctx,
+        n_gpu_layers=-1 if config.use_gpu else 0,
+        n_threads=config.n_threads or None,  # None for the defaults of llama-cpp-python
+        n_threads_batch=config.n_threads_batch or None,
+        n_batch=config.n_batch,
+        n_ubatch=config.n_ubatch,
+        flash_attn=config.flash_attn,
+        type_k=KV_CACHE_TYPES[config.type_k],
+        type_v=KV_CACHE_TYPES[config.type_v],
+        verbose=verbose
+    )
+    params.update(overrides)
+    if 'draft_model' not in params:
+        params['draft_model'] = create_draft_model(config.draft_mode, config.draft_tokens, config.draft_model_path, config.n_ctx, config.use_gpu)
+
+    return Llama(**params)
+
+
+def create_prompt_cache(config: Config, directory: str | None = None) -> PromptCache:
+    """
+    Open the prompt cache described by the settings
+
+    @param config: the settings
+    @param directory: the directory of the cache (`PROMPT_CACHE_DIR` if None)
+    @return: the prompt cache of the model and of its context settings
+    """
+    context_id = f'{model_identity(config.model_path)}|n_ctx={config.n_ctx}|type_k={config.type_k}|type_v={config.type_v}|flash_attn={config.flash_attn}'
+    return PromptCache(directory or config.prompt_cache_dir, config.prompt_cache_size * 1024 * 1024, context_id)
+
+
+def create_response_cache(config: Config) -> ResponseCache:
+    """
+    Open the response cache described by the settings
+
+    @param config: the settings
+    @return: the response cache of the model
+    """
+    return ResponseCache(config.response_cache_file, config.response_cache_size * 1024 * 1024, model_identity(config.model_path), config.seed)
+
+
+def create_chat(config: Config, model: Llama, debug: bool = False, **overrides) -> Chat:
+    """
+    Create a chat with the template and sampling settings
+
+    @param config: the settings
+    @param model: the llama object that represents the model
+    @param debug: whether or not to output debug informations
+    @param overrides: arguments passed to `Chat` instead of the ones from the settings
+    @return: the chat
+    """
+    params = dict(
+        model=model,
+        agent_prefixes=config.agent_prefixes(),
+        agent_names=config.agent_names(),
+        bot=config.bot,
+        eos=config.eos,
+        n_generate=config.n_generate,
+        temperature=config.temperature,
+        top_p=config.top_p,
+        top_k=config.top_k,
+        prompt_cache=create_prompt_cache(config) if config.prompt_cache_dir else None,
+        response_cache=create_response_cache(config) if config.response_cache_file else None,
+        context_policy=config.context_policy,
+        instrumentation=Instrumentation(config.stats_file),
+        debug=debug
+    )
+    params.update(overrides)
+
+    return Chat(**params)
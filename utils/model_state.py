@@ -0,0 +1,99 @@
+import ctypes
+import struct
+from array import array
+from typing import BinaryIO
+import llama_cpp
+from llama_cpp import Llama
+
+
+class ModelState:
+    """
+    Snapshot of the evaluated tokens and the KV cache of a model.
+    Unlike `Llama.save_state()` it does not copy the logits buffer, so it stays
+    roughly as big as the KV cache of the evaluated tokens.
+    """
+
+    HEADER = struct.Struct('<QQ')
+
+    def __init__(self, tokens: array, data: bytes) -> None:
+        """
+        Create a new model state
+
+        @param tokens: the tokens evaluated by the model
+        @param data: the raw llama.cpp state (KV cache included)
+        """
+        self.tokens = tokens
+        self.data = data
+
+    @classmethod
+    def capture(cls, model: Llama) -> 'ModelState':
+        """
+        Take a snapshot of the current state of the model
+
+        @param model: the llama object that represents the model
+        @return: the model state
+        """
+        ctx = model._ctx.ctx
+        state_size = llama_cpp.llama_state_get_size(ctx)
+        buffer = (ctypes.c_uint8 * state_size)()
+        n_bytes = llama_cpp.llama_state_get_data(ctx, buffer, state_size)
+
+        tokens = array('i', model.input_ids[:model.n_tokens].tolist())
+        return cls(tokens, ctypes.string_at(buffer, n_bytes))
+
+    def restore(self, model: Llama) -> None:
+        """
+        Load the snapshot into the model, replacing its current state
+
+        @param model: the llama object that represents the model
+        """
+        n_bytes = len(self.data)
+        buffer = (ctypes.c_uint8 * n_bytes).from_buffer_copy(self.data)
+        if llama_cpp.llama_state_set_data(model._ctx.ctx, buffer, n_bytes) != n_bytes:
+            raise RuntimeError('failed to restore the model state')
+
+        n_tokens = len(self.tokens)
+        model.input_ids[:n_tokens] = self.tokens
+        model.n_tokens = n_tokens
+        model._requires_eval = True  # The logits are not part of the snapshot
+
+    def size(self) -> int:
+        """
+        Get the size of the snapshot
+
+        @return: the size in bytes
+        """
+        return len(self.data) + len(self.tokens) * self.tokens.itemsize
+
+    def write(self, f: BinaryIO) -> None:
+        """
+        Serialize the snapshot to a binary file
+
+        @param f: the file opened for writing
+        """
+        f.write(self.HEADER.pack(len(self.tokens), len(self.data)))
+        f.write(self.tokens.tobytes())
+        f.write(self.data)
+
+    @classmethod
+    def read(cls, f: BinaryIO) -> 'ModelState':
+        """
+        Deserialize a snapshot from a binary file
+
+        @param f: the file opened for reading
+        @return: the model state
+        @raises ValueError: if the file is truncated
+        """
+        header = f.read(cls.HEADER.size)
+        if len(header) != cls.HEADER.size:
+            raise ValueError('truncated model state')
+        n_tokens, n_bytes = cls.HEADER.unpack(header)
+
+        tokens = array('i')
+        tokens_data = f.read(n_tokens * tokens.itemsize)
+        data = f.read(n_bytes)
+        if len(tokens_data) != n_tokens * tokens.itemsize or len(data) != n_bytes:
+            raise ValueError('truncated model state')
+        tokens.frombytes(tokens_data)
+
+        return cls(tokens, data)
@@ -0,0 +1,124 @@
+import time
+import threading
+from typing import TextIO
+
+
+class OutputWriter:
+    """
+    Buffer between the token stream and an output stream: the text is written
+    in large chunks instead of one write and flush per token
+    """
+
+    def __init__(self, out: TextIO, max_buffered: int) -> None:
+        """
+        Create a new output writer
+
+        @param out: the stream where the text is written
+        @param max_buffered: the number of buffered characters that triggers a write
+        """
+        self.out = out
+        self.max_buffered = max_buffered
+        self.buffer: list[str] = []
+        self.n_buffered = 0
+
+    def isatty(self) -> bool:
+        return self.out.isatty()
+
+    def write(self, text: str) -> None:
+        """
+        Buffer some text, writing the buffer if it is full
+
+        @param text: the text
+        """
+        self.buffer.append(text)
+        self.n_buffered += len(text)
+        if self.n_buffered >= self.max_buffered:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write all the buffered text
+        """
+        if self.n_buffered > 0:
+            self.out.write(''.join(self.buffer))
+            self.buffer.clear()
+            self.n_buffered = 0
+        self.out.flush()
+
+    def close(self) -> None:
+        """
+        Write all the buffered text, the writer is not used afterwards
+        """
+        self.flush()
+
+
+class FrameWriter(OutputWriter):
+    """
+    Output writer for terminals: the buffered text is written at most once per
+    frame, or earlier if too much text is waiting. A background thread writes the
+    text still buffered at the end of its frame, so it shows up even when no more
+    text arrives (e.g. the model stalls in the middle of a reply).
+    """
+
+    def __init__(self, out: TextIO, fps: int = 30, max_buffered: int = 4096) -> None:
+        """
+        Create a new frame writer
+
+        @param out: the terminal where the text is written
+        @param fps: the maximum number of writes per second
+        @param max_buffered: the number of buffered characters that triggers a write before the end of the frame
+        """
+        super().__init__(out, max_buffered)
+        self.frame_time = 1 / fps
+        self.last_write_time = 0.0
+        self.lock = threading.Lock()
+        self.pending = threading.Event()  # Set while some text waits for the end of its frame
+        self.closed = False
+        self.flusher = threading.Thread(target=self._flush_frames, name='frame-writer', daemon=True)
+        self.flusher.start()
+
+    def write(self, text: str) -> None:
+        with self.lock:
+            self.buffer.append(text)
+            self.n_buffered += len(text)
+            if self.n_buffered >= self.max_buffered or time.perf_counter() - self.last_write_time >= self.frame_time:
+                self._write_frame()
+            else:
+                self.pending.set()
+
+    def flush(self) -> None:
+        with self.lock:
+            self._write_frame()
+
+    def close(self) -> None:
+        self.flush()
+        self.closed = True
+        self.pending.set()
+        self.flusher.join()
+
+    def _write_frame(self) -> None:
+        super().flush()
+        self.last_write_time = time.perf_counter()
+        self.pending.clear()
+
+    def _flush_frames(self) -> None:
+        while self.pending.wait() and not self.closed:
+            with self.lock:
+                delay = self.last_write_time + self.frame_time - time.perf_counter()
+                if delay <= 0:
+                    self._write_frame()
+                    continue
+            time.sleep(delay)
+
+
+def create_writer(out: TextIO) -> OutputWriter:
+    """
+    Create the output writer that suits a stream: frames for terminals, large writes for pipes and files
+
+    @param out: the stream where the text is written
+    @return: the output writer
+    """
+    if out.isatty():
+        return FrameWriter(out)
+
+    return OutputWriter(out, max_buffered=64 * 1024)
@@ -0,0 +1,285 @@
+import llama_cpp
+from collections.abc import Sequence
+from llama_cpp import Llama, LlamaGrammar
+from llama_cpp._internals import LlamaBatch, LlamaContext, LlamaSampler
+from utils.chat import Chat
+from utils.detokenizer import StreamingDetokenizer, TokenPieces
+from utils.response_cache import RANDOM_SEEDS
+from utils.stop_matcher import StopSequenceMatcher
+
+
+class ParallelReply:
+    __slots__ = ('tokens', 'text', 'stop_sequence')
+
+    def __init__(self, tokens: list[int], text: str, stop_sequence: str | None) -> None:
+        """
+        Create a new reply of a parallel generation
+
+        @param tokens: the generated tokens, up to the stop sequence
+        @param text: the generated text, up to the stop sequence
+        @param stop_sequence: the stop sequence that ended the reply, if any
+        """
+        self.tokens = tokens
+        self.text = text
+        self.stop_sequence = stop_sequence
+
+
+class _Sequence:
+    __slots__ = ('seq_id', 'n_past', 'tokens', 'parts', 'sampler', 'matcher', 'detokenizer', 'stop_sequence', 'done')
+
+    def __init__(self, seq_id: int, n_past: int, sampler: LlamaSampler, matcher: StopSequenceMatcher, detokenizer: StreamingDetokenizer) -> None:
+        self.seq_id = seq_id
+        self.n_past = n_past
+        self.tokens: list[int] = []
+        self.parts: list[str] = []
+        self.sampler = sampler
+        self.matcher = matcher
+        self.detokenizer = detokenizer
+        self.stop_sequence: str | None = None
+        self.done = False
+
+
+class ParallelDecoder:
+    """
+    Decode several independent sequences in the same llama.cpp batches, each one with its own
+    sequence id. It owns a second llama.cpp context that shares the weights of the model.
+    The prompt prefix shared by all the sequences is evaluated once and its KV cache cells
+    are shared (unified KV cache), then every step decodes one token for each sequence.
+    """
+
+    MIN_P = 0.05  # Same default as `Llama.generate`
+
+    def __init__(self, model: Llama, n_seq: int, n_ctx: int = 0, n_batch: int = 512) -> None:
+        """
+        Create a new parallel decoder
+
+        @param model: the llama object whose weights and settings are used
+        @param n_seq: the maximum number of sequences decoded together
+        @param n_ctx: the context shared by all the sequences (0 for the context of the model times `n_seq`)
+        @param n_batch: the maximum number of tokens evaluated in a single llama.cpp batch
+        """
+        self.model = model
+        self.n_seq = n_seq
+        self.n_batch = n_batch
+        self.n_evaluated = 0  # Prompt tokens evaluated by the last generation
+        self.pieces = TokenPieces(model)
+
+        params = llama_cpp.llama_context_params.from_buffer_copy(model.context_params)
+        params.n_ctx = n_ctx if n_ctx > 0 else model.n_ctx() * n_seq
+        params.n_batch = n_batch
+        params.n_ubatch = min(params.n_ubatch, n_batch)
+        params.n_seq_max = n_seq
+        params.kv_unified = True  # Needed to share the cells of the common prefix
+        params.embeddings = False
+        self.ctx = LlamaContext(model=model._model, params=params, verbose=model.verbose)
+        self.batch = LlamaBatch(n_tokens=n_batch, embd=0, n_seq_max=n_seq, verbose=model.verbose)
+
+    def n_ctx(self) -> int:
+        return self.ctx.n_ctx()
+
+    def generate(
+            self,
+            prompts: Sequence[Sequence[int]],
+            n_generate: int,
+            temperature: float = 0.8,
+            top_p: float = 0.9,
+            top_k: int = 40,
+            stop_tokens: Sequence[int] = (),
+            stop_sequences: Sequence[str] = (),
+            seed: int = 0,
+            grammar: LlamaGrammar | None = None
+    ) -> list[ParallelReply]:
+        """
+        Generate a reply for each prompt, decoding all of them together
+
+        @param prompts: the prompt tokens of each sequence (at most `n_seq`)
+        @param n_generate: the maximum number of tokens generated for each sequence
+        @param temperature: the temperature used for sampling (0 for greedy sampling)
+        @param top_p: the top_p used for sampling
+        @param top_k: the top_k used for sampling
+        @param stop_tokens: the tokens that end a reply (besides the EOS of the model)
+        @param stop_sequences: the texts that end a reply, they are not part of it
+        @param seed: the seed of the first sequence, the next ones use the following seeds (a random seed stays random for all of them)
+        @param grammar: the grammar that constrains every reply, if any
+        @return: the reply of each prompt
+        @raises ValueError: if there are too many prompts or one is empty
+        """
+        if len(prompts) > self.n_seq:
+            raise ValueError(f'at most {self.n_seq} sequences can be decoded together')
+        if any(len(prompt) == 0 for prompt in prompts):
+            raise ValueError('the prompts cannot be empty')
+
+        self.ctx.kv_cache_clear()
+        stop_tokens = {self.model.token_eos(), *stop_tokens}
+        sequences = [
+            _Sequence(seq_id, 0, self._create_sampler(temperature, top_p, top_k, llama_cpp.LLAMA_DEFAULT_SEED if seed in RANDOM_SEEDS else seed + seq_id, grammar), StopSequenceMatcher(list(stop_sequences)), StreamingDetokenizer(self.pieces, Chat.CHARSET))
+            for seq_id in range(len(prompts))
+        ]
+
+        # Evaluate the common prefix once for all the sequences, every sequence keeps at least its last token
+        n_prefix = 0
+        max_prefix = min(len(prompt) for prompt in prompts) - 1
+        while n_prefix < max_prefix and all(prompt[n_prefix] == prompts[0][n_prefix] for prompt in prompts):
+            n_prefix += 1
+        all_ids = tuple(range(len(prompts)))
+        entries = [(prompts[0][pos], pos, all_ids, None) for pos in range(n_prefix)]
+
+        # Evaluate the rest of each prompt and sample the first token from its last position
+        for seq, prompt in zip(sequences, prompts):
+            entries.extend((prompt[pos], pos, (seq.seq_id,), seq if pos == len(prompt) - 1 else None) for pos in range(n_prefix, len(prompt)))
+            seq.n_past = len(prompt)
+
+        self.n_evaluated = len(entries)
+        while len(entries) > 0:
+            try:
+                self._decode(entries, n_generate, stop_tokens)
+            except RuntimeError:  # The KV cache is full
+                for seq in sequences:
+                    seq.done = True
+
+            # Decode the last sampled token of each unfinished sequence
+            entries = []
+            for seq in sequences:
+                if seq.done or seq.n_past >= self.n_ctx():
+                    if not seq.done:
+                        self._finish(seq)
+                    continue
+                entries.append((seq.tokens[-1], seq.n_past, (seq.seq_id,), seq))
+                seq.n_past += 1
+
+        return [ParallelReply(seq.tokens, ''.join(seq.parts), seq.stop_sequence) for seq in sequences]
+
+    def _decode(self, entries: list[tuple[int, int, tuple[int, ...], _Sequence | None]], n_generate: int, stop_tokens: set[int]) -> None:
+        """
+        Evaluate tokens in batches of at most `n_batch` and sample the next token of the
+        sequences whose entry asks for it (the logits are gone after the next batch)
+
+        @param entries: the token, its position, its sequence ids and the sequence to sample for (or None)
+        @param n_generate: the maximum number of tokens generated for each sequence
+        @param stop_tokens: the tokens that end a reply
+        """
+        batch = self.batch.batch
+        for start in range(0, len(entries), self.n_batch):
+            chunk = entries[start:start + self.n_batch]
+            for i, (token, pos, seq_ids, seq) in enumerate(chunk):
+                batch.token[i] = token
+                batch.pos[i] = pos
+                batch.n_seq_id[i] = len(seq_ids)
+                for j, seq_id in enumerate(seq_ids):
+                    batch.seq_id[i][j] = seq_id
+                batch.logits[i] = seq is not None
+            batch.n_tokens = len(chunk)
+            self.ctx.decode(self.batch)
+
+            for i, (_, _, _, seq) in enumerate(chunk):
+                if seq is not None:
+                    self._sample(seq, i, n_generate, stop_tokens)
+
+    def _sample(self, seq: _Sequence, index: int, n_generate: int, stop_tokens: set[int]) -> None:
+        token = seq.sampler.sample(self.ctx, index)  # llama.cpp also accepts the token (a second accept would break a grammar)
+        if token in stop_tokens:
+            self._finish(seq)
+            return
+
+        seq.tokens.append(token)
+        text = seq.detokenizer.feed(token)  # Same as `Chat.stream_reply`
+        seq.parts.append(text)
+
+        # Roll back the tokens of a stop sequence, like `Chat.stream_reply` does
+        stop = seq.matcher.feed(text)
+        if stop is not None:
+            reply = ''.join(seq.parts)[:stop.start]
+            n_stop_chars = seq.matcher.position - stop.start
+            while n_stop_chars > 0 and len(seq.parts) > 0:
+                n_stop_chars -= len(seq.parts.pop())
+                seq.tokens.pop()
+            seq.parts = [reply]
+            seq.stop_sequence = stop.sequence
+            self._finish(seq)
+        elif len(seq.tokens) >= n_generate:
+            self._finish(seq)
+
+    def _finish(self, seq: _Sequence) -> None:
+        seq.done = True
+        self.ctx.kv_cache_seq_rm(seq.seq_id, -1, -1)  # Free its cells, the shared ones stay for the others
+
+    def _create_sampler(self, temperature: float, top_p: float, top_k: int, seed: int, grammar: LlamaGrammar | None = None) -> LlamaSampler:
+        sampler = LlamaSampler()
+        if grammar is not None:  # Each sequence has its own grammar state
+            sampler.add_grammar(self.model._model, grammar)
+        if temperature == 0:
+            sampler.add_greedy()
+        else:
+            sampler.add_top_k(top_k)
+            sampler.add_top_p(top_p, 1)
+            sampler.add_min_p(self.MIN_P, 1)
+            sampler.add_temp(temperature)
+            sampler.add_dist(seed)
+
+        return sampler
+
+
+def generate_replies(decoder: ParallelDecoder, chats: Sequence[Chat], seed: int = 0, grammar: LlamaGrammar | None = None) -> list[str]:
+    """
+    Generate the next assistant reply of several chats together, like `Chat.generate_assistant_reply`.
+    The chats must use the same model and they share the sampling settings of the first one.
+
+    @param decoder: the parallel decoder
+    @param chats: the chats (at most `decoder.n_seq`)
+    @param seed: the seed of the first chat, the next ones use the following seeds
+    @param grammar: the grammar that constrains the replies, if any
+    @return: the reply of each chat
+    """
+    reply_offsets = []
+    for chat in chats:
+        chat.make_room(chat.n_generate)
+        reply_offsets.append(chat.tokens_used())
+        chat.cache_append_header(agent=Chat.ASSISTANT_KEY)
+
+    first = chats[0]
+    replies = decoder.generate(
+        [chat.tokens_cache for chat in chats],
+        n_generate=first.n_generate,
+        temperature=first.temperature,
+        top_p=first.top_p,
+        top_k=first.top_k,
+        stop_tokens=[first.eos_token],
+        stop_sequences=[first.eos, *first.agent_prefixes.values()],
+        seed=seed,
+        grammar=grammar
+    )
+
+    messages = []
+    for chat, reply_offset, reply in zip(chats, reply_offsets, replies):
+        chat.tokens_cache.extend(reply.tokens)
+        messages.append(chat.add_reply(reply.text, reply_offset, reply.stop_sequence).content)
+
+    return messages
+
+
+def sample_replies(decoder: ParallelDecoder, chat: Chat, n: int, seed: int = 0, grammar: LlamaGrammar | None = None) -> list[str]:
+    """
+    Sample `n` candidates for the next assistant reply of a chat (best-of-n), decoding them together.
+    The prompt is evaluated once and the chat is not modified.
+
+    @param decoder: the parallel decoder
+    @param chat: the chat
+    @param n: the number of candidates (at most `decoder.n_seq`)
+    @param seed: the seed of the first candidate, the next ones use the following seeds
+    @param grammar: the grammar that constrains the candidates, if any
+    @return: the candidates
+    """
+    prompt = list(chat.tokens_cache) + chat.header_tokens[Chat.ASSISTANT_KEY]
+    replies = decoder.generate(
+        [prompt] * n,
+        n_generate=chat.n_generate,
+        temperature=chat.temperature,
+        top_p=chat.top_p,
+        top_k=chat.top_k,
+        stop_tokens=[chat.eos_token],
+        stop_sequences=[chat.eos, *chat.agent_prefixes.values()],
+        seed=seed,
+        grammar=grammar
+    )
+
+    return [reply.text if reply.stop_sequence in (None, chat.eos) else reply.text.strip() for reply in replies]
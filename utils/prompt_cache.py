@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import struct
+import hashlib
+from array import array
+from collections.abc import Sequence
+from utils.model_state import ModelState
+
+
+class PromptCache:
+    """
+    Disk-backed cache of model states keyed by the token prefix that produced them and by the model
+    (file and KV cache settings) they belong to, a state can only be restored into the same model.
+    Entries are evicted in LRU order once the cache grows over its size cap.
+    """
+
+    INDEX_FILE = 'index.json'
+    STATE_EXT = '.state'
+
+    def __init__(self, directory: str, max_size: int, model_id: str = '') -> None:
+        """
+        Open (or create) a prompt cache
+
+        @param directory: the directory where the states are stored
+        @param max_size: the maximum total size of the cache in bytes
+        @param model_id: the identity of the model and of its context settings (see `model_identity`)
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.model_id = model_id
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.index: dict[str, dict] = {}
+        index_path = os.path.join(self.directory, self.INDEX_FILE)
+        if os.path.isfile(index_path):
+            try:
+                with open(index_path, 'r') as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError):
+                self.index = {}
+
+        # Forget entries whose state file went missing
+        self.index = {key: entry for key, entry in self.index.items() if os.path.isfile(self._state_path(key))}
+
+    def lookup(self, tokens: Sequence[int]) -> ModelState | None:
+        """
+        Find the state of the longest cached prefix of the tokens
+
+        @param tokens: the tokens of the prompt
+        @return: the cached model state, if any
+        """
+        lengths = sorted({entry['n_tokens'] for entry in self.index.values() if entry['n_tokens'] <= len(tokens)}, reverse=True)
+        for n_tokens in lengths:
+            key = self.prefix_key(tokens[:n_tokens])
+            if key not in self.index:
+                continue
+
+            try:
+                with open(self._state_path(key), 'rb') as f:
+                    state = ModelState.read(f)
+            except (OSError, ValueError, struct.error):
+                # Missing or corrupt state file
+                self.remove(tokens[:n_tokens])
+                continue
+
+            self.index[key]['last_used'] = time.time()
+            self._save_index()
+            return state
+
+        return None
+
+    def remove(self, tokens: Sequence[int]) -> None:
+        """
+        Remove the state of a prefix, e.g. because it could not be restored
+
+        @param tokens: the tokens of the prefix
+        """
+        key = self.prefix_key(tokens)
+        if self.index.pop(key, None) is None:
+            return
+        try:
+            os.remove(self._state_path(key))
+        except OSError:
+            pass
+        self._save_index()
+
+    def store(self, state: ModelState) -> None:
+        """
+        Store a model state, keyed by the tokens it evaluated
+
+        @param state: the model state
+        """
+        key = self.prefix_key(state.tokens)
+        tmp_path = self._state_path(key) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            state.write(f)
+        os.replace(tmp_path, self._state_path(key))
+
+        self.index[key] = {
+            'n_tokens': len(state.tokens),
+            'size': os.path.getsize(self._state_path(key)),
+            'last_used': time.time()
+        }
+        self._evict()
+        self._save_index()
+
+    def size(self) -> int:
+        """
+        Get the total size of the cached states
+
+        @return: the size in bytes
+        """
+        return sum(entry['size'] for entry in self.index.values())
+
+    def prefix_key(self, tokens: Sequence[int]) -> str:
+        """
+        Hash a token prefix evaluated by the model of the cache
+
+        @param tokens: the tokens of the prefix
+        @return: the hex digest that identifies the prefix
+        """
+        digest = hashlib.sha256(array('i', tokens).tobytes())
+        digest.update(self.model_id.encode('UTF-8'))
+        return digest.hexdigest()
+
+    def _evict(self) -> None:
+        total_size = self.size()
+        for key in sorted(self.index, key=lambda k: self.index[k]['last_used']):
+            if total_size <= self.max_size:
+                break
+            total_size -= self.index.pop(key)['size']
+            try:
+                os.remove(self._state_path(key))
+            except OSError:
+                pass
+
+    def _save_index(self) -> None:
+        index_path = os.path.join(self.directory, self.INDEX_FILE)
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, index_path)
+
+    def _state_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.STATE_EXT)
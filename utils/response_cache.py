@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from collections.abc import Sequence
+
+
+RANDOM_SEEDS = (-1, 0, 0xFFFFFFFF)  # llama.cpp picks a new seed for each model (llama-cpp-python maps 0 to the default seed)
+
+
+def model_identity(model_path: str) -> str:
+    """
+    Identify a model file, so that the replies of a replaced model are not reused
+
+    @param model_path: the path of the model file
+    @return: its absolute path, size and modification time
+    """
+    try:
+        stat = os.stat(model_path)
+        return f'{os.path.abspath(model_path)}|{stat.st_size}|{stat.st_mtime_ns}'
+    except OSError:
+        return os.path.abspath(model_path)
+
+
+class ResponseCache:
+    """
+    SQLite cache of the assistant replies, keyed by a hash of the whole context (up to the assistant
+    header), the sampling settings, the grammar, the seed and the model file. A reply depends only on
+    these when the sampling is deterministic: greedy (temperature 0) or with a fixed seed, because
+    llama-cpp-python seeds a new sampler for each reply. The least recently used replies are evicted
+    once the cache grows over its size cap. It can be used from several threads.
+    """
+
+    def __init__(self, path: str, max_size: int, model_id: str, seed: int) -> None:
+        """
+        Open (or create) a response cache
+
+        @param path: the path of the SQLite database
+        @param max_size: the maximum total size of the cached replies in bytes
+        @param model_id: the identity of the model file (see `model_identity`)
+        @param seed: the seed of the model
+        """
+        self.path = path
+        self.max_size = max_size
+        self.model_id = model_id
+        self.seed = seed
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS replies ('
+                'key TEXT PRIMARY KEY, tokens BLOB NOT NULL, reply TEXT NOT NULL, stop_sequence TEXT, size INTEGER NOT NULL, last_used REAL NOT NULL)'
+            )
+            self.connection.execute('CREATE INDEX IF NOT EXISTS replies_last_used ON replies (last_used)')
+
+    def deterministic(self, temperature: float) -> bool:
+        """
+        Check whether the replies can be cached: the same context always gets the same reply
+
+        @param temperature: the temperature used for sampling
+        @return: whether the sampling is deterministic
+        """
+        return temperature == 0 or self.seed not in RANDOM_SEEDS
+
+    def key(self, tokens: Sequence[int], settings: dict) -> str:
+        """
+        Hash a context and the settings of the reply
+
+        @param tokens: the tokens of the context, assistant header included
+        @param settings: the sampling settings, the grammar and whatever else changes the reply (JSON serializable)
+        @return: the hex digest that identifies the reply
+        """
+        digest = hashlib.sha256(array('i', tokens).tobytes())
+        digest.update(json.dumps([self.model_id, self.seed, settings], sort_keys=True).encode('UTF-8'))
+        return digest.hexdigest()
+
+    def lookup(self, key: str) -> tuple[array, str, str | None] | None:
+        """
+        Find a cached reply, counting a hit or a miss
+
+        @param key: the key of the reply
+        @return: the tokens of the reply, its text and the stop sequence that ended it (None if not cached)
+        """
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT tokens, reply, stop_sequence FROM replies WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.connection.execute('UPDATE replies SET last_used = ? WHERE key = ?', (time.time(), key))
+            self.hits += 1
+
+        tokens = array('i')
+        tokens.frombytes(row[0])
+        return tokens, row[1], row[2]
+
+    def store(self, key: str, tokens: Sequence[int], reply: str, stop_sequence: str | None) -> None:
+        """
+        Store a reply
+
+        @param key: the key of the reply
+        @param tokens: the tokens of the reply that stay in the context
+        @param reply: the text of the reply, before it is stripped
+        @param stop_sequence: the stop sequence that ended the reply, if any
+        """
+        data = array('i', tokens).tobytes()
+        size = len(data) + len(reply.encode('UTF-8'))
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?, ?, ?)',
+                (key, data, reply, stop_sequence, size, time.time())
+            )
+            self._evict()
+
+    def size(self) -> int:
+        """
+        Get the total size of the cached replies
+
+        @return: the size in bytes
+        """
+        with self.lock:
+            return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM replies').fetchone()[0]
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def _evict(self) -> None:
+        total_size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM replies').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        for key, size in self.connection.execute('SELECT key, size FROM replies ORDER BY last_used').fetchall():
+            if total_size <= self.max_size:
+                break
+            self.connection.execute('DELETE FROM replies WHERE key = ?', (key,))
+            total_size -= size
@@ -0,0 +1,257 @@
+import os
+import re
+import json
+import math
+import hashlib
+from collections import Counter
+from collections.abc import Callable
+from utils.files import file_to_markdown, read_text_file
+
+
+WORD_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|\d+')
+CAMEL_PATTERN = re.compile(r'[A-Z]?[a-z0-9]+|[A-Z]+(?![a-z])')
+
+
+def index_terms(text: str) -> list[str]:
+    """
+    Split a text into the terms used by the index: lowercase words and numbers,
+    with the parts of snake_case and camelCase identifiers as extra terms
+
+    @param text: the text
+    @return: the terms
+    """
+    terms = []
+    for word in WORD_PATTERN.findall(text):
+        terms.append(word.lower())
+        parts = [part.lower() for piece in word.split('_') for part in CAMEL_PATTERN.findall(piece)]
+        if len(parts) > 1:
+            terms.extend(parts)
+
+    return terms
+
+
+class Chunk:
+    __slots__ = ('first_line', 'last_line', 'text', 'n_tokens', 'terms')
+
+    def __init__(self, first_line: int, last_line: int, text: str, n_tokens: int, terms: dict[str, int]) -> None:
+        """
+        Create a new chunk of a file
+
+        @param first_line: the number of its first line (from 1)
+        @param last_line: the number of its last line
+        @param text: the text of the chunk
+        @param n_tokens: the number of tokens of the text
+        @param terms: the frequency of each term in the text
+        """
+        self.first_line = first_line
+        self.last_line = last_line
+        self.text = text
+        self.n_tokens = n_tokens
+        self.terms = terms
+
+
+class FileIndex:
+    """
+    BM25 index of the chunks of a file. The chunks are groups of whole lines, or pieces of a line too long for one chunk.
+    """
+
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, chunks: list[Chunk]) -> None:
+        """
+        Create a new file index
+
+        @param chunks: the chunks of the file, in order
+        """
+        self.chunks = chunks
+        self.doc_freqs: Counter = Counter(term for chunk in chunks for term in chunk.terms)
+        self.avg_length = sum(sum(chunk.terms.values()) for chunk in chunks) / max(len(chunks), 1)
+
+    @classmethod
+    def build(cls, text: str, count_tokens: Callable[[str], int], chunk_chars: int) -> 'FileIndex':
+        """
+        Split a text into chunks and index them
+
+        @param text: the text of the file
+        @param count_tokens: the function that counts the tokens of a text
+        @param chunk_chars: the approximate size of a chunk in characters (longer lines are split in pieces of this size)
+        @return: the file index
+        """
+        def make_chunk(first_line: int, last_line: int, chunk_text: str) -> Chunk:
+            return Chunk(first_line, last_line, chunk_text, count_tokens(chunk_text), Counter(index_terms(chunk_text)))
+
+        chunks = []
+        lines: list[str] = []
+        first_line = 1
+        n_chars = 0
+        for line_number, line in enumerate(text.splitlines(), start=1):
+            if len(line) > chunk_chars:
+                # A single chunk would not fit in the budget (e.g. minified code), split the line
+                if len(lines) > 0:
+                    chunks.append(make_chunk(first_line, line_number - 1, '\n'.join(lines)))
+                chunks.extend(make_chunk(line_number, line_number, line[i:i + chunk_chars]) for i in range(0, len(line), chunk_chars))
+                lines = []
+                first_line = line_number + 1
+                n_chars = 0
+                continue
+
+            lines.append(line)
+            n_chars += len(line) + 1
+            if n_chars >= chunk_chars:
+                chunks.append(make_chunk(first_line, line_number, '\n'.join(lines)))
+                lines = []
+                first_line = line_number + 1
+                n_chars = 0
+        if len(lines) > 0:
+            chunks.append(make_chunk(first_line, first_line + len(lines) - 1, '\n'.join(lines)))
+
+        return cls(chunks)
+
+    def n_tokens(self) -> int:
+        return sum(chunk.n_tokens for chunk in self.chunks)
+
+    def scores(self, query: str) -> list[float]:
+        """
+        Score each chunk against a query with BM25
+
+        @param query: the query
+        @return: the score of each chunk
+        """
+        query_terms = set(index_terms(query))
+        n_chunks = len(self.chunks)
+        idf = {term: math.log(1 + (n_chunks - self.doc_freqs[term] + 0.5) / (self.doc_freqs[term] + 0.5)) for term in query_terms if term in self.doc_freqs}
+
+        scores = []
+        for chunk in self.chunks:
+            length_norm = self.K1 * (1 - self.B + self.B * sum(chunk.terms.values()) / self.avg_length)
+            score = 0.0
+            for term, term_idf in idf.items():
+                freq = chunk.terms.get(term, 0)
+                if freq > 0:
+                    score += term_idf * freq * (self.K1 + 1) / (freq + length_norm)
+            scores.append(score)
+
+        return scores
+
+    def select(self, query: str, budget: int) -> list[Chunk]:
+        """
+        Select the chunks most relevant to a query that fit in a token budget
+
+        @param query: the query
+        @param budget: the maximum number of tokens of the selected chunks
+        @return: the selected chunks, in file order
+        """
+        scores = self.scores(query)
+        ranking = sorted((i for i in range(len(self.chunks)) if scores[i] > 0), key=lambda i: (-scores[i], i))
+        if len(ranking) == 0:  # Nothing matches the query, use the beginning of the file
+            ranking = list(range(len(self.chunks)))
+
+        selected = []
+        n_tokens = 0
+        for i in ranking:
+            if n_tokens + self.chunks[i].n_tokens <= budget:
+                selected.append(i)
+                n_tokens += self.chunks[i].n_tokens
+
+        return [self.chunks[i] for i in sorted(selected)]
+
+    def to_dict(self) -> dict:
+        return {'chunks': [[chunk.first_line, chunk.last_line, chunk.text, chunk.n_tokens, chunk.terms] for chunk in self.chunks]}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'FileIndex':
+        return cls([Chunk(*chunk) for chunk in data['chunks']])
+
+
+class Retriever:
+    """
+    Inject only the chunks of a file that are relevant to the user message, within a token budget.
+    The indexes are cached in memory and on disk, keyed by the path, the modification time and
+    the size of the file, so a file is chunked and tokenized again only when it changes.
+    """
+
+    INDEX_EXT = '.json'
+
+    def __init__(self, count_tokens: Callable[[str], int], tokenizer_id: str, cache_dir: str | None = None, chunk_chars: int = 1500) -> None:
+        """
+        Create a new retriever
+
+        @param count_tokens: the function that counts the tokens of a text
+        @param tokenizer_id: the name of the tokenizer (the token counts in the cache depend on it)
+        @param cache_dir: the directory where the indexes are stored (only in memory if None)
+        @param chunk_chars: the approximate size of a chunk in characters
+        """
+        self.count_tokens = count_tokens
+        self.tokenizer_id = tokenizer_id
+        self.cache_dir = cache_dir
+        self.chunk_chars = chunk_chars
+        self.indexes: dict[str, FileIndex] = {}
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def index(self, file_path: str) -> FileIndex:
+        """
+        Get the index of a file, building it if it is not cached
+
+        @param file_path: the path of the file
+        @return: the file index
+        @raises UnicodeError: if the file is not a valid text file
+        @raises ValueError: if the file is binary
+        """
+        stat = os.stat(file_path)
+        key_data = f'{os.path.abspath(file_path)}|{stat.st_mtime_ns}|{stat.st_size}|{self.tokenizer_id}|{self.chunk_chars}'
+        key = hashlib.sha256(key_data.encode('UTF-8')).hexdigest()
+        if key in self.indexes:
+            return self.indexes[key]
+
+        index_path = os.path.join(self.cache_dir, key + self.INDEX_EXT) if self.cache_dir is not None else None
+        index = None
+        if index_path is not None and os.path.isfile(index_path):
+            try:
+                with open(index_path, 'r') as f:
+                    index = FileIndex.from_dict(json.load(f))
+            except (OSError, ValueError, KeyError, TypeError):
+                index = None
+
+        if index is None:
+            index = FileIndex.build(read_text_file(file_path, max_size=None), self.count_tokens, self.chunk_chars)  # Only its chunks are injected, whatever its size
+            if index_path is not None:
+                tmp_path = index_path + '.tmp'
+                try:
+                    with open(tmp_path, 'w') as f:
+                        json.dump(index.to_dict(), f)
+                    os.replace(tmp_path, index_path)
+                except OSError:
+                    pass  # The cache is an optimization, the index is still usable
+
+        self.indexes[key] = index
+        return index
+
+    def file_to_markdown(self, file_path: str, query: str, budget: int, file_name: str | None = None) -> str:
+        """
+        Wrap the chunks of a text file most relevant to a query in markdown code blocks.
+        The whole file is used if it fits in the budget.
+
+        @param file_path: the path of the file
+        @param query: the text used to rank the chunks (the user message)
+        @param budget: the maximum number of tokens of the chunks
+        @param file_name: the name shown to the model (the base name of the file if None)
+        @return: the markdown blocks
+        """
+        try:
+            index = self.index(file_path)
+        except (UnicodeError, ValueError):
+            return file_to_markdown(file_path, file_name)  # Reports the invalid file
+        if index.n_tokens() <= budget:
+            return file_to_markdown(file_path, file_name)
+
+        if file_name is None:
+            file_name = os.path.basename(file_path)
+        file_ext = os.path.splitext(file_path)[1][1:]
+        chunks = index.select(query, budget)
+        if len(chunks) == 0:
+            return f'{file_name} is too long: no part of it fits in {budget} tokens.'
+        blocks = [f'Lines {chunk.first_line}-{chunk.last_line} of {file_name}:\n```{file_ext}\n{chunk.text.strip()}\n```' for chunk in chunks]
+
+        return f'Excerpts of {file_name} ({len(chunks)} of {len(index.chunks)} parts):\n\n' + '\n\n'.join(blocks)
@@ -0,0 +1,204 @@
+import queue
+import threading
+import time
+from llama_cpp import LlamaGrammar
+from utils.chat import Chat
+
+
+class Request:
+    """
+    A chat completion waiting for the model. Its events are put in `events` as
+    ('text', str) while the reply is generated, then ('done', dict) or ('error', str).
+    """
+
+    def __init__(self, messages: list[tuple[str, str]], max_tokens: int, temperature: float, top_p: float, top_k: int, grammar: LlamaGrammar | None = None) -> None:
+        """
+        Create a new request
+
+        @param messages: the messages of the conversation as (agent, content) tuples, the last one from the user
+        @param max_tokens: the maximum number of tokens of the reply
+        @param temperature: the temperature used for sampling
+        @param top_p: the top_p used for sampling
+        @param top_k: the top_k used for sampling
+        @param grammar: the grammar that constrains the reply, if any
+        """
+        self.messages = messages
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.grammar = grammar
+        self.events: queue.Queue = queue.Queue()
+        self.cancelled = threading.Event()
+        self.n_skipped = 0
+
+    def cancel(self) -> None:
+        """
+        Stop the request, for example because the client went away
+        """
+        self.cancelled.set()
+
+
+class Scheduler:
+    """
+    Run the requests one at a time on a pool of chats that share the same model.
+    A request goes to the chat whose messages share the longest prefix with it, so only
+    the new messages are tokenized. The chats share the single KV cache of the model, which
+    only holds the tokens evaluated last: the tokens of another chat are evaluated again,
+    except for the prefix they have in common with the evaluated ones (e.g. the system prompt).
+    So among the waiting requests, the one that shares the most evaluated tokens with the model
+    goes first, unless a request has already been skipped too many times. When too many requests
+    are waiting, new ones are refused (backpressure).
+    """
+
+    MAX_SKIPS = 4
+
+    def __init__(self, chats: list[Chat], max_pending: int = 16) -> None:
+        """
+        Create a new scheduler
+
+        @param chats: the chats of the pool, they must use the same model
+        @param max_pending: the maximum number of requests waiting for the model
+        """
+        self.chats = chats
+        self.max_pending = max_pending
+        self.pending: list[Request] = []
+        self.condition = threading.Condition()
+        self.last_used = {id(chat): 0.0 for chat in chats}
+        self.last_chat: Chat | None = None
+        self.worker = threading.Thread(target=self.run, daemon=True)
+
+    def start(self) -> None:
+        self.worker.start()
+
+    def submit(self, request: Request) -> bool:
+        """
+        Queue a request
+
+        @param request: the request
+        @return: whether the request was accepted (False if too many requests are waiting)
+        """
+        with self.condition:
+            if len(self.pending) >= self.max_pending:
+                return False
+            self.pending.append(request)
+            self.condition.notify()
+
+        return True
+
+    def n_pending(self) -> int:
+        with self.condition:
+            return len(self.pending)
+
+    def run(self) -> None:
+        """
+        Process the requests forever
+        """
+        while True:
+            with self.condition:
+                while len(self.pending) == 0:
+                    self.condition.wait()
+                request = self.select()
+
+            if request.cancelled.is_set():
+                request.events.put(('done', {'finish_reason': 'cancelled'}))
+                continue
+            try:
+                self.process(request)
+            except Exception as e:  # Keep serving the other requests
+                request.events.put(('error', str(e)))
+
+    def select(self) -> Request:
+        """
+        Remove the next request to process from the waiting ones
+
+        @return: the request
+        """
+        best_index = 0
+        if self.pending[0].n_skipped < self.MAX_SKIPS and self.last_chat is not None:  # The oldest request was not skipped too often
+            # The model holds the tokens of the chat evaluated last, up to its last reply
+            n_evaluated = self.last_chat.model_prefix_length()
+            best_reused = -1
+            for i, request in enumerate(self.pending):
+                n_shared = self.shared_messages(self.last_chat, request.messages)
+                last_shared = self.last_chat.messages[n_shared - 1] if n_shared > 0 else None
+                n_reused = min(n_evaluated, last_shared.offset + last_shared.length) if last_shared is not None else 0
+                if n_reused > best_reused:
+                    best_index, best_reused = i, n_reused
+
+        for request in self.pending[:best_index]:
+            request.n_skipped += 1
+        best = self.pending.pop(best_index)
+
+        return best
+
+    def route(self, messages: list[tuple[str, str]]) -> tuple[Chat, int]:
+        """
+        Find the chat whose messages share the longest prefix with a conversation
+
+        @param messages: the messages of the conversation as (agent, content) tuples
+        @return: the chat (the least recently used one if none shares a prefix) and the number of messages shared
+        """
+        best_chat = min(self.chats, key=lambda chat: self.last_used[id(chat)])
+        best_shared = 0
+        for chat in self.chats:
+            n_shared = self.shared_messages(chat, messages)
+            if n_shared > best_shared:
+                best_chat, best_shared = chat, n_shared
+
+        return best_chat, best_shared
+
+    @staticmethod
+    def shared_messages(chat: Chat, messages: list[tuple[str, str]]) -> int:
+        """
+        Count the leading messages of a conversation that a chat already has
+
+        @param chat: the chat
+        @param messages: the messages of the conversation as (agent, content) tuples
+        @return: the number of messages shared (the last message of the conversation is always new)
+        """
+        n_shared = 0
+        for msg, (agent, content) in zip(chat.messages, messages[:-1]):
+            if msg.agent != agent or msg.content != content:
+                break
+            n_shared += 1
+
+        return n_shared
+
+    def process(self, request: Request) -> None:
+        """
+        Generate the reply of a request, streaming its text in the events of the request
+
+        @param request: the request
+        """
+        chat, n_shared = self.route(request.messages)
+        self.last_chat = chat
+        self.last_used[id(chat)] = time.monotonic()
+
+        # Keep the shared messages (their tokens are reused) and append the new ones
+        if n_shared < len(chat.messages):
+            chat.messages = chat.messages[:n_shared]
+            chat.summary_message = None
+            chat.cache_rebuild()
+        for agent, content in request.messages[n_shared:]:
+            chat.send_message(agent, content)
+
+        chat.n_generate = request.max_tokens
+        chat.temperature = request.temperature
+        chat.top_p = request.top_p
+        chat.top_k = request.top_k
+        n_prompt = chat.tokens_used()
+        chat.prefill()
+
+        stream = chat.stream_reply(grammar=request.grammar)
+        for text in stream:
+            request.events.put(('text', text))
+            if request.cancelled.is_set():
+                chat.cancel()
+
+        n_completion = chat.content_length(chat.messages[-1])
+        request.events.put(('done', {
+            'finish_reason': 'length' if n_completion >= request.max_tokens else 'stop',
+            'prompt_tokens': n_prompt,
+            'completion_tokens': n_completion
+        }))
@@ -0,0 +1,81 @@
+import json
+import mmap
+import struct
+from array import array
+from collections.abc import Sequence
+from utils.model_state import ModelState
+
+
+class SessionFile:
+    """
+    Single-file snapshot of a chat: its messages, its context tokens and the model state.
+
+    Layout: header, model identity (UTF-8), messages (JSON), context tokens (int32 array, 8-byte aligned), model state.
+    """
+
+    MAGIC = b'LTSESS02'
+    HEADER = struct.Struct('<8sQQQ')  # Magic, model identity size, messages size, number of context tokens
+    ALIGNMENT = 8
+
+    @classmethod
+    def write(cls, path: str, model_id: str, messages: list[dict], tokens: Sequence[int], state: ModelState) -> None:
+        """
+        Write a session file
+
+        @param path: the path of the session file
+        @param model_id: the identity of the model that evaluated the tokens
+        @param messages: the messages of the chat as dicts
+        @param tokens: the context tokens of the chat
+        @param state: the model state
+        """
+        model_id_data = model_id.encode('UTF-8')
+        messages_data = json.dumps(messages).encode('UTF-8')
+        tokens_data = array('i', tokens).tobytes()
+
+        with open(path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(model_id_data), len(messages_data), len(tokens)))
+            f.write(model_id_data)
+            f.write(messages_data)
+            f.write(b'\0' * cls._padding(f.tell()))
+            f.write(tokens_data)
+            state.write(f)
+
+    @classmethod
+    def read(cls, path: str) -> tuple[str, list[dict], array, ModelState]:
+        """
+        Read a session file, memory-mapping it to avoid intermediate copies
+
+        @param path: the path of the session file
+        @return: the identity of the model, the messages as dicts, the context tokens and the model state
+        @raises ValueError: if the file is not a valid session file
+        """
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) < cls.HEADER.size:
+                raise ValueError('not a session file')
+            magic, model_id_size, messages_size, n_tokens = cls.HEADER.unpack_from(mm, 0)
+            if magic != cls.MAGIC:
+                raise ValueError('not a session file (or saved by an older version)')
+
+            offset = cls.HEADER.size
+            model_id = mm[offset:offset + model_id_size].decode('UTF-8')
+            offset += model_id_size
+            messages = json.loads(mm[offset:offset + messages_size].decode('UTF-8'))
+            offset += messages_size
+            offset += cls._padding(offset)
+
+            tokens = array('i')
+            tokens_size = n_tokens * tokens.itemsize
+            if offset + tokens_size > len(mm):
+                raise ValueError('truncated session file')
+            with memoryview(mm)[offset:offset + tokens_size] as view:
+                tokens.frombytes(view)
+            offset += tokens_size
+
+            f.seek(offset)
+            state = ModelState.read(f)
+
+        return model_id, messages, tokens, state
+
+    @classmethod
+    def _padding(cls, offset: int) -> int:
+        return -offset % cls.ALIGNMENT
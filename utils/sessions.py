@@ -0,0 +1,165 @@
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from collections.abc import Callable
+from utils.chat import Chat
+from utils.model_state import ModelState
+
+
+class SessionManager:
+    """
+    Several named chats sharing one loaded model. Only the active chat is in the KV cache
+    of the model: when switching, its model state is parked and the state of the other chat
+    is restored, so a parked chat continues without evaluating its context again.
+    Parked states stay in RAM up to a budget, then the least recently used ones are spilled to disk.
+    """
+
+    STATE_EXT = '.state'
+
+    def __init__(self, chat_factory: Callable[[], Chat], ram_budget: int, spill_dir: str | None = None) -> None:
+        """
+        Create a new session manager
+
+        @param chat_factory: the function that creates the chat of a new session
+        @param ram_budget: the maximum total size in bytes of the parked states kept in RAM
+        @param spill_dir: the directory where the states over the budget are written (a temporary one if None)
+        """
+        self.chat_factory = chat_factory
+        self.ram_budget = ram_budget
+        self.spill_dir = spill_dir
+        self.temp_dir: str | None = None
+
+        self.chats: dict[str, Chat] = {}
+        self.active: str | None = None
+        self.hot: OrderedDict[str, ModelState] = OrderedDict()  # Least recently used first
+        self.spilled: dict[str, str] = {}  # Session name -> state file
+
+    @property
+    def chat(self) -> Chat:
+        return self.chats[self.active]
+
+    def new(self, name: str, chat: Chat | None = None) -> Chat:
+        """
+        Create a session and make it the active one
+
+        @param name: the name of the session
+        @param chat: the chat of the session (a new one from the factory if None)
+        @return: the chat of the session
+        @raises ValueError: if a session with the same name exists
+        """
+        if name in self.chats:
+            raise ValueError(f'session "{name}" already exists')
+
+        self._park()
+        # Its prompt reuses the tokens it shares with the model state (system prompt), if any
+        self.chats[name] = chat if chat is not None else self.chat_factory()
+        self.active = name
+
+        return self.chats[name]
+
+    def switch(self, name: str) -> Chat:
+        """
+        Make a session the active one, restoring its model state
+
+        @param name: the name of the session
+        @return: the chat of the session
+        @raises ValueError: if the session does not exist
+        @raises RuntimeError: if its model state cannot be restored (it is kept, the active session does not change)
+        """
+        if name not in self.chats:
+            raise ValueError(f'session "{name}" does not exist')
+        if name == self.active:
+            return self.chat
+
+        self._park()
+        state = self.hot.get(name)
+        if state is None and name in self.spilled:
+            try:
+                with open(self.spilled[name], 'rb') as f:
+                    state = ModelState.read(f)
+            except (OSError, ValueError):  # Lost, its context is evaluated again
+                self._remove_spilled(name)
+        if state is not None:  # Without a state only the tokens it shares with the model are reused
+            model = self.chats[name].model
+            try:
+                state.restore(model)
+            except RuntimeError:
+                model.n_tokens = 0  # The KV cache may be partially overwritten, the active chat evaluates its context again
+                raise
+        # The state is in the model now
+        self.hot.pop(name, None)
+        if name in self.spilled:
+            self._remove_spilled(name)
+        self.active = name
+
+        return self.chat
+
+    def list(self) -> list[tuple[str, Chat, str]]:
+        """
+        Get the sessions
+
+        @return: the name, the chat and where the model state is (active, ram, disk) of each session
+        """
+        sessions = []
+        for name, chat in self.chats.items():
+            location = 'active' if name == self.active else 'ram' if name in self.hot else 'disk'
+            sessions.append((name, chat, location))
+
+        return sessions
+
+    def ram_usage(self) -> int:
+        """
+        Get the total size of the parked states kept in RAM
+
+        @return: the size in bytes
+        """
+        return sum(state.size() for state in self.hot.values())
+
+    def close(self) -> None:
+        """
+        Delete the spilled states
+        """
+        for path in self.spilled.values():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.spilled.clear()
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
+
+    def _park(self) -> None:
+        """
+        Save the model state of the active session, spilling the oldest states over the RAM budget
+        """
+        if self.active is None:
+            return
+
+        self.hot[self.active] = ModelState.capture(self.chat.model)
+        self.hot.move_to_end(self.active)
+
+        total_size = self.ram_usage()
+        while total_size > self.ram_budget and len(self.hot) > 0:
+            name, state = self.hot.popitem(last=False)
+            total_size -= state.size()
+            path = os.path.join(self._spill_dir(), name.encode('UTF-8').hex() + self.STATE_EXT)
+            with open(path, 'wb') as f:
+                state.write(f)
+            self.spilled[name] = path
+
+    def _remove_spilled(self, name: str) -> None:
+        try:
+            os.remove(self.spilled.pop(name))
+        except OSError:
+            pass
+
+    def _spill_dir(self) -> str:
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            return self.spill_dir
+
+        if self.temp_dir is None:
+            self.temp_dir = tempfile.mkdtemp(prefix='llamaterm-sessions-')
+        return self.temp_dir
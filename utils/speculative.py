@@ -0,0 +1,59 @@
+import numpy as np
+import numpy.typing as npt
+from typing import Any
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+
+class LlamaSmallModelDecoding(LlamaDraftModel):
+    """
+    Draft the next tokens with a small model that shares the vocabulary of the main one.
+    The drafts are verified by the main model, so the output is unchanged.
+    """
+
+    def __init__(self, model: Llama, num_pred_tokens: int = 10) -> None:
+        """
+        Create a new draft model
+
+        @param model: the small model used for drafting
+        @param num_pred_tokens: the number of tokens drafted at every step
+        """
+        self.model = model
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any) -> npt.NDArray[np.intc]:
+        draft = []
+        # Greedy decoding, the KV cache of the draft model is reused through prefix matching
+        for token in self.model.generate(tokens=input_ids.tolist(), temp=0.0, top_k=1):
+            if token == self.model.token_eos():
+                break
+            draft.append(token)
+            if len(draft) >= self.num_pred_tokens:
+                break
+
+        return np.array(draft, dtype=np.intc)
+
+
+def create_draft_model(mode: str, n_draft: int, draft_model_path: str = '', n_ctx: int = 0, use_gpu: bool = False) -> LlamaDraftModel | None:
+    """
+    Create the draft model used for speculative decoding
+
+    @param mode: none, lookup (n-gram prompt lookup in the context) or model (small GGUF model)
+    @param n_draft: the number of tokens drafted at every step
+    @param draft_model_path: the path of the small GGUF model (model mode only)
+    @param n_ctx: the context size of the small model (model mode only)
+    @param use_gpu: whether to offload the small model to the GPU (model mode only)
+    @return: the draft model or None if speculative decoding is disabled
+    """
+    if mode == 'lookup':
+        return LlamaPromptLookupDecoding(num_pred_tokens=n_draft)
+    if mode == 'model':
+        draft_llama = Llama(
+            model_path=draft_model_path,
+            n_ctx=n_ctx,
+            n_gpu_layers=-1 if use_gpu else 0,
+            verbose=False
+        )
+        return LlamaSmallModelDecoding(draft_llama, num_pred_tokens=n_draft)
+
+    return None
@@ -0,0 +1,80 @@
+import time
+import threading
+from collections.abc import Callable
+
+
+class StartupProfile:
+    """
+    Timeline of the startup: when each step ended since the start of the program
+    """
+
+    def __init__(self, start_time: float | None = None) -> None:
+        """
+        Create a new startup profile
+
+        @param start_time: the `time.perf_counter()` of the start of the program (now if None)
+        """
+        self.start_time = start_time if start_time is not None else time.perf_counter()
+        self.events: list[tuple[float, str]] = []
+
+    def mark(self, event: str) -> None:
+        """
+        Record the end of a step, it can be called from any thread
+
+        @param event: the name of the step
+        """
+        self.events.append((time.perf_counter(), event))
+
+    def format(self) -> str:
+        """
+        Format the timeline, one step per line with its time since the start and since the previous step
+
+        @return: the timeline
+        """
+        lines = ['Startup timeline:']
+        last_time = self.start_time
+        for event_time, event in sorted(self.events):
+            lines.append(f'  {(event_time - self.start_time) * 1000:8.1f}ms  (+{(event_time - last_time) * 1000:7.1f}ms)  {event}')
+            last_time = event_time
+
+        return '\n'.join(lines)
+
+
+class BackgroundTask:
+    """
+    Run a function on a daemon thread, so that the program does not wait for it to exit
+    """
+
+    def __init__(self, function: Callable[[], object]) -> None:
+        """
+        Start a new background task
+
+        @param function: the function to run
+        """
+        self.function = function
+        self.value: object = None
+        self.error: BaseException | None = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def done(self) -> bool:
+        return not self.thread.is_alive()
+
+    def result(self) -> object:
+        """
+        Wait for the function to end
+
+        @return: what the function returned
+        @raises: what the function raised
+        """
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+        return self.value
+
+    def _run(self) -> None:
+        try:
+            self.value = self.function()
+        except BaseException as e:  # Raised again by `result()` in the waiting thread
+            self.error = e
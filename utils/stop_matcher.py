@@ -0,0 +1,178 @@
+class StopMatch:
+    def __init__(self, sequence: str, start: int, emitted: int) -> None:
+        """
+        Describe a stop sequence found in a text stream
+
+        @param sequence: the stop sequence that was matched
+        @param start: the position in the stream where the sequence begins
+        @param emitted: how many characters of the sequence arrived in previous chunks
+        """
+        self.sequence = sequence
+        self.start = start
+        self.emitted = emitted
+
+    def __repr__(self) -> str:
+        return f'<StopMatch {self.sequence!r} at {self.start}>'
+
+
+class StopSequenceMatcher:
+    """
+    Incremental multi-pattern matcher (Aho-Corasick) used to detect stop sequences
+    in a stream of text chunks. Feeding a chunk costs O(len(chunk)) regardless of
+    how long the stream already is.
+    """
+
+    def __init__(self, sequences: list[str]) -> None:
+        """
+        Build the automaton for the given stop sequences
+
+        @param sequences: the stop sequences to look for (empty ones are ignored)
+        """
+        self.sequences = list(dict.fromkeys(seq for seq in sequences if len(seq) > 0))
+
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._depth: list[int] = [0]
+        self._output: list[str | None] = [None]
+
+        for seq in self.sequences:
+            self._add_sequence(seq)
+        self._build_failure_links()
+
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Reset the matcher state to start a new stream
+        """
+        self.state = 0
+        self.position = 0
+
+    def feed(self, text: str) -> StopMatch | None:
+        """
+        Feed a new chunk of the stream into the matcher
+
+        @param text: the new chunk of text
+        @return: the first stop sequence completed by this chunk, if any
+        """
+        chunk_start = self.position
+        state = self.state
+        for char in text:
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            self.position += 1
+
+            sequence = self._output[state]
+            if sequence is not None:
+                self.state = state
+                start = self.position - len(sequence)
+                return StopMatch(sequence, start, max(0, chunk_start - start))
+
+        self.state = state
+        return None
+
+    @property
+    def partial_length(self) -> int:
+        """
+        The number of trailing characters of the stream that could be the beginning of a stop sequence
+        """
+        return self._depth[self.state]
+
+    def _add_sequence(self, sequence: str) -> None:
+        state = 0
+        for char in sequence:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._depth.append(self._depth[state] + 1)
+                self._output.append(None)
+            state = next_state
+        self._output[state] = sequence
+
+    def _build_failure_links(self) -> None:
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                if self._output[next_state] is None:  # Inherit sequences that end as a suffix of this state
+                    self._output[next_state] = self._output[self._fail[next_state]]
+                queue.append(next_state)
+
+
+class TokenStopMatcher:
+    """
+    Incremental matcher of stop sequences expressed as token ids, backed by a trie.
+    It lets the generation stop on the exact token that completes a stop sequence,
+    without detokenizing or searching the reply text.
+    """
+
+    def __init__(self, sequences: dict[str, list[int]]) -> None:
+        """
+        Build the trie for the given tokenized stop sequences
+
+        @param sequences: the stop sequences text mapped to their tokens (empty ones are ignored)
+        """
+        self._children: list[dict[int, int]] = [{}]
+        self._depth: list[int] = [0]
+        self._output: list[str | None] = [None]
+
+        for sequence, tokens in sequences.items():
+            if len(tokens) > 0:
+                self._add_sequence(sequence, tokens)
+
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Reset the matcher state to start a new stream
+        """
+        self.active: list[int] = []
+
+    def feed(self, token: int) -> tuple[str, int] | None:
+        """
+        Feed a new token into the matcher
+
+        @param token: the new token
+        @return: the stop sequence completed by this token and its length in tokens, if any
+        """
+        active = []
+        for node in [*self.active, 0]:  # Continue the partial matches and try to start a new one
+            child = self._children[node].get(token)
+            if child is None:
+                continue
+            sequence = self._output[child]
+            if sequence is not None:
+                self.active = []
+                return sequence, self._depth[child]
+            active.append(child)
+
+        self.active = active
+        return None
+
+    @property
+    def partial_length(self) -> int:
+        """
+        The number of trailing tokens that could be the beginning of a stop sequence
+        """
+        return max((self._depth[node] for node in self.active), default=0)
+
+    def _add_sequence(self, sequence: str, tokens: list[int]) -> None:
+        node = 0
+        for token in tokens:
+            child = self._children[node].get(token)
+            if child is None:
+                child = len(self._children)
+                self._children[node][token] = child
+                self._children.append({})
+                self._depth.append(self._depth[node] + 1)
+                self._output.append(None)
+            node = child
+        if self._output[node] is None:
+            self._output[node] = sequence
@@ -0,0 +1,203 @@
+import os
+import time
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp._internals import LlamaBatch, LlamaContext
+
+
+KV_CACHE_TYPES = {
+    'f32': llama_cpp.GGML_TYPE_F32,
+    'f16': llama_cpp.GGML_TYPE_F16,
+    'q8_0': llama_cpp.GGML_TYPE_Q8_0,
+    'q5_1': llama_cpp.GGML_TYPE_Q5_1,
+    'q5_0': llama_cpp.GGML_TYPE_Q5_0,
+    'q4_1': llama_cpp.GGML_TYPE_Q4_1,
+    'q4_0': llama_cpp.GGML_TYPE_Q4_0
+}
+
+SAMPLE_TEXT = (
+    'The quick brown fox jumps over the lazy dog. A local model reads the prompt in large batches '
+    'and then writes its reply one token at a time, so both phases are measured. '
+)
+
+
+class TuneSettings:
+    __slots__ = ('n_threads', 'n_threads_batch', 'n_batch', 'n_ubatch', 'flash_attn', 'type_k', 'type_v')
+
+    def __init__(self, n_threads: int, n_threads_batch: int, n_batch: int, n_ubatch: int, flash_attn: bool, type_k: str, type_v: str) -> None:
+        """
+        Create new performance settings
+
+        @param n_threads: the threads used to generate the tokens
+        @param n_threads_batch: the threads used to evaluate the prompt
+        @param n_batch: the maximum number of tokens given to llama.cpp at once
+        @param n_ubatch: the maximum number of tokens evaluated at once
+        @param flash_attn: whether flash attention is used
+        @param type_k: the data type of the K cache (a key of `KV_CACHE_TYPES`)
+        @param type_v: the data type of the V cache (quantized types need flash attention)
+        """
+        self.n_threads = n_threads
+        self.n_threads_batch = n_threads_batch
+        self.n_batch = n_batch
+        self.n_ubatch = n_ubatch
+        self.flash_attn = flash_attn
+        self.type_k = type_k
+        self.type_v = type_v
+
+    def replace(self, **changes) -> 'TuneSettings':
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return TuneSettings(**values)
+
+    def to_env(self) -> str:
+        return '\n'.join([
+            f'N_THREADS={self.n_threads}',
+            f'N_THREADS_BATCH={self.n_threads_batch}',
+            f'N_BATCH={self.n_batch}',
+            f'N_UBATCH={self.n_ubatch}',
+            f'FLASH_ATTN={int(self.flash_attn)}',
+            f'TYPE_K="{self.type_k}"',
+            f'TYPE_V="{self.type_v}"'
+        ])
+
+    def __repr__(self) -> str:
+        return f'threads={self.n_threads}/{self.n_threads_batch} batch={self.n_batch}/{self.n_ubatch} flash_attn={int(self.flash_attn)} kv={self.type_k}/{self.type_v}'
+
+
+class Tuner:
+    """
+    Find the fastest threads, batch sizes, flash attention and KV cache types for a loaded model.
+    Every candidate gets its own llama.cpp context, sharing the weights of the model, where
+    a prompt is evaluated (prefill) and then tokens are evaluated one at a time (decode).
+    The settings are tuned one axis at a time, keeping the best value of the previous axes,
+    because the whole grid would take too long.
+    """
+
+    N_AXES = 6
+    BATCH_SIZES = (128, 256, 512, 1024, 2048)
+
+    def __init__(self, model: Llama, n_prompt: int = 512, n_decode: int = 64, repeats: int = 2) -> None:
+        """
+        Create a new tuner
+
+        @param model: the llama object whose weights are used
+        @param n_prompt: the number of prompt tokens evaluated by each candidate
+        @param n_decode: the number of tokens decoded one at a time by each candidate
+        @param repeats: the number of measurements of each candidate (the fastest one counts)
+        """
+        self.model = model
+        self.n_prompt = n_prompt
+        self.n_decode = n_decode
+        self.repeats = repeats
+
+        tokens = model.tokenize(SAMPLE_TEXT.encode('UTF-8'), add_bos=False, special=False)
+        self.prompt = (tokens * (n_prompt // len(tokens) + 1))[:n_prompt]
+
+    def measure(self, settings: TuneSettings) -> tuple[float, float] | None:
+        """
+        Measure the speed of some settings
+
+        @param settings: the settings
+        @return: the prefill and the decode speed in tokens per second (None if llama.cpp does not support the settings)
+        """
+        params = llama_cpp.llama_context_params.from_buffer_copy(self.model.context_params)
+        params.n_ctx = self.n_prompt + self.n_decode
+        params.n_batch = settings.n_batch
+        params.n_ubatch = min(settings.n_ubatch, settings.n_batch)
+        params.n_threads = settings.n_threads
+        params.n_threads_batch = settings.n_threads_batch
+        params.flash_attn_type = llama_cpp.LLAMA_FLASH_ATTN_TYPE_ENABLED if settings.flash_attn else llama_cpp.LLAMA_FLASH_ATTN_TYPE_DISABLED
+        params.type_k = KV_CACHE_TYPES[settings.type_k]
+        params.type_v = KV_CACHE_TYPES[settings.type_v]
+        params.n_seq_max = 1
+        params.embeddings = False
+        try:
+            ctx = LlamaContext(model=self.model._model, params=params, verbose=False)
+        except ValueError:
+            return None
+
+        batch = LlamaBatch(n_tokens=settings.n_batch, embd=0, n_seq_max=1, verbose=False)
+        prefill_time = decode_time = float('inf')
+        try:
+            for _ in range(self.repeats):
+                ctx.kv_cache_clear()
+                start_time = time.perf_counter()
+                for start in range(0, self.n_prompt, settings.n_batch):
+                    batch.set_batch(self.prompt[start:start + settings.n_batch], n_past=start, logits_all=False)
+                    ctx.decode(batch)
+                prefill_time = min(prefill_time, time.perf_counter() - start_time)
+
+                start_time = time.perf_counter()
+                for i in range(self.n_decode):
+                    batch.set_batch([self.prompt[i]], n_past=self.n_prompt + i, logits_all=False)
+                    ctx.decode(batch)
+                decode_time = min(decode_time, time.perf_counter() - start_time)
+        except RuntimeError:
+            return None
+        finally:
+            batch.close()
+            ctx.close()
+
+        return self.n_prompt / prefill_time, self.n_decode / decode_time
+
+    def tune(self, settings: TuneSettings, callback=None) -> tuple[TuneSettings, float, float]:
+        """
+        Tune the settings one axis at a time
+
+        @param settings: the settings to start from
+        @param callback: called with the settings, the prefill and the decode speed of each candidate
+        @return: the fastest settings, their prefill and their decode speed
+        @raises ValueError: if llama.cpp does not support the starting settings
+        """
+        self.measure(settings)  # Warm up the caches, the first measurement is always slower
+        best = settings
+        best_speeds = self.measure(best)
+        if best_speeds is None:
+            raise ValueError(f'the starting settings are not supported: {best}')
+        if callback is not None:
+            callback(best, *best_speeds)
+
+        for i in range(self.N_AXES):
+            phase, candidates = self._axes(best)[i]  # Around the best settings found so far
+            for candidate in candidates:
+                if repr(candidate) == repr(best):
+                    continue
+                speeds = self.measure(candidate)
+                if speeds is None:
+                    continue
+                if callback is not None:
+                    callback(candidate, *speeds)
+                if self._score(phase, speeds) > self._score(phase, best_speeds):
+                    best, best_speeds = candidate, speeds
+
+        return best, *best_speeds
+
+    def _axes(self, settings: TuneSettings) -> list[tuple[str, list[TuneSettings]]]:
+        """
+        Get the candidates of each axis, changing only that axis of some settings
+
+        @param settings: the settings
+        @return: the phase that scores each axis (decode, prefill or a whole turn) and its candidates
+        """
+        n_cpus = os.cpu_count() or 1
+        thread_counts = sorted({max(n_cpus // 4, 1), max(n_cpus // 2, 1), max(n_cpus * 3 // 4, 1), n_cpus})
+        batch_sizes = [size for size in self.BATCH_SIZES if size <= max(self.n_prompt, self.BATCH_SIZES[0])]
+
+        return [
+            ('decode', [settings.replace(n_threads=n) for n in thread_counts]),
+            ('prefill', [settings.replace(n_threads_batch=n) for n in thread_counts]),
+            ('prefill', [settings.replace(n_batch=size, n_ubatch=min(size, settings.n_ubatch)) for size in batch_sizes]),
+            ('prefill', [settings.replace(n_ubatch=size) for size in batch_sizes if size <= settings.n_batch]),
+            ('turn', [settings.replace(flash_attn=flash_attn, type_v=settings.type_v if flash_attn else 'f16') for flash_attn in (False, True)]),
+            # A quantized V cache needs flash attention
+            ('turn', [settings.replace(type_k=kv_type, type_v=kv_type if settings.flash_attn else 'f16') for kv_type in ('f16', 'q8_0')])
+        ]
+
+    def _score(self, phase: str, speeds: tuple[float, float]) -> float:
+        prefill_speed, decode_speed = speeds
+        if phase == 'decode':
+            return decode_speed
+        if phase == 'prefill':
+            return prefill_speed
+
+        return 1 / (self.n_prompt / prefill_speed + self.n_decode / decode_speed)
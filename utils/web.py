@@ -0,0 +1,185 @@
+import os
+import re
+import json
+import hashlib
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from utils.html_cleaner import HTMLCleaner
+
+
+URL_PATTERN = re.compile(r'\[(https?://[^\[\]\s]+)\]')
+
+
+def find_urls(text: str) -> list[str]:
+    """
+    Find the web pages in square brackets (`[https://example.com]`)
+
+    @param text: the text of the message
+    @return: the URLs, in order and without duplicates
+    """
+    return list(dict.fromkeys(URL_PATTERN.findall(text)))
+
+
+def remove_urls(text: str) -> str:
+    """
+    Remove the web pages in square brackets from a text
+
+    @param text: the text of the message
+    @return: the rest of the text
+    """
+    return URL_PATTERN.sub(' ', text)
+
+
+def page_to_markdown(url: str, cleaned_html: str) -> str:
+    return f'Content of {url}:\n```html\n{cleaned_html}\n```'
+
+
+class WebPage:
+    __slots__ = ('url', 'cleaned_html', 'reduction', 'etag', 'last_modified')
+
+    def __init__(self, url: str, cleaned_html: str, reduction: float, etag: str | None = None, last_modified: str | None = None) -> None:
+        """
+        Create a new cleaned web page
+
+        @param url: the URL of the page
+        @param cleaned_html: the cleaned HTML of the page
+        @param reduction: how much smaller the cleaned HTML is, in percent
+        @param etag: the `ETag` header of the response, if any
+        @param last_modified: the `Last-Modified` header of the response, if any
+        """
+        self.url = url
+        self.cleaned_html = cleaned_html
+        self.reduction = reduction
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'WebPage':
+        return cls(**{name: data[name] for name in cls.__slots__})
+
+
+class WebFetcher:
+    """
+    Fetch and clean web pages. The connections are pooled and kept alive between fetches, several pages
+    are fetched at the same time and the cleaned pages are cached: a cached page is requested again
+    with its `ETag`/`Last-Modified` and is not downloaded nor cleaned again if the server answers 304.
+    """
+
+    PAGE_EXT = '.json'
+
+    def __init__(self, cache_dir: str | None = None, n_workers: int = 8, timeout: float = 30.0) -> None:
+        """
+        Create a new web fetcher
+
+        @param cache_dir: the directory where the cleaned pages are stored (only in memory if None)
+        @param n_workers: the maximum number of pages fetched at the same time
+        @param timeout: the timeout of each request in seconds
+        """
+        self.cache_dir = cache_dir
+        self.n_workers = n_workers
+        self.timeout = timeout
+        self.pages: dict[str, WebPage] = {}
+        self.hits = 0  # Pages not modified since they were cached
+        self.misses = 0
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=n_workers, pool_maxsize=n_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch(self, url: str) -> WebPage:
+        """
+        Fetch and clean a web page, unless it was not modified since it was cached
+
+        @param url: the URL of the page
+        @return: the cleaned page
+        @raises Exception: If there's an error fetching the URL
+        """
+        cached = self._load(url)
+        headers = {}
+        if cached is not None:
+            if cached.etag is not None:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified is not None:
+                headers['If-Modified-Since'] = cached.last_modified
+
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+            if response.status_code == 304 and cached is not None:
+                self.hits += 1
+                return cached
+            response.raise_for_status()
+            original_html = response.text
+        except requests.RequestException as e:
+            raise Exception(f"Error fetching the URL: {e}")
+
+        self.misses += 1
+        cleaned_html = HTMLCleaner.clean_html(original_html)
+        page = WebPage(
+            url, cleaned_html, HTMLCleaner._calculate_reduction(len(original_html), len(cleaned_html)),
+            response.headers.get('ETag'), response.headers.get('Last-Modified')
+        )
+        self._store(page)
+        return page
+
+    def fetch_many(self, urls: list[str]) -> list[WebPage | Exception]:
+        """
+        Fetch and clean several web pages at the same time
+
+        @param urls: the URLs of the pages
+        @return: the cleaned page or the error of each URL, in order
+        """
+        def fetch(url: str) -> WebPage | Exception:
+            try:
+                return self.fetch(url)
+            except Exception as e:
+                return e
+
+        if len(urls) <= 1:
+            return [fetch(url) for url in urls]
+        with ThreadPoolExecutor(max_workers=min(self.n_workers, len(urls))) as executor:
+            return list(executor.map(fetch, urls))
+
+    def close(self) -> None:
+        self.session.close()
+
+    def _page_path(self, url: str) -> str | None:
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode('UTF-8')).hexdigest() + self.PAGE_EXT)
+
+    def _load(self, url: str) -> WebPage | None:
+        if url in self.pages:
+            return self.pages[url]
+
+        page_path = self._page_path(url)
+        if page_path is None or not os.path.isfile(page_path):
+            return None
+        try:
+            with open(page_path, 'r') as f:
+                page = WebPage.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        self.pages[url] = page
+        return page
+
+    def _store(self, page: WebPage) -> None:
+        self.pages[page.url] = page
+        if page.etag is None and page.last_modified is None:
+            return  # It could never be validated, so it is always fetched again
+
+        page_path = self._page_path(page.url)
+        if page_path is not None:
+            tmp_path = page_path + '.tmp'
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump(page.to_dict(), f)
+                os.replace(tmp_path, page_path)
+            except OSError:
+                pass  # The page is still cached in memory